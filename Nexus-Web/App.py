@@ -1,11 +1,30 @@
-from flask import Flask, render_template, request, jsonify, send_file, redirect
+from flask import Flask, render_template, request, jsonify, send_file, redirect, g, Response, stream_with_context
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
 import os
 import io
+import time
+import uuid
+import zipfile
+import unicodedata
+from urllib.parse import quote
 import story_backend
 import matrix_backend
-from chat_backend import cargar_conocimiento, consultar_gemini
-import zipfile
+import metrics
+import cancellation
+import chat_sessions
+import deadline
+import document_store
+import llm_client
+import llm_scheduler
+import model_router
+import parse_pool
+import profiling
+import singleflight
+import zip_stream
+import coverage_gaps
+from admission import AdmissionController, admission_control, check_thread_budget
+from chat_backend import cargar_conocimiento, consultar_en_sesion
 import logging
 from dotenv import load_dotenv
 
@@ -25,6 +44,10 @@ logger = logging.getLogger(__name__)
 UPLOAD_FOLDER = 'temp_uploads'
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
+# Tamaño máximo de una petición (documentos y matrices subidos); por encima se responde 413
+MAX_UPLOAD_MB = float(os.getenv('MAX_UPLOAD_MB', '32'))
+app.config['MAX_CONTENT_LENGTH'] = int(MAX_UPLOAD_MB * 1024 * 1024)
+
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 
@@ -54,6 +77,162 @@ except Exception as e:
     logger.error(f"Error cargando conocimiento JIRA: {e}")
     CONOCIMIENTO_JIRA = None
 
+# ============================================================================
+# CONTROL DE ADMISIÓN (por worker): concurrencia, profundidad de cola y espera máxima
+# ============================================================================
+
+# Fracción de los hilos del worker (fuera de la reserva) que puede ocupar cada endpoint
+MATRIX_ADMISSION = AdmissionController.from_env("matrix", share=0.3, queue_timeout=30)
+STORY_ADMISSION = AdmissionController.from_env("story", share=0.25, queue_timeout=30)
+PREVIEW_ADMISSION = AdmissionController.from_env("preview", share=0.25, queue_timeout=15)
+UPLOAD_ADMISSION = AdmissionController.from_env("upload", share=0.2, queue_timeout=10)
+
+admission_error = check_thread_budget([MATRIX_ADMISSION, STORY_ADMISSION, PREVIEW_ADMISSION, UPLOAD_ADMISSION])
+if admission_error:
+    logger.warning(admission_error)
+
+# ============================================================================
+# MÉTRICAS POR PETICIÓN
+# ============================================================================
+
+@app.before_request
+def start_request_metrics():
+    g.metrics_endpoint = request.endpoint or "unknown"
+    g.metrics_start = time.perf_counter()
+    metrics.REQUESTS_IN_FLIGHT.labels(g.metrics_endpoint).inc()
+
+# ============================================================================
+# PERFILADO BAJO DEMANDA (cabecera X-Profile-Token o muestreo, ver profiling.py)
+# ============================================================================
+
+@app.before_request
+def start_request_profile():
+    trigger = profiling.should_profile(request.endpoint, request.headers.get(profiling.TOKEN_HEADER))
+    if trigger is None:
+        return
+    profile = profiling.RequestProfile(request.endpoint, request.path, trigger)
+    try:
+        started = profile.start()
+    except Exception as e:
+        logger.warning(f"No se pudo iniciar el perfilado de {request.endpoint}: {e}")
+        return
+    if started:
+        g.request_profile = profile
+    elif trigger == profiling.TRIGGER_HEADER:
+        logger.info(f"Perfilado omitido en {request.endpoint}: otra petición de este worker ya se está perfilando")
+
+@app.after_request
+def attach_request_profile(response):
+    profile = g.pop("request_profile", None)
+    if profile is not None:
+        response.headers[profiling.ID_HEADER] = profile.id
+        # Las descargas se generan mientras se envían: el perfil termina al cerrar la respuesta
+        profile.snapshot("handler")
+        response.call_on_close(lambda: profile.finish(response.status_code))
+    return response
+
+@app.teardown_request
+def discard_request_profile(error=None):
+    # Solo queda aquí si after_request no llegó a ejecutarse
+    profile = g.pop("request_profile", None)
+    if profile is not None:
+        profile.finish(500)
+
+# ============================================================================
+# PRIORIDAD DE LAS LLAMADAS AL LLM (chat interactivo > vista previa > generación masiva)
+# ============================================================================
+
+LLM_PRIORITY_BY_ENDPOINT = {
+    'get_chat_response': llm_scheduler.PRIORITY_INTERACTIVE,
+    'preview': llm_scheduler.PRIORITY_PREVIEW,
+}
+
+def request_user():
+    """Identifica al usuario para el reparto justo de llamadas al LLM."""
+    forwarded = request.headers.get('X-Forwarded-For', '')
+    return request.headers.get('X-User-Id') or forwarded.split(',')[0].strip() or request.remote_addr
+
+@app.before_request
+def set_llm_priority():
+    priority = LLM_PRIORITY_BY_ENDPOINT.get(request.endpoint, llm_scheduler.PRIORITY_BULK)
+    g.llm_context_token = llm_scheduler.set_request_context(priority, request_user())
+
+@app.teardown_request
+def reset_llm_priority(error=None):
+    # Los hilos de gthread se reutilizan: el contexto no debe pasar a la siguiente petición
+    token = g.pop("llm_context_token", None)
+    if token is not None:
+        llm_scheduler.reset_request_context(token)
+
+# ============================================================================
+# CANCELACIÓN DE GENERACIONES (el navegador envía job_id y avisa si se cierra la página)
+# ============================================================================
+
+CANCELLABLE_ENDPOINTS = {'generate_matrix', 'matrix_coverage', 'generate_and_download_story', 'preview'}
+# El chat no se cancela, pero su plazo acota la espera por el resumen y lo hereda la compactación
+DEADLINE_ENDPOINTS = CANCELLABLE_ENDPOINTS | {'get_chat_response'}
+
+@app.before_request
+def bind_cancel_token():
+    if request.endpoint in CANCELLABLE_ENDPOINTS:
+        job_id = request.headers.get('X-Job-Id') or request.form.get('job_id')
+        g.cancel_context_token = cancellation.bind(job_id)
+
+@app.teardown_request
+def release_cancel_token(error=None):
+    token = g.pop("cancel_context_token", None)
+    if token is not None:
+        cancellation.release(token)
+
+@app.before_request
+def bind_request_deadline():
+    # Las generaciones largas y el chat tienen un plazo; el cliente puede pedir uno menor
+    if request.endpoint in DEADLINE_ENDPOINTS:
+        seconds = deadline.REQUEST_DEADLINE_SECONDS
+        try:
+            seconds = min(seconds, float(request.headers.get('X-Request-Deadline', seconds)))
+        except ValueError:
+            pass
+        g.deadline_context_token = deadline.bind(seconds)
+
+@app.teardown_request
+def release_request_deadline(error=None):
+    token = g.pop("deadline_context_token", None)
+    if token is not None:
+        deadline.release(token)
+
+def set_coverage_headers(response, result):
+    """Indica en cabeceras si el resultado es parcial (plazo agotado) su cobertura y cuánto se reutilizó de la biblioteca de casos"""
+    response.headers['X-Partial-Result'] = 'true' if result.get('partial') else 'false'
+    if result.get('coverage'):
+        coverage = result['coverage']
+        response.headers['X-Coverage'] = f"{coverage['completed']}/{coverage['total']}"
+    if result.get('reuse'):
+        response.headers['X-Reuse-Ratio'] = str(result['reuse']['reuse_ratio'])
+        response.headers['X-LLM-Calls-Avoided'] = str(result['reuse']['llm_calls_avoided'])
+    return response
+
+def cancelled_response():
+    """Respuesta para un trabajo cancelado por el cliente (nadie la leerá, pero se registra)"""
+    metrics.JOBS_CANCELLED.labels(request.endpoint).inc()
+    logger.info(f"Generación cancelada por el cliente en {request.endpoint}")
+    return jsonify({"error": "Generación cancelada por el cliente"}), 499
+
+@app.after_request
+def record_request_status(response):
+    g.metrics_status = response.status_code
+    return response
+
+@app.teardown_request
+def finish_request_metrics(error=None):
+    # Con respuestas en streaming el teardown puede ejecutarse más de una vez
+    start = g.pop("metrics_start", None)
+    if start is None:
+        return
+    status = g.get("metrics_status", 500)
+    metrics.REQUESTS_IN_FLIGHT.labels(g.metrics_endpoint).dec()
+    metrics.REQUEST_LATENCY.labels(g.metrics_endpoint, str(status)).observe(time.perf_counter() - start)
+
 # ============================================================================
 # MANEJO GLOBAL DE ERRORES PARA DEVOLVER JSON
 # ============================================================================
@@ -73,6 +252,12 @@ def not_found_error(error):
     </html>
     """, 404
 
+@app.errorhandler(413)
+def request_too_large(error):
+    if request.path.startswith('/api/'):
+        return jsonify({"error": f"El archivo supera el tamaño máximo de {MAX_UPLOAD_MB:g} MB"}), 413
+    return f"El archivo supera el tamaño máximo de {MAX_UPLOAD_MB:g} MB", 413
+
 @app.errorhandler(500)
 def internal_error(error):
     if request.path.startswith('/api/'):
@@ -120,6 +305,10 @@ def health_check():
             "api_key_length": len(api_key) if api_key else 0,
             "conocimiento_jira_loaded": CONOCIMIENTO_JIRA is not None,
             "upload_folder_exists": os.path.exists(UPLOAD_FOLDER),
+            "matrix_parse_stats": matrix_backend.get_parse_stats(),
+            "llm_scheduler": llm_client.get_scheduler_stats(),
+            "model_routes": model_router.describe(),
+            "parse_pool": parse_pool.get_stats(),
             "dependencies": {}
         }
 
@@ -147,6 +336,12 @@ def health_check():
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """Métricas en formato de texto de Prometheus (agregadas entre workers)"""
+    body, content_type = metrics.render_metrics()
+    return Response(body, mimetype=content_type)
+
 # ============================================================================
 # RUTAS PRINCIPALES
 # ============================================================================
@@ -179,19 +374,93 @@ def story_creator():
 # API ENDPOINTS CON MANEJO DE ERRORES
 # ============================================================================
 
+def guarded_stream(chunks, download_name):
+    """
+    Genera el primer bloque antes de enviar la cabecera (un error ahí todavía es un 500) y,
+    si la exportación falla a mitad de la descarga, lo registra y corta la conexión sin el
+    bloque final de chunked, de modo que el cliente ve una descarga incompleta y no un 200 válido
+    """
+    chunks = iter(chunks)
+    first = next(chunks, None)
+
+    def generate():
+        try:
+            if first is not None:
+                yield first
+            yield from chunks
+        except Exception as e:
+            logger.error(f"Error exportando {download_name} durante la descarga: {e}", exc_info=True)
+            raise
+    return generate()
+
+def download_response(chunks, download_name, mimetype, gzip=False):
+    """Respuesta de descarga que envía los bytes a medida que el generador los produce"""
+    if gzip:
+        chunks = zip_stream.gzip_stream(chunks)
+    response = Response(stream_with_context(guarded_stream(chunks, download_name)), mimetype=mimetype)
+    if gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+        response.vary.add('Accept-Encoding')
+    # Igual que send_file: nombres no ASCII van en filename* (RFC 5987)
+    try:
+        download_name.encode('ascii')
+        names = {"filename": download_name}
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', download_name).encode('ascii', 'ignore').decode('ascii')
+        names = {"filename": simple, "filename*": f"UTF-8''{quote(download_name, safe='!#$&+^`|~')}"}
+    response.headers.set('Content-Disposition', 'attachment', **names)
+    return response
+
+def save_upload(file):
+    """Guarda el archivo subido con un nombre único (peticiones concurrentes pueden subir el mismo nombre)"""
+    filename = f"{uuid.uuid4().hex}_{secure_filename(file.filename)}"
+    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    file.save(filepath)
+    return filepath
+
+# Extractor de texto de cada pipeline (las historias ignoran las tablas del DOCX)
+DOCUMENT_EXTRACTORS = {
+    'matrix': matrix_backend.extract_text_from_file,
+    'story': story_backend.extract_text_from_file,
+}
+
+def request_document():
+    """
+    Archivo de la petición: un documento subido por adelantado (document_id de /api/upload)
+    o el archivo del formulario, que se guarda como temporal.
+    Devuelve (filepath, document_id, respuesta_de_error).
+    """
+    document_id = request.form.get('document_id')
+    if document_id:
+        try:
+            return document_store.source_path(document_id), document_id, None
+        except document_store.DocumentNotFound:
+            return None, None, (jsonify({"error": "El documento no existe o expiró. Vuelve a subir el archivo"}), 404)
+    if 'file' not in request.files:
+        return None, None, (jsonify({"error": "No se subió ningún archivo"}), 400)
+    file = request.files['file']
+    if file.filename == '':
+        return None, None, (jsonify({"error": "No se seleccionó un archivo"}), 400)
+    return save_upload(file), None, None
+
+def extract_document_text(pipeline, filepath, document_id=None):
+    """Texto del documento: el extraído en segundo plano tras /api/upload o, si no, extraído ahora"""
+    if document_id:
+        return document_store.get_text(document_id, pipeline, DOCUMENT_EXTRACTORS[pipeline])
+    with metrics.stage(pipeline, "extract"):
+        return DOCUMENT_EXTRACTORS[pipeline](filepath)
+
+def remove_upload(filepath, document_id=None):
+    """Borra el archivo temporal de la petición (los documentos de /api/upload expiran solos)"""
+    if not document_id and os.path.exists(filepath):
+        os.remove(filepath)
+
 @app.route('/api/matrix', methods=['POST'])
+@admission_control(MATRIX_ADMISSION)
 def generate_matrix():
     try:
         logger.info("Iniciando generación de matriz")
 
-        # Verificar archivo
-        if 'file' not in request.files:
-            return jsonify({"error": "No se subió ningún archivo"}), 400
-
-        file = request.files['file']
-        if file.filename == '':
-            return jsonify({"error": "No se seleccionó un archivo"}), 400
-
         # Obtener parámetros del formulario, incluyendo el nuevo campo 'historia' y 'types'
         context = request.form.get('contexto', '')
         flow = request.form.get('flujo', '')
@@ -201,75 +470,173 @@ def generate_matrix():
             types = ['funcional']
             logger.warning("No se especificaron tipos de prueba, usando 'funcional' por defecto")
         output_filename = request.form.get('output_filename', 'matriz_de_prueba')
+        output_mode = request.form.get('output_mode') or None
+        # zip (JSON + CSV + XLSX) o descarga directa en streaming: ndjson, csv, json
+        export_format = (request.form.get('format') or 'zip').lower()
+        if export_format != 'zip' and export_format not in matrix_backend.STREAM_FORMATS:
+            return jsonify({"error": f"Formato no soportado: {export_format}"}), 400
 
-        logger.info(f"Procesando archivo: {file.filename}")
         logger.info(f"Contexto: {len(context)} caracteres")
         logger.info(f"Flujo: {len(flow)} caracteres")
         logger.info(f"Historia de Usuario: {len(historia)} caracteres")
         logger.info(f"Tipos de prueba: {types}")
 
-        # Guardar archivo temporal
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
+        # Archivo subido con el formulario o documento subido por adelantado
+        filepath, document_id, error_response = request_document()
+        if error_response:
+            return error_response
+        logger.info(f"Procesando archivo: {document_id or os.path.basename(filepath)}")
 
         try:
-            # Extraer texto
-            logger.info("Extrayendo texto del archivo")
-            text = matrix_backend.extract_text_from_file(filepath)
-            logger.info(f"Texto extraído: {len(text)} caracteres")
-
-            # Generar matriz
-            logger.info("Generando matriz de pruebas")
-            result = matrix_backend.generar_matriz_test(context, flow, historia, text, types)
+            def generate():
+                # Extraer texto
+                logger.info("Extrayendo texto del archivo")
+                text = extract_document_text("matrix", filepath, document_id)
+                logger.info(f"Texto extraído: {len(text)} caracteres")
+
+                # Generar matriz
+                logger.info("Generando matriz de pruebas")
+                return matrix_backend.generar_matriz_test(context, flow, historia, text, types, output_mode)
+
+            # Peticiones idénticas en curso (mismo archivo y parámetros) comparten una sola generación
+            key = singleflight.request_key('matrix', filepath, {
+                "contexto": context, "flujo": flow, "historia": historia, "types": types, "output_mode": output_mode
+            })
+            result, shared = singleflight.do(key, generate, private_errors=(cancellation.JobCancelled,))
+            if shared:
+                logger.info("Resultado compartido con una petición idéntica en curso")
             logger.info(f"Resultado: {result['status']}")
 
             # Limpiar archivo temporal
-            if os.path.exists(filepath):
-                os.remove(filepath)
+            remove_upload(filepath, document_id)
 
             if result['status'] == 'success':
                 matrix_data = result['matrix']
                 logger.info(f"Matriz generada con {len(matrix_data)} casos de prueba")
 
-                # Crear ZIP con archivos
-                zip_buffer = io.BytesIO()
-                with zipfile.ZipFile(zip_buffer, 'a', zipfile.ZIP_DEFLATED, False) as zip_file:
-                    # JSON
-                    json_content = matrix_backend.save_to_json_buffer(matrix_data)
-                    zip_file.writestr(f"{output_filename}.json", json_content)
-
-                    # CSV
-                    csv_content = matrix_backend.save_to_csv_buffer(matrix_data)
-                    zip_file.writestr(f"{output_filename}.csv", csv_content)
-
-                    # XLSX
-                    xlsx_content = matrix_backend.save_to_xlsx_buffer(matrix_data)
-                    zip_file.writestr(f"{output_filename}.xlsx", xlsx_content)
-
-                zip_buffer.seek(0)
-                logger.info("Archivo ZIP creado exitosamente")
-
-                return send_file(
-                    zip_buffer,
-                    as_attachment=True,
-                    download_name=f"{output_filename}.zip",
-                    mimetype='application/zip'
+                if result.get('partial'):
+                    logger.warning(f"Matriz parcial por plazo agotado: {result['coverage']}")
+
+                if export_format != 'zip':
+                    # Filas en streaming (gzip si el cliente lo acepta): se pueden procesar antes de que termine la exportación
+                    extension, mimetype = matrix_backend.STREAM_FORMATS[export_format]
+                    response = download_response(
+                        matrix_backend.iter_matrix_export(matrix_data, export_format),
+                        f"{output_filename}.{extension}",
+                        mimetype,
+                        gzip=bool(request.accept_encodings['gzip'])
+                    )
+                    return set_coverage_headers(response, result)
+
+                # ZIP en streaming: cada archivo se genera y se envía sin armar el ZIP completo en memoria
+                response = download_response(
+                    matrix_backend.iter_matrix_zip(matrix_data, output_filename),
+                    f"{output_filename}.zip",
+                    'application/zip'
                 )
+                return set_coverage_headers(response, result)
             else:
                 logger.error(f"Error en la generación: {result['message']}")
                 return jsonify({"error": result['message']}), 500
 
+        except cancellation.JobCancelled:
+            remove_upload(filepath, document_id)
+            return cancelled_response()
         except Exception as e:
             logger.error(f"Error procesando archivo: {e}", exc_info=True)
-            if os.path.exists(filepath):
-                os.remove(filepath)
+            remove_upload(filepath, document_id)
             return jsonify({"error": f"Error en el procesamiento del archivo: {str(e)}"}), 500
 
+    except RequestEntityTooLarge:
+        raise
     except Exception as e:
         logger.error(f"Error general en generate_matrix: {e}", exc_info=True)
         return jsonify({"error": f"Error interno: {str(e)}"}), 500
 
+@app.route('/api/matrix/coverage', methods=['POST'])
+@admission_control(MATRIX_ADMISSION)
+def matrix_coverage():
+    """
+    Cobertura de una matriz previa frente a su documento (análisis local, sin LLM).
+    Con mode=followup se generan casos solo para los requerimientos sin cubrir y se
+    descarga la matriz combinada, en el mismo formato que /api/matrix.
+    """
+    try:
+        if 'file' not in request.files or 'matrix' not in request.files:
+            return jsonify({"error": "Se requieren el documento ('file') y la matriz previa ('matrix')"}), 400
+
+        file = request.files['file']
+        matrix_file = request.files['matrix']
+        if file.filename == '' or matrix_file.filename == '':
+            return jsonify({"error": "No se seleccionó un archivo"}), 400
+
+        mode = (request.form.get('mode') or 'report').lower()
+        if mode not in ('report', 'followup'):
+            return jsonify({"error": f"Modo no soportado: {mode}"}), 400
+        export_format = (request.form.get('format') or 'zip').lower()
+        if export_format != 'zip' and export_format not in matrix_backend.STREAM_FORMATS:
+            return jsonify({"error": f"Formato no soportado: {export_format}"}), 400
+        try:
+            threshold = float(request.form['threshold']) if request.form.get('threshold') else None
+        except ValueError:
+            return jsonify({"error": "El umbral debe ser un número"}), 400
+
+        try:
+            previous_cases = matrix_backend.read_matrix_file(matrix_file.read(), matrix_file.filename)
+        except (ValueError, UnicodeDecodeError, zipfile.BadZipFile) as e:
+            return jsonify({"error": f"No se pudo leer la matriz previa: {str(e)}"}), 400
+
+        filepath = save_upload(file)
+        try:
+            with metrics.stage("matrix", "extract"):
+                text = matrix_backend.extract_text_from_file(filepath)
+        finally:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+
+        if mode == 'report':
+            with metrics.stage("matrix", "coverage"):
+                report = coverage_gaps.analyze_coverage(text, previous_cases, threshold)
+            logger.info(f"Cobertura: {report['covered']}/{report['requirements_total']} requerimientos")
+            return jsonify(report)
+
+        types = request.form.getlist('types') or ['funcional']
+        output_filename = request.form.get('output_filename', 'matriz_de_prueba')
+        result = matrix_backend.generar_casos_para_brechas(
+            request.form.get('contexto', ''), request.form.get('flujo', ''), request.form.get('historia', ''),
+            text, previous_cases, types, request.form.get('output_mode') or None, threshold
+        )
+        if result['status'] != 'success':
+            logger.error(f"Error en el seguimiento de cobertura: {result['message']}")
+            return jsonify({"error": result['message']}), 500
+
+        logger.info(f"Seguimiento de cobertura: {result['new_cases']} casos nuevos, {result['total_cases']} en total")
+        if export_format != 'zip':
+            extension, mimetype = matrix_backend.STREAM_FORMATS[export_format]
+            response = download_response(
+                matrix_backend.iter_matrix_export(result['matrix'], export_format),
+                f"{output_filename}.{extension}",
+                mimetype,
+                gzip=bool(request.accept_encodings['gzip'])
+            )
+        else:
+            response = download_response(
+                matrix_backend.iter_matrix_zip(result['matrix'], output_filename),
+                f"{output_filename}.zip",
+                'application/zip'
+            )
+        response.headers['X-New-Cases'] = str(result['new_cases'])
+        response.headers['X-Uncovered-Requirements'] = str(len(result['coverage_report']['uncovered']))
+        return set_coverage_headers(response, result)
+
+    except cancellation.JobCancelled:
+        return cancelled_response()
+    except RequestEntityTooLarge:
+        raise
+    except Exception as e:
+        logger.error(f"Error general en matrix_coverage: {e}", exc_info=True)
+        return jsonify({"error": f"Error interno: {str(e)}"}), 500
+
 @app.route('/api/chat', methods=['POST'])
 def get_chat_response():
     try:
@@ -282,73 +649,83 @@ def get_chat_response():
         if not pregunta:
             return jsonify({"error": "Por favor, escribe una pregunta"}), 400
 
-        logger.info(f"Pregunta: {pregunta[:100]}...")
-        respuesta = consultar_gemini(pregunta, CONOCIMIENTO_JIRA)
+        # Sesión de varios turnos: se crea una nueva si no viene o ya expiró
+        session_id = request.json.get('session_id')
+        if not chat_sessions.exists(session_id):
+            session_id = chat_sessions.create()
+
+        logger.info(f"Pregunta (sesión {session_id}): {pregunta[:100]}...")
+        respuesta = consultar_en_sesion(session_id, pregunta, CONOCIMIENTO_JIRA)
         logger.info("Respuesta generada exitosamente")
 
-        return jsonify({"respuesta": respuesta})
+        return jsonify({"respuesta": respuesta, "session_id": session_id})
 
     except Exception as e:
         logger.error(f"Error en chat: {e}", exc_info=True)
         return jsonify({"error": f"Error procesando la consulta: {str(e)}"}), 500
 
+@app.route('/api/chat/<session_id>', methods=['DELETE'])
+def delete_chat_session(session_id):
+    """Descarta el historial de una sesión de chat (botón "Limpiar")"""
+    if not chat_sessions.delete(session_id):
+        return jsonify({"error": "La sesión no existe o ya expiró"}), 404
+    return jsonify({"status": "deleted", "session_id": session_id})
+
 @app.route('/api/story', methods=['POST'])
+@admission_control(STORY_ADMISSION)
 def generate_and_download_story():
     try:
         logger.info("Iniciando generación de historias")
         logger.info(f"Parámetros recibidos - Archivo: {request.files['file'].filename if 'file' in request.files else 'No file'}, Rol: {request.form.get('role', 'Usuario')}, Tipo: {request.form.get('story_type', 'funcionalidad')}, Contexto: {request.form.get('business_context', '')[:200]}...")
 
-        if 'file' not in request.files:
-            return jsonify({"error": "No se subió ningún archivo"}), 400
-
-        file = request.files['file']
-        if file.filename == '':
-            return jsonify({"error": "No se seleccionó un archivo"}), 400
-
         # Obtener parámetros
         role = request.form.get('role', 'Usuario')
         story_type = request.form.get('story_type', 'funcionalidad')
         output_filename = request.form.get('output_filename', 'historias_generadas')
         business_context = request.form.get('business_context', '')
 
-        logger.info(f"Archivo: {file.filename}, Rol: {role}, Tipo: {story_type}, Contexto: {len(business_context)} caracteres")
-
-        # Guardar archivo temporal
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
+        # Archivo subido con el formulario o documento subido por adelantado
+        filepath, document_id, error_response = request_document()
+        if error_response:
+            return error_response
+        logger.info(f"Archivo: {document_id or os.path.basename(filepath)}, Rol: {role}, Tipo: {story_type}, Contexto: {len(business_context)} caracteres")
 
         try:
-            # Extraer texto
-            text = story_backend.extract_text_from_file(filepath)
-            logger.info(f"Documento con {len(text)} caracteres")
+            def generate():
+                # Extraer texto
+                text = extract_document_text("story", filepath, document_id)
+                logger.info(f"Documento con {len(text)} caracteres")
 
-            # Procesar según tamaño
-            if len(text) > 5000:
-                logger.info("Usando procesamiento avanzado para documento grande")
-                result = story_backend.process_large_document(text, role, story_type, business_context)
+                # Procesar según tamaño
+                if len(text) > 5000:
+                    logger.info("Usando procesamiento avanzado para documento grande")
+                    result = story_backend.process_large_document(text, role, story_type, business_context)
 
-                if result['status'] == 'success':
-                    stories = [result['story']]
-                else:
-                    raise Exception(result['message'])
-            else:
-                logger.info("Usando procesamiento por chunks")
-                chunks = story_backend.split_document_into_chunks(text)
-                logger.info(f"Dividido en {len(chunks)} chunks")
-
-                stories = []
-                for i, chunk in enumerate(chunks, 1):
-                    logger.info(f"Procesando chunk {i}/{len(chunks)}")
-                    result = story_backend.generate_story_from_chunk(chunk, role, story_type, business_context)
                     if result['status'] == 'success':
-                        stories.append(result['story'])
-                    else:
-                        raise Exception(result['message'])
+                        return {"stories": [result['story']], "partial": result['partial'],
+                                "coverage": result['coverage']}
+                    raise Exception(result['message'])
+
+                logger.info("Usando procesamiento por chunks (en paralelo)")
+                result = story_backend.generate_story_from_text(text, role, story_type, business_context)
+                if result['status'] == 'success':
+                    return {"stories": result['stories'], "partial": result['partial'],
+                            "coverage": result['coverage']}
+                raise Exception(result['message'])
+
+            # Peticiones idénticas en curso (mismo archivo y parámetros) comparten una sola generación
+            key = singleflight.request_key('story', filepath, {
+                "role": role, "story_type": story_type, "business_context": business_context
+            })
+            result, shared = singleflight.do(key, generate, private_errors=(cancellation.JobCancelled,))
+            if shared:
+                logger.info("Historias compartidas con una petición idéntica en curso")
+            stories = result['stories']
+            if result['partial']:
+                logger.warning(f"Historias parciales por plazo agotado: {result['coverage']}")
 
             # Limpiar archivo temporal
-            if os.path.exists(filepath):
-                os.remove(filepath)
+            remove_upload(filepath, document_id)
 
             # Validar número mínimo de historias
             MIN_STORIES = 5
@@ -357,76 +734,179 @@ def generate_and_download_story():
 
             # Crear documento Word
             logger.info("Creando documento Word")
-            doc = story_backend.create_word_document(stories)
-            stories_buffer = io.BytesIO()
-            doc.save(stories_buffer)
-            stories_buffer.seek(0)
+            with metrics.stage("story", "export_docx"):
+                doc = story_backend.create_word_document(stories)
+                stories_buffer = io.BytesIO()
+                doc.save(stories_buffer)
+                stories_buffer.seek(0)
 
             logger.info("Proceso completado exitosamente")
 
-            return send_file(
+            response = send_file(
                 stories_buffer,
                 as_attachment=True,
                 download_name=f"{output_filename}.docx",
                 mimetype='application/vnd.openxmlformats-officedocument.wordprocessingml.document'
             )
+            return set_coverage_headers(response, result)
 
+        except cancellation.JobCancelled:
+            remove_upload(filepath, document_id)
+            return cancelled_response()
         except Exception as e:
             logger.error(f"Error procesando story: {e}", exc_info=True)
-            if os.path.exists(filepath):
-                os.remove(filepath)
+            remove_upload(filepath, document_id)
             return jsonify({"error": f"Error en el procesamiento: {str(e)}"}), 500
 
+    except RequestEntityTooLarge:
+        raise
     except Exception as e:
         logger.error(f"Error general en generate_story: {e}", exc_info=True)
         return jsonify({"error": f"Error interno: {str(e)}"}), 500
 
 @app.route('/api/preview', methods=['POST'])
+@admission_control(PREVIEW_ADMISSION)
 def preview():
     try:
         logger.info(f"Parámetros recibidos en preview - Archivo: {request.files['file'].filename if 'file' in request.files else 'No file'}, Rol: {request.form.get('role', 'Usuario')}, Tipo: {request.form.get('story_type', 'historia de usuario')}, Contexto: {request.form.get('business_context', '')[:200]}...")
 
-        if 'file' not in request.files:
-            return jsonify({"error": "No se subió ningún archivo"}), 400
-
-        file = request.files['file']
-        if file.filename == '':
-            return jsonify({"error": "No se seleccionó un archivo"}), 400
-
         role = request.form.get('role', 'Usuario')
         story_type = request.form.get('story_type', 'historia de usuario')
         business_context = request.form.get('business_context', '')
 
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
+        filepath, document_id, error_response = request_document()
+        if error_response:
+            return error_response
 
         try:
-            text = story_backend.extract_text_from_file(filepath)
+            text = extract_document_text("story", filepath, document_id)
             result = story_backend.generate_story_from_text(text, role, story_type, business_context)
 
-            if os.path.exists(filepath):
-                os.remove(filepath)
+            remove_upload(filepath, document_id)
 
             if result['status'] == 'success':
                 return jsonify({
                     "status": "success",
                     "stories": result['stories'],
-                    "total_stories": len(result['stories'])
+                    "total_stories": len(result['stories']),
+                    "partial": result['partial'],
+                    "coverage": result['coverage']
                 })
             else:
                 return jsonify({"error": result['message']}), 500
 
+        except cancellation.JobCancelled:
+            remove_upload(filepath, document_id)
+            return cancelled_response()
         except Exception as e:
             logger.error(f"Error en preview: {e}", exc_info=True)
-            if os.path.exists(filepath):
-                os.remove(filepath)
+            remove_upload(filepath, document_id)
             return jsonify({"error": f"Error en el procesamiento: {str(e)}"}), 500
 
+    except RequestEntityTooLarge:
+        raise
     except Exception as e:
         logger.error(f"Error general en preview: {e}", exc_info=True)
         return jsonify({"error": f"Error interno: {str(e)}"}), 500
 
+@app.route('/api/upload', methods=['POST'])
+@admission_control(UPLOAD_ADMISSION)
+def upload_document():
+    """
+    Subida anticipada: guarda el archivo en cuanto el usuario lo elige y empieza a extraer
+    su texto en segundo plano. Devuelve el document_id que aceptan /api/matrix, /api/story
+    y /api/preview en lugar del archivo. Los documentos se conservan después de la petición,
+    así que hay cuota por cliente y total (ver document_store).
+    """
+    try:
+        if 'file' not in request.files or request.files['file'].filename == '':
+            return jsonify({"error": "No se subió ningún archivo"}), 400
+        file = request.files['file']
+        pipeline = request.form.get('pipeline', 'matrix')
+        if pipeline not in DOCUMENT_EXTRACTORS:
+            return jsonify({"error": f"Pipeline no soportado: {pipeline}"}), 400
+        if not file.filename.lower().endswith(('.docx', '.pdf')):
+            return jsonify({"error": "Formato de archivo no soportado. Usa .docx o .pdf."}), 400
+
+        try:
+            document_id = document_store.create(file, request_user(), request.content_length)
+        except document_store.QuotaExceeded as e:
+            logger.warning(f"Subida rechazada por cuota: {e}")
+            return jsonify({"error": str(e)}), 429 if e.per_client else 503
+        document_store.start_extraction(document_id, pipeline, DOCUMENT_EXTRACTORS[pipeline])
+        logger.info(f"Documento {document_id} subido ({file.filename}), extrayendo para {pipeline}")
+        return jsonify({"document_id": document_id, "pipeline": pipeline,
+                        "status": document_store.STATUS_PROCESSING}), 202
+
+    except RequestEntityTooLarge:
+        raise
+    except Exception as e:
+        logger.error(f"Error en upload_document: {e}", exc_info=True)
+        return jsonify({"error": f"Error interno: {str(e)}"}), 500
+
+@app.route('/api/upload/<document_id>', methods=['GET'])
+def upload_status(document_id):
+    """Estado de la extracción de un documento subido por adelantado"""
+    pipeline = request.args.get('pipeline', 'matrix')
+    if pipeline not in DOCUMENT_EXTRACTORS:
+        return jsonify({"error": f"Pipeline no soportado: {pipeline}"}), 400
+    try:
+        info = document_store.status(document_id, pipeline)
+    except document_store.DocumentNotFound:
+        return jsonify({"error": "El documento no existe o expiró"}), 404
+    info.update({"document_id": document_id, "pipeline": pipeline})
+    return jsonify(info)
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """Cancela una generación en curso (la página la llama al cerrarse con navigator.sendBeacon)"""
+    if not cancellation.request_cancel(job_id):
+        return jsonify({"error": "Identificador de trabajo inválido"}), 400
+    logger.info(f"Cancelación solicitada para el trabajo {job_id}")
+    return jsonify({"status": "cancelled", "job_id": job_id}), 202
+
+# ============================================================================
+# PERFILES DE PETICIONES (requieren la cabecera X-Profile-Token)
+# ============================================================================
+
+def profiles_forbidden():
+    """Respuesta 403 si la cabecera no trae el token de administración (None si lo trae)"""
+    if profiling.authorized(request.headers.get(profiling.TOKEN_HEADER)):
+        return None
+    return jsonify({"error": "Se requiere un token de perfilado válido"}), 403
+
+@app.route('/api/profiles', methods=['GET'])
+def list_request_profiles():
+    """Perfiles guardados en este host, más recientes primero"""
+    forbidden = profiles_forbidden()
+    if forbidden:
+        return forbidden
+    return jsonify({"profiles": profiling.list_profiles()})
+
+@app.route('/api/profiles/<profile_id>', methods=['GET'])
+def get_request_profile(profile_id):
+    """Resumen de CPU y memoria de una petición perfilada"""
+    forbidden = profiles_forbidden()
+    if forbidden:
+        return forbidden
+    try:
+        return jsonify(profiling.summary(profile_id))
+    except profiling.ProfileNotFound:
+        return jsonify({"error": "El perfil no existe o expiró"}), 404
+
+@app.route('/api/profiles/<profile_id>/pstats', methods=['GET'])
+def download_request_profile(profile_id):
+    """Perfil de CPU completo en formato pstats (python -m pstats, snakeviz)"""
+    forbidden = profiles_forbidden()
+    if forbidden:
+        return forbidden
+    try:
+        path = profiling.pstats_path(profile_id)
+    except profiling.ProfileNotFound:
+        return jsonify({"error": "El perfil no existe o expiró"}), 404
+    return send_file(path, mimetype='application/octet-stream', as_attachment=True,
+                     download_name=f"profile_{profile_id}.prof")
+
 # ============================================================================
 # CONFIGURACIÓN PARA PRODUCCIÓN
 # ============================================================================
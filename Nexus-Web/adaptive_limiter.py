@@ -0,0 +1,62 @@
+"""
+Limitador adaptativo de concurrencia (AIMD) para las llamadas al LLM.
+
+El número de llamadas en vuelo permitidas crece de forma aditiva con cada
+éxito (+1 por cada "ventana" de `limit` éxitos) y se reduce de forma
+multiplicativa cuando Gemini responde con throttling (429/503) o timeouts.
+Vive en el event loop de llm_client, por lo que no necesita locks de hilos.
+
+El limitador solo lleva la cuenta; quién obtiene cada hueco libre lo decide
+el planificador de prioridades (llm_scheduler).
+"""
+import os
+import time
+
+import metrics
+
+
+class AdaptiveLimiter:
+    def __init__(self, initial, minimum, maximum, decrease_factor=0.5, cooldown=1.0):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease_factor = decrease_factor
+        # Tras un recorte se ignoran otros fallos durante `cooldown` segundos: las llamadas
+        # que ya estaban en vuelo fallan juntas y no deben provocar recortes encadenados
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        metrics.LLM_CONCURRENCY_LIMIT.set(int(self.limit))
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            int(os.getenv("LLM_CONCURRENCY_INITIAL", "8")),
+            int(os.getenv("LLM_CONCURRENCY_MIN", "1")),
+            int(os.getenv("LLM_CONCURRENCY_MAX", "64"))
+        )
+
+    def try_acquire(self, reserve=0):
+        """Ocupa un hueco si hay capacidad, dejando libres `reserve` huecos del límite actual."""
+        if self.in_flight < max(1, int(self.limit) - reserve):
+            self.in_flight += 1
+            return True
+        return False
+
+    def release(self):
+        self.in_flight -= 1
+
+    def on_success(self):
+        """Incremento aditivo."""
+        self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+        metrics.LLM_CONCURRENCY_LIMIT.set(int(self.limit))
+
+    def on_throttle(self):
+        """Decremento multiplicativo (como máximo uno por periodo de cooldown)."""
+        ahora = time.monotonic()
+        if ahora - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = ahora
+        self.limit = max(self.minimum, self.limit * self.decrease_factor)
+        metrics.LLM_CONCURRENCY_LIMIT.set(int(self.limit))
+        print(f"⚠️ Throttling del LLM: límite de concurrencia reducido a {int(self.limit)}")
@@ -0,0 +1,170 @@
+"""
+Control de admisión para los endpoints de generación.
+
+Cada endpoint tiene un número máximo de peticiones en ejecución y una cola
+acotada. Cuando la cola está llena (o la espera supera el máximo configurado)
+la petición se rechaza de inmediato con 429 y Retry-After, en lugar de aceptar
+todo y que todas las peticiones acaben en timeout a la vez.
+
+Los límites son por proceso (worker de gunicorn). Una petición en cola ocupa
+un hilo de gthread mientras espera, así que ejecución más cola de todos los
+endpoints tiene que caber en los hilos del worker y dejar hilos libres para
+el chat, /health y /metrics: si no, los hilos se agotan antes de que se
+llene alguna cola y las peticiones nuevas esperan en el backlog de gunicorn
+en lugar de recibir el 429. Por eso los límites por defecto se derivan de
+GUNICORN_THREADS: cada endpoint recibe una fracción de los hilos que no son
+reserva (dos tercios en ejecución y uno en cola), y check_thread_budget
+avisa si los valores configurados no caben.
+
+Con respuestas en streaming (descargas de la matriz) la exportación ocurre
+después de que la vista devuelve la respuesta: el hueco se ocupa hasta que
+se cierra la respuesta, para que ese trabajo también cuente.
+
+Configuración:
+    GUNICORN_THREADS                  hilos por worker (el mismo valor que gunicorn.conf.py)
+    ADMISSION_HEADROOM                fracción de hilos que nunca ocupan los endpoints con admisión
+    ADMISSION_<NOMBRE>_CONCURRENCY    peticiones en ejecución (por defecto, según su fracción de hilos)
+    ADMISSION_<NOMBRE>_QUEUE          peticiones en cola (por defecto, según su fracción de hilos)
+    ADMISSION_<NOMBRE>_QUEUE_TIMEOUT  espera máxima en cola, en segundos
+"""
+import math
+import os
+import threading
+import time
+from functools import wraps
+
+from flask import current_app, jsonify
+
+import metrics
+
+GUNICORN_THREADS = int(os.getenv("GUNICORN_THREADS", "32"))
+ADMISSION_HEADROOM = float(os.getenv("ADMISSION_HEADROOM", "0.25"))
+
+
+def thread_budget():
+    """Hilos del worker que pueden ocupar, entre todos, las peticiones admitidas y en cola."""
+    return max(1, int(GUNICORN_THREADS * (1 - ADMISSION_HEADROOM)))
+
+
+class AdmissionController:
+    """Semáforo con cola acotada y estimación del tiempo de reintento."""
+
+    def __init__(self, name, max_concurrent, max_queue, queue_timeout):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiting = 0
+        # Media móvil del tiempo de servicio, para calcular Retry-After
+        self.avg_service_time = 30.0
+        self._cond = threading.Condition()
+
+    @classmethod
+    def from_env(cls, name, share, queue_timeout):
+        """
+        Controlador con límites por defecto sacados de su fracción (share) de thread_budget():
+        dos tercios en ejecución y uno en cola. Las variables ADMISSION_<NOMBRE>_* los reemplazan.
+        """
+        hilos = max(2, int(thread_budget() * share))
+        max_concurrent = max(1, hilos * 2 // 3)
+        prefijo = f"ADMISSION_{name.upper()}_"
+        return cls(
+            name,
+            int(os.getenv(prefijo + "CONCURRENCY", max_concurrent)),
+            int(os.getenv(prefijo + "QUEUE", hilos - max_concurrent)),
+            float(os.getenv(prefijo + "QUEUE_TIMEOUT", queue_timeout))
+        )
+
+    @property
+    def max_threads(self):
+        """Hilos que puede llegar a ocupar: en ejecución más en cola."""
+        return self.max_concurrent + self.max_queue
+
+    def acquire(self):
+        """Intenta admitir la petición. Devuelve True si fue admitida."""
+        inicio = time.monotonic()
+        with self._cond:
+            if self.active < self.max_concurrent:
+                self.active += 1
+                metrics.ADMISSION_QUEUE_WAIT.labels(self.name).observe(0)
+                return True
+
+            if self.waiting >= self.max_queue:
+                metrics.ADMISSION_REJECTED.labels(self.name, "queue_full").inc()
+                return False
+
+            self.waiting += 1
+            metrics.ADMISSION_QUEUE_DEPTH.labels(self.name).inc()
+            try:
+                limite = inicio + self.queue_timeout
+                while self.active >= self.max_concurrent:
+                    restante = limite - time.monotonic()
+                    if restante <= 0:
+                        metrics.ADMISSION_REJECTED.labels(self.name, "queue_timeout").inc()
+                        return False
+                    self._cond.wait(restante)
+                self.active += 1
+            finally:
+                self.waiting -= 1
+                metrics.ADMISSION_QUEUE_DEPTH.labels(self.name).dec()
+
+        metrics.ADMISSION_QUEUE_WAIT.labels(self.name).observe(time.monotonic() - inicio)
+        return True
+
+    def release(self, service_time=None):
+        with self._cond:
+            self.active -= 1
+            if service_time is not None:
+                self.avg_service_time = 0.8 * self.avg_service_time + 0.2 * service_time
+            self._cond.notify()
+
+    def retry_after(self):
+        """Segundos sugeridos antes de reintentar, según la cola y el tiempo medio de servicio."""
+        with self._cond:
+            estimado = self.avg_service_time * (self.waiting + 1) / max(self.max_concurrent, 1)
+        return max(1, min(int(math.ceil(estimado)), 300))
+
+
+def check_thread_budget(controllers):
+    """
+    Comprueba que ejecución más cola de los controladores quepa en thread_budget().
+    Devuelve un mensaje de error si no cabe, o None.
+    """
+    total = sum(controller.max_threads for controller in controllers)
+    if total <= thread_budget():
+        return None
+    detalle = ", ".join(f"{c.name}={c.max_concurrent}+{c.max_queue}" for c in controllers)
+    return (f"Los límites de admisión ({detalle}) ocupan hasta {total} hilos por worker, pero solo hay "
+            f"{thread_budget()} de {GUNICORN_THREADS} fuera de la reserva (ADMISSION_HEADROOM={ADMISSION_HEADROOM:g}): "
+            f"con carga mixta los hilos se agotan antes de que las colas rechacen con 429")
+
+
+def admission_control(controller):
+    """Decorador de vistas Flask: aplica el controlador y devuelve 429 si no hay capacidad."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not controller.acquire():
+                retry_after = controller.retry_after()
+                response = jsonify({
+                    "error": "El servidor está ocupado procesando otras solicitudes. Intenta de nuevo más tarde.",
+                    "retry_after": retry_after
+                })
+                response.status_code = 429
+                response.headers["Retry-After"] = str(retry_after)
+                return response
+
+            inicio = time.monotonic()
+            try:
+                response = current_app.make_response(view(*args, **kwargs))
+            except BaseException:
+                controller.release(time.monotonic() - inicio)
+                raise
+            if response.is_streamed:
+                response.call_on_close(lambda: controller.release(time.monotonic() - inicio))
+            else:
+                controller.release(time.monotonic() - inicio)
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,217 @@
+"""
+Benchmark de la extracción de texto de DOCX: python-docx frente a docx_stream.
+
+Genera documentos sintéticos de requerimientos (secciones "HISTORIA #n:" con
+párrafos y tablas intercaladas) de varios tamaños en páginas y mide tiempo,
+memoria pico de Python (tracemalloc) y memoria pico del proceso (RSS, incluye
+el árbol XML de lxml, que tracemalloc no ve). Cada medición de RSS se hace en
+un proceso nuevo para que no se contamine con las anteriores.
+
+También comprueba que el orden es el del documento: con python-docx todas las
+celdas quedan al final; con docx_stream cada tabla queda bajo su historia.
+
+Uso (desde Nexus-Web/):
+    python benchmarks/bench_docx.py --output bench_docx_report.json
+    python benchmarks/bench_docx.py --baseline bench_docx_baseline.json --max-time-regression 0.20
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import docx  # noqa: E402
+
+import docx_stream  # noqa: E402
+
+# bench_matrix (measure, compare_with_baseline) importa matrix_backend y sus dependencias:
+# se importa solo en el proceso principal para no inflar el RSS base de los procesos de medición
+DEFAULT_PAGES = [10, 100, 300]
+# Párrafos de requerimientos por página (aprox.) y cada cuántas historias hay una tabla
+_PARRAFOS_POR_PAGINA = 12
+_TABLA_CADA = 3
+
+_VERBOS = ["Verificar", "Validar", "Registrar", "Consultar", "Actualizar", "Exportar"]
+_OBJETOS = ["inicio de sesión", "recuperación de contraseña", "carga de archivo", "reporte mensual",
+            "perfil de usuario", "pago con tarjeta", "búsqueda avanzada", "permisos de rol"]
+
+
+def extract_with_python_docx(file_path):
+    """Extractor anterior de matrix_backend: todos los párrafos y luego todas las celdas."""
+    doc = docx.Document(file_path)
+    full_text = []
+    for para in doc.paragraphs:
+        if para.text.strip():
+            full_text.append(para.text)
+    for table in doc.tables:
+        for row in table.rows:
+            for cell in row.cells:
+                if cell.text.strip():
+                    full_text.append(cell.text)
+    return "\n".join(full_text)
+
+
+def generate_docx(path, pages, seed=0):
+    """DOCX sintético de ~`pages` páginas con historias, párrafos y tablas de criterios."""
+    rnd = random.Random(seed)
+    doc = docx.Document()
+    parrafos = 0
+    historia = 0
+    while parrafos < pages * _PARRAFOS_POR_PAGINA:
+        historia += 1
+        doc.add_paragraph(f"HISTORIA #{historia}: {rnd.choice(_VERBOS)} {rnd.choice(_OBJETOS)}")
+        for _ in range(rnd.randint(4, 10)):
+            doc.add_paragraph(f"El sistema debe {rnd.choice(_VERBOS).lower()} el {rnd.choice(_OBJETOS)} "
+                              f"y mostrar un mensaje claro al usuario. " * rnd.randint(1, 3))
+            parrafos += 1
+        if historia % _TABLA_CADA == 0:
+            tabla = doc.add_table(rows=4, cols=3)
+            for i, fila in enumerate(tabla.rows):
+                for j, celda in enumerate(fila.cells):
+                    celda.text = f"Criterio H{historia}-{i}.{j}: {rnd.choice(_OBJETOS)}"
+    doc.save(path)
+    return historia
+
+
+def check_order(text):
+    """True si cada celda "Criterio Hn-..." aparece después de "HISTORIA #n:" y antes de la siguiente."""
+    historia = 0
+    for linea in text.split("\n"):
+        if linea.startswith("HISTORIA #"):
+            historia = int(linea.split("#", 1)[1].split(":", 1)[0])
+        elif linea.startswith("Criterio H"):
+            if int(linea[len("Criterio H"):].split("-", 1)[0]) != historia:
+                return False
+    return True
+
+
+def _proc_status_kib(field):
+    """Valor en KiB de un campo de /proc/self/status (VmRSS, VmHWM), o None fuera de Linux."""
+    try:
+        with open("/proc/self/status") as f:
+            for linea in f:
+                if linea.startswith(field + ":"):
+                    return int(linea.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _rss_child(extractor_name, path, conn):
+    extractor = EXTRACTORS[extractor_name]
+    # ru_maxrss/VmHWM se heredan del proceso padre a través de exec: en Linux se reinicia el pico
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        base = _proc_status_kib("VmRSS")
+    except OSError:
+        base = None
+    if base is None:
+        base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        extractor(path)
+        delta = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base
+        # ru_maxrss está en KiB en Linux y en bytes en macOS
+        conn.send(delta if sys.platform != "darwin" else round(delta / 1024, 1))
+    else:
+        extractor(path)
+        conn.send(_proc_status_kib("VmHWM") - base)
+    conn.close()
+
+
+def peak_rss_kib(extractor_name, path):
+    """Crecimiento del RSS pico durante una extracción, medido en un proceso nuevo."""
+    contexto = multiprocessing.get_context("spawn")
+    padre, hijo = contexto.Pipe(duplex=False)
+    proceso = contexto.Process(target=_rss_child, args=(extractor_name, path, hijo))
+    proceso.start()
+    delta = padre.recv()
+    proceso.join()
+    return delta
+
+
+EXTRACTORS = {
+    "python_docx": extract_with_python_docx,
+    "docx_stream": docx_stream.extract_docx_text,
+}
+
+
+def run_benchmarks(pages_list, repeats, workdir):
+    from bench_matrix import measure
+
+    results = []
+    for pages in pages_list:
+        path = os.path.join(workdir, f"bench_{pages}p.docx")
+        historias = generate_docx(path, pages)
+        print(f"  documento de {pages} páginas ({historias} historias, {os.path.getsize(path) // 1024} KiB)")
+        for nombre, extractor in EXTRACTORS.items():
+            print(f"  {nombre} (pages={pages})...", flush=True)
+            resultado = {"name": f"extract_{nombre}", "size": pages, **measure(extractor, lambda: (path,), repeats)}
+            resultado["peak_rss_kib"] = peak_rss_kib(nombre, path)
+            resultado["body_order"] = check_order(extractor(path))
+            results.append(resultado)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark de extracción de texto DOCX.")
+    parser.add_argument("--pages", type=int, nargs="+", default=DEFAULT_PAGES,
+                        help="Tamaños de documento en páginas (por defecto: 10 100 300)")
+    parser.add_argument("--repeats", type=int, default=3, help="Repeticiones por medición de tiempo")
+    parser.add_argument("--output", default="bench_docx_report.json", help="Ruta del reporte JSON")
+    parser.add_argument("--baseline", help="Reporte base contra el cual comparar")
+    parser.add_argument("--max-time-regression", type=float, default=0.20,
+                        help="Regresión de tiempo tolerada (0.20 = 20%%)")
+    parser.add_argument("--max-memory-regression", type=float, default=0.20,
+                        help="Regresión de memoria pico tolerada (0.20 = 20%%)")
+    parser.add_argument("--min-time", type=float, default=0.005,
+                        help="Tiempos base menores a este valor (s) no se comparan")
+    args = parser.parse_args(argv)
+
+    print("Ejecutando benchmarks de extracción DOCX...")
+    with tempfile.TemporaryDirectory() as workdir:
+        results = run_benchmarks(args.pages, args.repeats, workdir)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeats": args.repeats
+        },
+        "results": results
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Reporte guardado en {args.output}")
+
+    for r in results:
+        print(f"{r['name']:<22} pages={r['size']:<5} {r['time_s'] * 1000:10.1f} ms {r['peak_kib']:12.1f} KiB "
+              f"{r['peak_rss_kib']:10.0f} KiB RSS  orden={'sí' if r['body_order'] else 'no'}")
+
+    if args.baseline:
+        from bench_matrix import compare_with_baseline
+
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regresiones = compare_with_baseline(results, baseline, args.max_time_regression,
+                                            args.max_memory_regression, args.min_time)
+        if regresiones:
+            print("\nRegresiones detectadas:")
+            for r in regresiones:
+                print(f"  - {r}")
+            return 1
+        print("\nSin regresiones respecto al baseline.")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
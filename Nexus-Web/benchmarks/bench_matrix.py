@@ -0,0 +1,258 @@
+"""
+Benchmark de CPU y memoria del pipeline de post-procesamiento de matrices.
+
+Mide split_document_into_chunks, clean_json_response, deduplicate_cases,
+normalize_matrix_data y los exportadores CSV/JSON/XLSX sobre datos sintéticos
+(sin llamadas al LLM) y genera un reporte JSON.
+
+Uso (desde Nexus-Web/):
+    python benchmarks/bench_matrix.py --output bench_report.json
+    python benchmarks/bench_matrix.py --baseline bench_baseline.json --max-time-regression 0.20
+
+Con --baseline el proceso termina con código 1 si alguna medición empeora más
+allá de los umbrales configurados.
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import matrix_backend  # noqa: E402
+
+DEFAULT_SIZES = [100, 1000, 10000]
+DEFAULT_DOC_SIZES_KB = [10, 100, 1000]
+
+_VERBOS = ["Verificar", "Validar", "Comprobar", "Registrar", "Consultar", "Actualizar", "Eliminar", "Exportar"]
+_OBJETOS = ["inicio de sesión", "recuperación de contraseña", "carga de archivo", "campo de correo",
+            "reporte mensual", "perfil de usuario", "carrito de compras", "pago con tarjeta",
+            "notificación por correo", "búsqueda avanzada", "filtro por fecha", "permisos de rol"]
+_CONDICIONES = ["con datos válidos", "con datos inválidos", "sin conexión", "con sesión expirada",
+                "con el campo vacío", "con valores límite", "con 1000 usuarios concurrentes",
+                "desde un dispositivo móvil"]
+_CATEGORIAS = {
+    "Funcional": ["Flujo Principal", "Flujos Alternativos", "Casos Límite", "Casos de Error"],
+    "No Funcional": ["Rendimiento", "Seguridad", "Usabilidad", "Compatibilidad", "Confiabilidad"]
+}
+
+
+# ----------------------------
+# Generadores sintéticos
+# ----------------------------
+def generate_requirements_document(size_kb, seed=0):
+    """Genera un documento de requerimientos con secciones 'HISTORIA #n:' de ~size_kb KB."""
+    rnd = random.Random(seed)
+    objetivo = size_kb * 1024
+    partes = []
+    total = 0
+    historia = 0
+    while total < objetivo:
+        historia += 1
+        bloque = [f"HISTORIA #{historia}: {rnd.choice(_VERBOS)} {rnd.choice(_OBJETOS)}"]
+        for _ in range(rnd.randint(4, 12)):
+            frase = (f"El sistema debe {rnd.choice(_VERBOS).lower()} el {rnd.choice(_OBJETOS)} "
+                     f"{rnd.choice(_CONDICIONES)} y mostrar un mensaje claro al usuario.")
+            bloque.append(" ".join([frase] * rnd.randint(1, 3)))
+        texto = "\n".join(bloque) + "\n\n"
+        partes.append(texto)
+        total += len(texto)
+    return "".join(partes)
+
+
+def generate_raw_cases(n, seed=0, duplicate_ratio=0.2):
+    """
+    Genera n casos tal como los devuelve el modelo: algunos con Pasos/Resultado_esperado
+    como string numerado, campos faltantes y una fracción de casi-duplicados.
+    """
+    rnd = random.Random(seed)
+    cases = []
+    for i in range(n):
+        if cases and rnd.random() < duplicate_ratio:
+            base = dict(rnd.choice(cases))
+            base["titulo_caso_prueba"] = base["titulo_caso_prueba"] + " correctamente"
+            cases.append(base)
+            continue
+
+        tipo = rnd.choice(list(_CATEGORIAS))
+        pasos = [f"{rnd.choice(_VERBOS)} el {rnd.choice(_OBJETOS)} {rnd.choice(_CONDICIONES)}"
+                 for _ in range(rnd.randint(3, 8))]
+        resultados = [f"El sistema muestra el {rnd.choice(_OBJETOS)} actualizado"
+                      for _ in range(rnd.randint(1, 4))]
+        case = {
+            "titulo_caso_prueba": f"{rnd.choice(_VERBOS)} {rnd.choice(_OBJETOS)} {rnd.choice(_CONDICIONES)} #{i}",
+            "Descripcion": " ".join(pasos),
+            "Precondiciones": "Usuario registrado en el sistema",
+            "Tipo_de_prueba": tipo,
+            "Nivel_de_prueba": "UAT",
+            "Tipo_de_ejecucion": "Manual",
+            "Pasos": "\n".join(f"{j}. {p}" for j, p in enumerate(pasos, 1)) if rnd.random() < 0.3 else pasos,
+            "Resultado_esperado": ". ".join(resultados) if rnd.random() < 0.3 else resultados,
+            "Categoria": rnd.choice(_CATEGORIAS[tipo]),
+            "Prioridad": rnd.choice(["Alta", "Media", "Baja"]),
+            "historia_de_usuario": f"HISTORIA #{rnd.randint(1, 40)}: {rnd.choice(_OBJETOS)}"
+        }
+        if rnd.random() < 0.2:
+            del case["Precondiciones"]
+        cases.append(case)
+    return cases
+
+
+def generate_model_response(cases):
+    """Envuelve casos en una respuesta típica del modelo (markdown + texto extra)."""
+    return "Aquí están los casos de prueba:\n```json\n" + json.dumps(cases, ensure_ascii=False, indent=2) + "\n```\n"
+
+
+# ----------------------------
+# Medición
+# ----------------------------
+def measure(func, make_args, repeats):
+    """Ejecuta func(*make_args()) `repeats` veces midiendo tiempo y una vez más con tracemalloc."""
+    tiempos = []
+    for _ in range(repeats):
+        args = make_args()
+        gc.collect()
+        inicio = time.perf_counter()
+        func(*args)
+        tiempos.append(time.perf_counter() - inicio)
+
+    args = make_args()
+    gc.collect()
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "time_s": statistics.median(tiempos),
+        "time_min_s": min(tiempos),
+        "peak_kib": round(peak / 1024, 1)
+    }
+
+
+def consume(exporter):
+    """Envuelve un exportador generador para recorrer sus bloques sin acumularlos."""
+    def run(data):
+        return sum(len(chunk) for chunk in exporter(data))
+    return run
+
+
+def run_benchmarks(sizes, doc_sizes_kb, repeats, dedup_limit, include_xlsx=True):
+    """Ejecuta todos los benchmarks y devuelve la lista de resultados."""
+    results = []
+
+    def add(name, size, func, make_args):
+        print(f"  {name} (n={size})...", flush=True)
+        results.append({"name": name, "size": size, **measure(func, make_args, repeats)})
+
+    for size_kb in doc_sizes_kb:
+        documento = generate_requirements_document(size_kb)
+        add("split_document_into_chunks", size_kb, matrix_backend.split_document_into_chunks,
+            lambda: (documento,))
+
+    for n in sizes:
+        raw = generate_raw_cases(n)
+        respuesta = generate_model_response(raw)
+        normalizados = matrix_backend.normalize_matrix_data([dict(c) for c in raw])
+
+        add("clean_json_response", n, matrix_backend.clean_json_response, lambda: (respuesta,))
+        if n <= dedup_limit:
+            add("deduplicate_cases", n, matrix_backend.deduplicate_cases,
+                lambda: (matrix_backend.normalize_matrix_data(raw),))
+        else:
+            print(f"  deduplicate_cases (n={n}) omitido: supera --dedup-limit={dedup_limit}")
+        add("normalize_matrix_data", n, matrix_backend.normalize_matrix_data, lambda: (raw,))
+        add("save_to_csv_buffer", n, matrix_backend.save_to_csv_buffer, lambda: (normalizados,))
+        add("save_to_json_buffer", n, matrix_backend.save_to_json_buffer, lambda: (normalizados,))
+        # Exportadores en streaming: se consumen bloque a bloque como haría la respuesta HTTP
+        for exportador in (matrix_backend.iter_csv, matrix_backend.iter_json_array, matrix_backend.iter_ndjson):
+            add(exportador.__name__, n, consume(exportador), lambda: (normalizados,))
+        if include_xlsx:
+            add("save_to_xlsx_buffer", n, matrix_backend.save_to_xlsx_buffer, lambda: (normalizados,))
+
+    return results
+
+
+def compare_with_baseline(results, baseline, max_time_regression, max_memory_regression, min_time_s):
+    """Compara contra un reporte base. Devuelve la lista de regresiones encontradas."""
+    base_index = {(r["name"], r["size"]): r for r in baseline.get("results", [])}
+    regresiones = []
+
+    for r in results:
+        base = base_index.get((r["name"], r["size"]))
+        if not base:
+            continue
+
+        # Tiempos muy pequeños son ruido: solo se comparan por encima de min_time_s
+        if base["time_s"] >= min_time_s and r["time_s"] > base["time_s"] * (1 + max_time_regression):
+            regresiones.append(f"{r['name']} (n={r['size']}): tiempo {base['time_s']:.4f}s -> {r['time_s']:.4f}s")
+        if base["peak_kib"] > 0 and r["peak_kib"] > base["peak_kib"] * (1 + max_memory_regression):
+            regresiones.append(f"{r['name']} (n={r['size']}): memoria {base['peak_kib']}KiB -> {r['peak_kib']}KiB")
+
+    return regresiones
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark del pipeline de post-procesamiento de matrices.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES,
+                        help="Número de casos de prueba sintéticos (por defecto: 100 1000 10000)")
+    parser.add_argument("--doc-sizes-kb", type=int, nargs="+", default=DEFAULT_DOC_SIZES_KB,
+                        help="Tamaños de documento en KB para split_document_into_chunks")
+    parser.add_argument("--repeats", type=int, default=3, help="Repeticiones por medición de tiempo")
+    parser.add_argument("--dedup-limit", type=int, default=1000,
+                        help="Tamaño máximo para deduplicate_cases (es O(n²))")
+    parser.add_argument("--no-xlsx", action="store_true", help="Omitir save_to_xlsx_buffer")
+    parser.add_argument("--output", default="bench_report.json", help="Ruta del reporte JSON")
+    parser.add_argument("--baseline", help="Reporte base contra el cual comparar")
+    parser.add_argument("--max-time-regression", type=float, default=0.20,
+                        help="Regresión de tiempo tolerada (0.20 = 20%%)")
+    parser.add_argument("--max-memory-regression", type=float, default=0.20,
+                        help="Regresión de memoria pico tolerada (0.20 = 20%%)")
+    parser.add_argument("--min-time", type=float, default=0.005,
+                        help="Tiempos base menores a este valor (s) no se comparan")
+    args = parser.parse_args(argv)
+
+    print("Ejecutando benchmarks del pipeline de matrices...")
+    results = run_benchmarks(args.sizes, args.doc_sizes_kb, args.repeats, args.dedup_limit,
+                             include_xlsx=not args.no_xlsx)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeats": args.repeats
+        },
+        "results": results
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Reporte guardado en {args.output}")
+
+    for r in results:
+        print(f"{r['name']:<28} n={r['size']:<6} {r['time_s'] * 1000:10.2f} ms {r['peak_kib']:12.1f} KiB")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regresiones = compare_with_baseline(results, baseline, args.max_time_regression,
+                                            args.max_memory_regression, args.min_time)
+        if regresiones:
+            print("\nRegresiones detectadas:")
+            for r in regresiones:
+                print(f"  - {r}")
+            return 1
+        print("\nSin regresiones respecto al baseline.")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
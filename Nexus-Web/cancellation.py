@@ -0,0 +1,150 @@
+"""
+Cancelación cooperativa de generaciones en curso.
+
+El navegador envía un job_id con cada generación y, si el usuario cierra la
+página, llama a POST /api/jobs/<job_id>/cancel (navigator.sendBeacon). La
+petición de cancelación puede llegar a otro worker de gunicorn, así que se
+marca con un archivo en CANCEL_DIR; el token del trabajo consulta su propia
+bandera y ese archivo.
+
+El token de la petición actual viaja en un contextvar (igual que la prioridad
+de llm_scheduler), de modo que llm_client y los bucles de fragmentos/lotes lo
+consultan sin cambiar las firmas de los backends. Las llamadas al LLM en cola
+o en vuelo se abortan al detectar la cancelación.
+"""
+import asyncio
+import contextvars
+import os
+import re
+import tempfile
+import time
+
+import metrics
+
+CANCEL_DIR = os.getenv("CANCEL_DIR", os.path.join(tempfile.gettempdir(), "nexus_cancel"))
+# Cada cuánto revisan el token las llamadas al LLM en espera o en vuelo (segundos)
+CANCEL_POLL_INTERVAL = float(os.getenv("CANCEL_POLL_INTERVAL", "0.5"))
+# Marcas de trabajos que ya terminaron (o que nunca empezaron en este host)
+CANCEL_MARKER_TTL = float(os.getenv("CANCEL_MARKER_TTL", "3600"))
+
+_JOB_ID_RE = re.compile(r"^[A-Za-z0-9_-]{8,64}$")
+
+_current_token = contextvars.ContextVar("cancel_token", default=None)
+
+
+class JobCancelled(Exception):
+    """El trabajo fue cancelado por el cliente."""
+
+
+def valid_job_id(job_id):
+    return bool(job_id) and bool(_JOB_ID_RE.match(job_id))
+
+
+def _marker_path(job_id):
+    return os.path.join(CANCEL_DIR, job_id)
+
+
+class CancelToken:
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self._cancelled = False
+
+    @property
+    def cancelled(self):
+        if not self._cancelled and os.path.exists(_marker_path(self.job_id)):
+            self._cancelled = True
+        return self._cancelled
+
+    def check(self, stage=None):
+        """Lanza JobCancelled si el trabajo fue cancelado; `stage` cuenta la llamada al LLM evitada."""
+        if self.cancelled:
+            if stage:
+                metrics.LLM_CALLS_CANCELLED.labels(stage).inc()
+            raise JobCancelled(f"Trabajo {self.job_id} cancelado por el cliente")
+
+
+def current_token():
+    return _current_token.get()
+
+
+def check(stage=None):
+    """Comprueba el token de la petición actual (no hace nada si no hay token)."""
+    token = _current_token.get()
+    if token is not None:
+        token.check(stage)
+
+
+def bind(job_id):
+    """
+    Asocia un token al contexto actual si job_id es válido.
+    Devuelve el token del contextvar para release(), o None si no se asoció nada.
+    """
+    if not valid_job_id(job_id):
+        return None
+    return _current_token.set(CancelToken(job_id))
+
+
+def release(context_token):
+    """Desasocia el token y borra su marca de cancelación, si la hay."""
+    token = _current_token.get()
+    _current_token.reset(context_token)
+    if token is not None:
+        try:
+            os.remove(_marker_path(token.job_id))
+        except OSError:
+            pass
+
+
+def request_cancel(job_id):
+    """Marca el trabajo como cancelado (visible desde cualquier worker del host)."""
+    if not valid_job_id(job_id):
+        return False
+    os.makedirs(CANCEL_DIR, exist_ok=True)
+    _cleanup_expired()
+    with open(_marker_path(job_id), "w") as f:
+        f.write(str(time.time()))
+    return True
+
+
+def _cleanup_expired():
+    """Borra marcas antiguas de trabajos que ya no existen (se llama de forma oportunista)."""
+    ahora = time.time()
+    try:
+        nombres = os.listdir(CANCEL_DIR)
+    except OSError:
+        return
+    for nombre in nombres:
+        ruta = os.path.join(CANCEL_DIR, nombre)
+        try:
+            if ahora - os.path.getmtime(ruta) > CANCEL_MARKER_TTL:
+                os.remove(ruta)
+        except OSError:
+            pass
+
+
+async def run_cancellable(coro, stage):
+    """
+    Espera la corrutina revisando periódicamente el token de la petición actual.
+    Si el trabajo se cancela, cancela la corrutina (llamada en cola o en vuelo)
+    y lanza JobCancelled.
+    """
+    token = _current_token.get()
+    if token is None:
+        return await coro
+    try:
+        token.check(stage)
+    except JobCancelled:
+        coro.close()
+        raise
+    tarea = asyncio.ensure_future(coro)
+    while True:
+        hechas, _ = await asyncio.wait({tarea}, timeout=CANCEL_POLL_INTERVAL)
+        if hechas:
+            return tarea.result()
+        if token.cancelled:
+            tarea.cancel()
+            try:
+                await tarea
+            except (asyncio.CancelledError, Exception):
+                pass
+            token.check(stage)
@@ -0,0 +1,290 @@
+"""
+Biblioteca persistente de casos de prueba reutilizables entre trabajos.
+
+Cada requerimiento (oración) para el que el LLM generó casos se guarda junto
+con esos casos ya normalizados. Antes de pedir un fragmento al LLM, sus
+requerimientos se buscan en un índice local de similitud (TF-IDF, índice
+invertido con NumPy): los que tienen una coincidencia por encima de
+CASE_LIBRARY_THRESHOLD reutilizan los casos guardados y al LLM solo se le
+pide la parte nueva del fragmento. Si todo el fragmento está en la
+biblioteca, no se hace la llamada.
+
+La biblioteca se separa por perfil (tipos de prueba solicitados): los casos
+generados solo como funcionales no se reutilizan en una matriz no funcional.
+No se separa por cliente ni por proyecto: cualquier trabajo del host reutiliza
+casos generados para otros, así que está desactivada salvo que se active con
+CASE_LIBRARY_ENABLED=1 (por ejemplo, en una instalación de un solo equipo).
+
+El índice de cada perfil se construye una vez por proceso. Cuando la tabla
+cambia, las peticiones siguen usando el índice anterior mientras uno nuevo se
+construye en segundo plano (como mucho uno cada CASE_LIBRARY_REFRESH_SECONDS)
+y se intercambia al terminar: la generación nunca espera una reconstrucción,
+salvo la primera carga del perfil. Los casos se guardan en el índice como
+JSON y solo se decodifican los que se reutilizan.
+
+Configuración:
+    CASE_LIBRARY_ENABLED       "1" activa la reutilización (por defecto desactivada)
+    CASE_LIBRARY_DB            ruta del archivo SQLite (compartido entre workers del host)
+    CASE_LIBRARY_THRESHOLD     similitud mínima para reutilizar un requerimiento
+    CASE_LIBRARY_MAX_ENTRIES   requerimientos más recientes que se cargan en el índice
+    CASE_LIBRARY_REFRESH_SECONDS  intervalo mínimo entre reconstrucciones del índice de un perfil
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import coverage_gaps
+import metrics
+from case_model import TestCase
+
+CASE_LIBRARY_ENABLED = os.getenv("CASE_LIBRARY_ENABLED", "0") == "1"
+CASE_LIBRARY_DB = os.getenv("CASE_LIBRARY_DB", os.path.join(tempfile.gettempdir(), "nexus_case_library.sqlite"))
+CASE_LIBRARY_THRESHOLD = float(os.getenv("CASE_LIBRARY_THRESHOLD", "0.85"))
+CASE_LIBRARY_MAX_ENTRIES = int(os.getenv("CASE_LIBRARY_MAX_ENTRIES", "50000"))
+CASE_LIBRARY_REFRESH_SECONDS = float(os.getenv("CASE_LIBRARY_REFRESH_SECONDS", "30"))
+
+# Campos que dependen del trabajo y no se guardan con el caso
+_CAMPOS_DEL_TRABAJO = ("id_caso_prueba", "historia_de_usuario")
+
+# Índices ya construidos por perfil: (versión de la tabla, índice, momento de la construcción)
+_indices = {}
+# Protege solo el diccionario y los conjuntos; las construcciones se hacen fuera
+_indices_lock = threading.Lock()
+# Perfiles con una reconstrucción en curso en este proceso
+_rebuilding = set()
+# Un candado por perfil para que la primera carga no se construya dos veces
+_build_locks = {}
+
+_executor = None
+_executor_pid = None
+
+
+def _connect():
+    conn = sqlite3.connect(CASE_LIBRARY_DB, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS requirements ("
+        "id INTEGER PRIMARY KEY, profile TEXT NOT NULL, fingerprint TEXT NOT NULL, "
+        "requirement TEXT NOT NULL, cases TEXT NOT NULL, created REAL NOT NULL, "
+        "UNIQUE (profile, fingerprint))"
+    )
+    return conn
+
+
+def profile_key(tipos_prueba):
+    return ",".join(sorted(set(tipos_prueba)))
+
+
+def _fingerprint(tokens):
+    return hashlib.sha256(" ".join(tokens).encode("utf-8")).hexdigest()
+
+
+class LibraryIndex:
+    """Índice invertido TF-IDF de los requerimientos de un perfil."""
+
+    def __init__(self, tokens_list, cases_list):
+        # JSON de los casos de cada requerimiento (se decodifica al reutilizarlo)
+        self.cases = cases_list
+        self.size = len(tokens_list)
+        df = {}
+        for tokens in tokens_list:
+            for token in set(tokens):
+                df[token] = df.get(token, 0) + 1
+        self.idf = {token: float(np.log((1 + self.size) / (1 + n)) + 1) for token, n in df.items()}
+        # Peso por defecto de términos que no están en la biblioteca (cuentan en la norma de la consulta)
+        self.idf_nuevo = float(np.log(1 + self.size) + 1)
+
+        filas = {}
+        for fila, tokens in enumerate(tokens_list):
+            pesos = self._pesos(tokens)
+            for token, peso in pesos.items():
+                filas.setdefault(token, ([], []))
+                filas[token][0].append(fila)
+                filas[token][1].append(peso)
+        self.postings = {token: (np.asarray(f, dtype=np.int32), np.asarray(p, dtype=np.float32))
+                         for token, (f, p) in filas.items()}
+
+    def _pesos(self, tokens):
+        """Pesos TF-IDF (TF sublineal, norma L2) de una lista de tokens."""
+        conteo = {}
+        for token in tokens:
+            conteo[token] = conteo.get(token, 0) + 1
+        pesos = {token: np.log1p(n) * self.idf.get(token, self.idf_nuevo) for token, n in conteo.items()}
+        norma = np.sqrt(sum(p * p for p in pesos.values())) or 1.0
+        return {token: p / norma for token, p in pesos.items()}
+
+    def search(self, tokens):
+        """Devuelve (fila, similitud) del requerimiento más parecido, o (-1, 0.0)."""
+        if not self.size or not tokens:
+            return -1, 0.0
+        puntajes = np.zeros(self.size, dtype=np.float32)
+        for token, peso in self._pesos(tokens).items():
+            posting = self.postings.get(token)
+            if posting is not None:
+                puntajes[posting[0]] += peso * posting[1]
+        fila = int(puntajes.argmax())
+        return fila, float(puntajes[fila])
+
+
+class Match:
+    """Resultado de buscar los requerimientos de un fragmento en la biblioteca."""
+    __slots__ = ("cases", "pending", "covered", "reused", "total")
+
+    def __init__(self, cases, pending, covered, total):
+        self.cases = cases
+        self.pending = pending
+        # Oraciones del fragmento cuyos casos salen de la biblioteca
+        self.covered = covered
+        self.reused = len(covered)
+        self.total = total
+
+
+def _get_executor():
+    """Hilo de reconstrucción del proceso, creado de nuevo tras un fork."""
+    global _executor, _executor_pid
+    with _indices_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="case-library")
+            _executor_pid = os.getpid()
+            _rebuilding.clear()
+        return _executor
+
+
+def _version(conn, profile):
+    return conn.execute("SELECT COUNT(*), MAX(id) FROM requirements WHERE profile = ?", (profile,)).fetchone()
+
+
+def _build(profile):
+    """Lee la tabla y construye el índice del perfil (sin candados globales)."""
+    conn = _connect()
+    try:
+        # Versión y filas en la misma transacción de lectura
+        conn.execute("BEGIN")
+        version = _version(conn, profile)
+        filas = conn.execute(
+            "SELECT requirement, cases FROM requirements WHERE profile = ? ORDER BY id DESC LIMIT ?",
+            (profile, CASE_LIBRARY_MAX_ENTRIES)
+        ).fetchall()
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+    indice = LibraryIndex([coverage_gaps.tokenize(requisito) for requisito, _ in filas],
+                          [casos for _, casos in filas])
+    with _indices_lock:
+        _indices[profile] = (version, indice, time.monotonic())
+    return indice
+
+
+def _rebuild_quietly(profile):
+    try:
+        _build(profile)
+    except Exception as e:
+        print(f"Error reconstruyendo el índice de la biblioteca de casos ({profile}): {e}")
+    finally:
+        with _indices_lock:
+            _rebuilding.discard(profile)
+
+
+def load_index(profile):
+    """
+    Índice del perfil. Si la biblioteca cambió desde la última construcción se devuelve
+    el índice actual y se programa una reconstrucción en segundo plano.
+    """
+    with _indices_lock:
+        guardado = _indices.get(profile)
+    if guardado is None:
+        with _indices_lock:
+            candado = _build_locks.setdefault(profile, threading.Lock())
+        with candado:
+            with _indices_lock:
+                guardado = _indices.get(profile)
+            if guardado is None:
+                return _build(profile)
+
+    version, indice, construido = guardado
+    if time.monotonic() - construido < CASE_LIBRARY_REFRESH_SECONDS:
+        return indice
+    conn = _connect()
+    try:
+        actual = _version(conn, profile)
+    finally:
+        conn.close()
+    if actual != version:
+        executor = _get_executor()
+        with _indices_lock:
+            if profile in _rebuilding:
+                return indice
+            _rebuilding.add(profile)
+        executor.submit(_rebuild_quietly, profile)
+    return indice
+
+
+def match(indice, chunk, threshold=None):
+    """
+    Separa los requerimientos del fragmento en reutilizados (casos de la biblioteca)
+    y pendientes (hay que pedirlos al LLM).
+    """
+    threshold = CASE_LIBRARY_THRESHOLD if threshold is None else threshold
+    casos = []
+    pendientes = []
+    cubiertos = []
+    filas_usadas = set()
+    requisitos = coverage_gaps.split_requirements(chunk)
+    for _, oracion in requisitos:
+        fila, similitud = indice.search(coverage_gaps.tokenize(oracion))
+        reutilizado = fila >= 0 and similitud >= threshold
+        metrics.record_cache("case_library", reutilizado)
+        if reutilizado:
+            cubiertos.append(oracion)
+            # Requerimientos repetidos en el fragmento no duplican los casos
+            if fila not in filas_usadas:
+                filas_usadas.add(fila)
+                casos.extend(json.loads(indice.cases[fila]))
+        else:
+            pendientes.append(oracion)
+    return Match(casos, pendientes, cubiertos, len(requisitos))
+
+
+def store(profile, requirements, cases):
+    """
+    Guarda los casos generados para unos requerimientos. Cada caso se asigna al
+    requerimiento más parecido; los requerimientos sin casos no se guardan.
+    """
+    if not requirements or not cases:
+        return
+    normalizados = []
+    for case in cases:
+        datos = TestCase.from_raw(case).to_dict()
+        for campo in _CAMPOS_DEL_TRABAJO:
+            datos.pop(campo)
+        normalizados.append(datos)
+
+    tokens_requisitos = [coverage_gaps.tokenize(requisito) for requisito in requirements]
+    if len(requirements) == 1:
+        asignados = {0: normalizados}
+    else:
+        asignados = {}
+        indices, _ = coverage_gaps.best_matches([coverage_gaps.tokenize(coverage_gaps.case_text(case))
+                                                 for case in normalizados], tokens_requisitos)
+        for case, indice in zip(normalizados, indices):
+            asignados.setdefault(max(int(indice), 0), []).append(case)
+
+    ahora = time.time()
+    conn = _connect()
+    try:
+        conn.executemany(
+            "INSERT OR REPLACE INTO requirements (profile, fingerprint, requirement, cases, created) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [(profile, _fingerprint(tokens_requisitos[i]), requirements[i],
+              json.dumps(casos, ensure_ascii=False), ahora)
+             for i, casos in asignados.items() if tokens_requisitos[i]]
+        )
+    finally:
+        conn.close()
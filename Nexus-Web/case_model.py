@@ -0,0 +1,143 @@
+"""
+Modelo compacto de un caso de prueba para el pipeline de matrices.
+
+Los casos llegan del LLM como diccionarios libres. Se convierten una sola vez
+a TestCase (con __slots__, sin diccionario por instancia): en esa conversión
+se normalizan Pasos y Resultado_esperado con expresiones regulares
+precompiladas y se rellenan los campos por defecto. Deduplicación,
+asignación de IDs y exportadores trabajan directamente sobre estos objetos.
+"""
+import re
+
+# Columnas de la matriz en el orden de exportación (CSV, XLSX, JSON)
+FIELDNAMES = (
+    "id_caso_prueba",
+    "titulo_caso_prueba",
+    "Descripcion",
+    "Precondiciones",
+    "Tipo_de_prueba",
+    "Nivel_de_prueba",
+    "Tipo_de_ejecucion",
+    "Pasos",
+    "Resultado_esperado",
+    "Categoria",
+    "Ambiente",
+    "Ciclo",
+    "issuetype",
+    "Prioridad",
+    "historia_de_usuario"
+)
+
+LIST_FIELDS = ("Pasos", "Resultado_esperado")
+
+# Valores por defecto de los campos de texto obligatorios
+TEXT_DEFAULTS = {
+    "titulo_caso_prueba": "Título por definir",
+    "Descripcion": "Descripción por definir",
+    "Precondiciones": "Precondiciones por definir",
+    "Tipo_de_prueba": "Funcional",
+    "Nivel_de_prueba": "UAT",
+    "Tipo_de_ejecucion": "Manual",
+    "Categoria": "Flujo Principal",
+    "Ambiente": "QA",
+    "Ciclo": "Ciclo 1",
+    "issuetype": "Test Case",
+    "Prioridad": "Media",
+    "historia_de_usuario": "Historia de usuario general"
+}
+
+DEFAULT_STEP = "Paso por definir"
+DEFAULT_RESULT = "Resultado por definir"
+
+# Separador de elementos de lista en CSV/XLSX
+LIST_SEPARATOR = " | "
+
+_NUMERACION = re.compile(r"^\d+[\.\)]\s*")
+_SEPARADOR_RESULTADOS = re.compile(r"[\.\n]|\d+[\.\)]\s*")
+
+
+def _normalize_steps(pasos):
+    """Pasos como lista de textos sin numeración."""
+    if isinstance(pasos, str):
+        pasos = pasos.split("\n")
+    elif not isinstance(pasos, list):
+        return [DEFAULT_STEP]
+    steps = []
+    for step in pasos:
+        if isinstance(step, str):
+            step = _NUMERACION.sub("", step.strip())
+            if step:
+                steps.append(step)
+        elif step:
+            steps.append(str(step))
+    return steps or [DEFAULT_STEP]
+
+
+def _normalize_results(resultados):
+    """Resultados esperados como lista de frases terminadas en punto."""
+    if isinstance(resultados, str):
+        resultados = _SEPARADOR_RESULTADOS.split(resultados)
+    elif not isinstance(resultados, list):
+        return [DEFAULT_RESULT]
+    results = []
+    for result in resultados:
+        if not result:
+            continue
+        result = result.strip() if isinstance(result, str) else str(result).strip()
+        if result:
+            results.append(result if result.endswith(".") else result + ".")
+    return results or [DEFAULT_RESULT]
+
+
+class TestCase:
+    """Caso de prueba normalizado. Admite case['campo'] y case.get() por compatibilidad."""
+    __slots__ = FIELDNAMES
+
+    def __init__(self, **campos):
+        for field in FIELDNAMES:
+            setattr(self, field, campos.get(field, ""))
+
+    @classmethod
+    def from_raw(cls, raw, historia=None):
+        """Normaliza un caso tal como lo devuelve el modelo (única pasada de limpieza)."""
+        case = cls.__new__(cls)
+        case.id_caso_prueba = raw.get("id_caso_prueba") or ""
+        for field, default_value in TEXT_DEFAULTS.items():
+            value = raw.get(field)
+            setattr(case, field, value if value else default_value)
+        if historia:
+            case.historia_de_usuario = historia
+        case.Pasos = _normalize_steps(raw.get("Pasos"))
+        case.Resultado_esperado = _normalize_results(raw.get("Resultado_esperado"))
+        return case
+
+    @classmethod
+    def from_dict(cls, data):
+        """Reconstruye un caso ya normalizado (por ejemplo, leído de JSON) sin volver a limpiarlo."""
+        return cls(**data)
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in FIELDNAMES}
+
+    def row(self):
+        """Valores en el orden de FIELDNAMES con las listas unidas, para CSV y XLSX."""
+        return [LIST_SEPARATOR.join(str(item) for item in value if item) if isinstance(value, list)
+                else (str(value) if value else "")
+                for value in (getattr(self, field) for field in FIELDNAMES)]
+
+    def __getitem__(self, field):
+        try:
+            return getattr(self, field)
+        except AttributeError:
+            raise KeyError(field)
+
+    def get(self, field, default=None):
+        return getattr(self, field, default)
+
+    def __repr__(self):
+        return f"TestCase({self.id_caso_prueba!r}, {self.titulo_caso_prueba!r})"
+
+
+def as_cases(data):
+    """Recorre casos TestCase o diccionarios (ya normalizados) como TestCase, sin copiar la lista."""
+    return (case if isinstance(case, TestCase) else TestCase.from_dict(case) for case in data)
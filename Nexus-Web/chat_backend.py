@@ -1,63 +1,167 @@
 import os
 import google.generativeai as genai
 # REMOVIDO: import google.api_core.exceptions as api_exceptions
-from pptx import Presentation
+
+import chat_sessions
+import knowledge_snapshot
+import llm_client
+import model_router
 
 # Este es el nuevo punto de entrada de tu aplicación
 def cargar_conocimiento(path):
     """
-    Carga el texto de todas las formas de un archivo PowerPoint.
+    Carga el conocimiento de un archivo PowerPoint: el snapshot precompilado (mmap)
+    con su índice de búsqueda. Solo se recorre el PPTX si el snapshot falta o está
+    obsoleto (ver knowledge_snapshot).
     """
-    texto = ""
     try:
         if not os.path.exists(path):
             return "❌ Archivo 'PLAN de Capacitacion.pptx' no encontrado."
 
-        prs = Presentation(path)
-        for slide in prs.slides:
-            for shape in slide.shapes:
-                if hasattr(shape, "text"):
-                    texto += shape.text + " "
-        return texto.strip()
+        return knowledge_snapshot.load(path)
     except Exception as e:
         return f"Error al cargar el archivo PowerPoint: {e}"
 
-def consultar_gemini(pregunta, conocimiento_jira):
+_SAFETY_SETTINGS = [
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"}
+]
+
+_ROLES = {chat_sessions.ROLE_USER: "Usuario", chat_sessions.ROLE_ASSISTANT: "Asistente"}
+
+
+def _formatear_turnos(turnos):
+    return "\n\n".join(f"{_ROLES[rol]}: {texto}" for rol, texto in turnos)
+
+
+def _conocimiento_relevante(pregunta, conocimiento_jira, historial=None):
     """
-    Genera una respuesta utilizando la API de Gemini.
+    Diapositivas del snapshot relacionadas con la pregunta (y con la pregunta anterior,
+    para las preguntas de seguimiento). Si ninguna comparte términos se usan las primeras
+    (portada y temario). Un conocimiento en texto plano se usa completo.
     """
+    if not isinstance(conocimiento_jira, knowledge_snapshot.KnowledgeSnapshot):
+        return conocimiento_jira
+    consulta = pregunta
+    if historial is not None:
+        anteriores = [texto for rol, texto in historial.turns if rol == chat_sessions.ROLE_USER]
+        if anteriores:
+            consulta = f"{pregunta}\n{anteriores[-1]}"
+    secciones = [texto for _, texto in conocimiento_jira.search(consulta)]
+    if not secciones:
+        total = min(len(conocimiento_jira), knowledge_snapshot.KNOWLEDGE_PASSAGES)
+        secciones = [conocimiento_jira.passage(i) for i in range(total)]
+    return "\n---\n".join(seccion.strip() for seccion in secciones)
+
+
+def _construir_prompt(pregunta, conocimiento_jira, historial=None):
+    conocimiento_jira = _conocimiento_relevante(pregunta, conocimiento_jira, historial)
+    conversacion = ""
+    if historial is not None and (historial.summary or historial.turns):
+        conversacion = "Usa la conversación previa para entender a qué se refiere la pregunta, sin repetir lo que ya respondiste.\n\n"
+        if historial.summary:
+            conversacion += f"Resumen de la conversación anterior:\n---\n{historial.summary}\n---\n\n"
+        if historial.turns:
+            conversacion += f"Conversación reciente:\n---\n{_formatear_turnos(historial.turns)}\n---\n\n"
+    return (
+        f"Eres un Tester Senior con amplio conocimiento en ISTQB. Tu misión es actuar como asistente para resolver dudas de un proyecto de software, "
+        f"específicamente en un contexto de pruebas de software, control de calidad y gestión de incidencias en Jira. "
+        f"Debes responder a la pregunta del usuario utilizando, en primer lugar, el siguiente 'conocimiento del proyecto' (las secciones relacionadas con la pregunta). "
+        f"Si el conocimiento no es suficiente, debes responder con tu conocimiento general sobre pruebas de software y control de calidad.\n\n"
+        f"**Formato de Respuesta:** La respuesta debe ser facil de leer, es decir, usa saltos de linea, viñetas o cualquier otro metodo para que el parrafo generado tenga una estructura profesional y limpia\n\n"
+        f"Conocimiento del proyecto:\n---\n{conocimiento_jira}\n---\n\n"
+        f"{conversacion}"
+        f"Pregunta del usuario: {pregunta}"
+    )
+
+
+def _modelo():
+    api_key = os.getenv("GEMINI_API_KEY")
+    if not api_key:
+        return None
+    llm_client.configure(api_key)
+    return genai.GenerativeModel(model_router.LLM_DEFAULT_MODEL)
+
+
+def _mensaje_de_error(e):
+    # CAMBIADO: Manejo genérico de excepciones en lugar de BlockedPromptException específica
+    error_message = str(e).lower()
+    if "blocked" in error_message or "safety" in error_message:
+        return f"Error de seguridad: La solicitud fue bloqueada por filtros de seguridad."
+    else:
+        return f"Error al comunicarse con la API de Gemini: {e}"
+
+
+def _responder(pregunta, conocimiento_jira, historial):
+    """Devuelve (respuesta, True) o (mensaje de error, False)."""
     try:
-        api_key = os.getenv("GEMINI_API_KEY")
-        if not api_key:
-            return "Error: La clave API de Gemini no está configurada. Contacta al administrador."
-
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel("gemini-1.5-flash-latest")
-
-        prompt = (
-            f"Eres un Tester Senior con amplio conocimiento en ISTQB. Tu misión es actuar como asistente para resolver dudas de un proyecto de software, "
-            f"específicamente en un contexto de pruebas de software, control de calidad y gestión de incidencias en Jira. "
-            f"Debes responder a la pregunta del usuario utilizando, en primer lugar, el siguiente 'conocimiento del proyecto'. "
-            f"Si el conocimiento no es suficiente, debes responder con tu conocimiento general sobre pruebas de software y control de calidad.\n\n"
-            f"**Formato de Respuesta:** La respuesta debe ser facil de leer, es decir, usa saltos de linea, viñetas o cualquier otro metodo para que el parrafo generado tenga una estructura profesional y limpia\n\n"
-            f"Conocimiento del proyecto:\n---\n{conocimiento_jira}\n---\n\n"
-            f"Pregunta del usuario: {pregunta}"
-        )
+        model = _modelo()
+        if model is None:
+            return "Error: La clave API de Gemini no está configurada. Contacta al administrador.", False
 
-        response = model.generate_content(
-            prompt,
-            safety_settings=[
-                {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-                {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-                {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-                {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"}
-            ]
+        response = llm_client.generate_content(
+            model,
+            _construir_prompt(pregunta, conocimiento_jira, historial),
+            llm_client.STAGE_CHAT,
+            safety_settings=_SAFETY_SETTINGS
         )
-        return response.text
-    # CAMBIADO: Manejo genérico de excepciones en lugar de BlockedPromptException específica
+        return response.text, True
     except Exception as e:
-        error_message = str(e).lower()
-        if "blocked" in error_message or "safety" in error_message:
-            return f"Error de seguridad: La solicitud fue bloqueada por filtros de seguridad."
+        return _mensaje_de_error(e), False
+
+
+def resumir_conversacion(resumen_previo, turnos):
+    """Resumen nuevo de la conversación: el resumen previo más los turnos indicados."""
+    model = _modelo()
+    if model is None:
+        raise RuntimeError("La clave API de Gemini no está configurada")
+    palabras = chat_sessions.CHAT_SUMMARY_TOKENS * 3 // 4
+    prompt = (
+        f"Resume la siguiente conversación entre un usuario y un asistente de pruebas de software y Jira "
+        f"en un máximo de {palabras} palabras. Conserva los temas consultados, los datos concretos que dio "
+        f"el usuario (proyectos, módulos, tickets, decisiones) y las conclusiones de las respuestas; "
+        f"omite saludos y formato. Responde solo con el resumen.\n\n"
+        + (f"Resumen previo:\n---\n{resumen_previo}\n---\n\n" if resumen_previo else "")
+        + f"Turnos nuevos:\n---\n{_formatear_turnos(turnos)}\n---"
+    )
+    response = llm_client.generate_content(
+        model,
+        prompt,
+        llm_client.STAGE_CHAT_SUMMARY,
+        safety_settings=_SAFETY_SETTINGS,
+        generation_config={"max_output_tokens": chat_sessions.CHAT_SUMMARY_TOKENS}
+    )
+    return response.text
+
+
+def consultar_en_sesion(session_id, pregunta, conocimiento_jira):
+    """
+    Responde dentro de una sesión de chat: usa el resumen y los turnos recientes,
+    guarda el turno y programa la compactación del historial en segundo plano.
+    Las respuestas de error no se guardan en el historial.
+    """
+    historial = chat_sessions.history(session_id)
+    if historial.pending:
+        # Si la compactación en segundo plano sigue en curso se espera su resumen en lugar de pedir otro
+        if chat_sessions.wait_for_compaction(session_id):
+            historial = chat_sessions.history(session_id)
+            if historial.pending:
+                # No había compactación en este worker o falló: se hace ahora
+                try:
+                    chat_sessions.compact(session_id, resumir_conversacion)
+                    historial = chat_sessions.history(session_id)
+                except Exception as e:
+                    print(f"Error resumiendo la sesión de chat {session_id}: {e}")
         else:
-            return f"Error al comunicarse con la API de Gemini: {e}"
+            # Sin resumen nuevo se responde solo con el resumen previo y los turnos que caben
+            print(f"La sesión de chat {session_id} sigue resumiéndose; se responde con el resumen previo")
+
+    respuesta, ok = _responder(pregunta, conocimiento_jira, historial)
+    if not ok:
+        return respuesta
+
+    chat_sessions.append(session_id, pregunta, respuesta)
+    chat_sessions.schedule_compaction(session_id, resumir_conversacion)
+    return respuesta
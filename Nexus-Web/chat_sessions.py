@@ -0,0 +1,264 @@
+"""
+Sesiones de chat de varios turnos con historial acotado.
+
+Cada sesión guarda sus turnos (pregunta del usuario y respuesta) en SQLite,
+compartido entre los workers del host. Al prompt solo van un resumen de la
+conversación anterior y los turnos más recientes que caben en
+CHAT_HISTORY_TOKENS, así que su tamaño no crece con la conversación.
+
+Los turnos que ya no caben se compactan en el resumen: en segundo plano
+después de cada respuesta, cuando los turnos sin resumir superan el
+presupuesto. La compactación corre con el contexto de la petición que la
+programó (prioridad y usuario del LLM y plazo), no con el de un trabajo
+masivo anónimo. Si la siguiente pregunta llega antes de que termine, espera
+esa misma compactación (hasta CHAT_SUMMARY_WAIT_SECONDS, sin pasar del plazo
+de la pregunta) en lugar de pedir otro resumen igual, y solo compacta ella
+misma si no había ninguna en curso en el worker o falló. Se compacta hasta dejar la mitad del presupuesto para no
+resumir en cada turno. El resumen lo genera quien llama (chat_backend) con el LLM; este
+módulo solo guarda y recorta.
+
+Configuración:
+    CHAT_SESSION_DB        ruta del archivo SQLite (compartido entre workers del host)
+    CHAT_SESSION_TTL       segundos sin actividad tras los que se borra una sesión
+    CHAT_HISTORY_TOKENS    tokens estimados de turnos recientes que van al prompt
+    CHAT_SUMMARY_TOKENS    tokens máximos del resumen de la conversación
+    CHAT_SUMMARY_WAIT_SECONDS  espera máxima de una pregunta por la compactación en curso
+"""
+import contextvars
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+import deadline
+import metrics
+import model_router
+
+CHAT_SESSION_DB = os.getenv("CHAT_SESSION_DB", os.path.join(tempfile.gettempdir(), "nexus_chat_sessions.sqlite"))
+CHAT_SESSION_TTL = float(os.getenv("CHAT_SESSION_TTL", "86400"))
+CHAT_HISTORY_TOKENS = int(os.getenv("CHAT_HISTORY_TOKENS", "1500"))
+CHAT_SUMMARY_TOKENS = int(os.getenv("CHAT_SUMMARY_TOKENS", "400"))
+CHAT_SUMMARY_WAIT_SECONDS = float(os.getenv("CHAT_SUMMARY_WAIT_SECONDS", "20"))
+
+ROLE_USER = "user"
+ROLE_ASSISTANT = "assistant"
+
+_SESSION_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+# Compactación en curso en este proceso por sesión (Future del executor)
+_compacting = {}
+
+
+class History:
+    """Lo que va al prompt: resumen, turnos recientes y turnos sin resumir que no caben."""
+    __slots__ = ("summary", "turns", "pending")
+
+    def __init__(self, summary, turns, pending):
+        self.summary = summary
+        self.turns = turns
+        self.pending = pending
+
+
+def _connect():
+    conn = sqlite3.connect(CHAT_SESSION_DB, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS sessions ("
+        "id TEXT PRIMARY KEY, summary TEXT NOT NULL DEFAULT '', "
+        "summarized_upto INTEGER NOT NULL DEFAULT 0, updated REAL NOT NULL)"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS turns ("
+        "id INTEGER PRIMARY KEY, session TEXT NOT NULL, role TEXT NOT NULL, "
+        "text TEXT NOT NULL, tokens INTEGER NOT NULL, created REAL NOT NULL)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS turns_session ON turns (session, id)")
+    return conn
+
+
+def _get_executor():
+    """Pool de compactación del proceso, creado de nuevo tras un fork."""
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chat-summary")
+            _executor_pid = os.getpid()
+            _compacting.clear()
+        return _executor
+
+
+def create():
+    """Crea una sesión vacía y devuelve su id."""
+    session_id = uuid.uuid4().hex
+    conn = _connect()
+    try:
+        _cleanup_expired(conn)
+        conn.execute("INSERT INTO sessions (id, updated) VALUES (?, ?)", (session_id, time.time()))
+    finally:
+        conn.close()
+    return session_id
+
+
+def exists(session_id):
+    if not session_id or not _SESSION_ID_RE.match(session_id):
+        return False
+    conn = _connect()
+    try:
+        return conn.execute("SELECT 1 FROM sessions WHERE id = ?", (session_id,)).fetchone() is not None
+    finally:
+        conn.close()
+
+
+def delete(session_id):
+    """Borra la sesión y sus turnos. Devuelve False si no existía."""
+    if not session_id or not _SESSION_ID_RE.match(session_id):
+        return False
+    conn = _connect()
+    try:
+        conn.execute("DELETE FROM turns WHERE session = ?", (session_id,))
+        return conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,)).rowcount > 0
+    finally:
+        conn.close()
+
+
+def append(session_id, question, answer):
+    """Guarda un turno completo (pregunta y respuesta)."""
+    ahora = time.time()
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany(
+            "INSERT INTO turns (session, role, text, tokens, created) VALUES (?, ?, ?, ?, ?)",
+            [(session_id, ROLE_USER, question, model_router.estimate_input_tokens(question), ahora),
+             (session_id, ROLE_ASSISTANT, answer, model_router.estimate_input_tokens(answer), ahora)]
+        )
+        conn.execute("UPDATE sessions SET updated = ? WHERE id = ?", (ahora, session_id))
+        conn.execute("COMMIT")
+    except Exception:
+        # Si falló el propio BEGIN no hay transacción que deshacer
+        if conn.in_transaction:
+            conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def _load(conn, session_id):
+    fila = conn.execute("SELECT summary, summarized_upto FROM sessions WHERE id = ?", (session_id,)).fetchone()
+    if fila is None:
+        return "", 0, []
+    turnos = conn.execute(
+        "SELECT id, role, text, tokens FROM turns WHERE session = ? AND id > ? ORDER BY id",
+        (session_id, fila[1])
+    ).fetchall()
+    return fila[0], fila[1], turnos
+
+
+def _split(turnos, presupuesto):
+    """Índice desde el que los turnos más recientes caben en el presupuesto (en pares pregunta/respuesta)."""
+    usados = 0
+    corte = len(turnos)
+    while corte >= 2 and usados + turnos[corte - 1][3] + turnos[corte - 2][3] <= presupuesto:
+        usados += turnos[corte - 1][3] + turnos[corte - 2][3]
+        corte -= 2
+    return corte
+
+
+def history(session_id):
+    """Resumen y turnos recientes [(rol, texto)] de la sesión dentro de CHAT_HISTORY_TOKENS."""
+    conn = _connect()
+    try:
+        resumen, _, turnos = _load(conn, session_id)
+    finally:
+        conn.close()
+    corte = _split(turnos, CHAT_HISTORY_TOKENS)
+    return History(resumen, [(rol, texto) for _, rol, texto, _ in turnos[corte:]], corte)
+
+
+def needs_compaction(session_id):
+    return history(session_id).pending > 0
+
+
+def compact(session_id, summarizer):
+    """
+    Resume los turnos más antiguos hasta que los sin resumir quepan en la mitad
+    del presupuesto. summarizer(resumen_previo, [(rol, texto)]) devuelve el resumen nuevo.
+    Devuelve True si el resumen cambió.
+    """
+    conn = _connect()
+    try:
+        resumen, hasta, turnos = _load(conn, session_id)
+        corte = _split(turnos, CHAT_HISTORY_TOKENS // 2)
+        if corte == 0:
+            return False
+        with metrics.stage("chat", "summary"):
+            nuevo = summarizer(resumen, [(rol, texto) for _, rol, texto, _ in turnos[:corte]])
+        # Tope duro: el resumen nunca supera su presupuesto aunque el modelo se extienda
+        nuevo = nuevo.strip()[:CHAT_SUMMARY_TOKENS * 4]
+        # Si otro worker compactó mientras tanto, su resumen gana y este se descarta
+        actualizado = conn.execute(
+            "UPDATE sessions SET summary = ?, summarized_upto = ? WHERE id = ? AND summarized_upto = ?",
+            (nuevo, turnos[corte - 1][0], session_id, hasta)
+        ).rowcount
+        return actualizado > 0
+    finally:
+        conn.close()
+
+
+def schedule_compaction(session_id, summarizer):
+    """Compacta en segundo plano si los turnos sin resumir superan el presupuesto."""
+    if not needs_compaction(session_id):
+        return
+    executor = _get_executor()
+    with _executor_lock:
+        if session_id in _compacting:
+            return
+        # Copia del contexto de la petición: el hilo del pool no hereda sus contextvars
+        contexto = contextvars.copy_context()
+        # Se registra bajo el lock: _compact_quietly no puede quitarla antes de que se agregue
+        _compacting[session_id] = executor.submit(contexto.run, _compact_quietly, session_id, summarizer)
+
+
+def wait_for_compaction(session_id, timeout=CHAT_SUMMARY_WAIT_SECONDS):
+    """
+    Espera la compactación en segundo plano de la sesión si hay una en curso en este proceso.
+    Si la petición tiene plazo, la espera deja tiempo para la llamada que responde la pregunta.
+    Devuelve False si sigue en curso al vencer el timeout (True si terminó o no había ninguna).
+    """
+    with _executor_lock:
+        futuro = _compacting.get(session_id)
+    if futuro is None:
+        return True
+    plazo = deadline.current()
+    if plazo is not None:
+        timeout = max(0.0, min(timeout, plazo.llm_budget() - plazo.min_call))
+    try:
+        futuro.result(timeout)
+    except FutureTimeout:
+        return False
+    return True
+
+
+def _compact_quietly(session_id, summarizer):
+    # Si falla, la siguiente pregunta compacta antes de responder
+    try:
+        compact(session_id, summarizer)
+    except Exception as e:
+        print(f"Error resumiendo la sesión de chat {session_id}: {e}")
+    finally:
+        with _executor_lock:
+            _compacting.pop(session_id, None)
+
+
+def _cleanup_expired(conn):
+    """Borra sesiones inactivas más antiguas que CHAT_SESSION_TTL (se llama de forma oportunista)."""
+    limite = time.time() - CHAT_SESSION_TTL
+    conn.execute("DELETE FROM turns WHERE session IN (SELECT id FROM sessions WHERE updated < ?)", (limite,))
+    conn.execute("DELETE FROM sessions WHERE updated < ?", (limite,))
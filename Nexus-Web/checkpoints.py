@@ -0,0 +1,81 @@
+"""
+Checkpoints de trabajos largos (matrices y documentos grandes de historias).
+
+Cada fragmento o lote completado se guarda en una base SQLite local en cuanto
+termina. Si el worker se reinicia o la petición expira, al reenviar el mismo
+documento con los mismos parámetros el trabajo retoma: solo se llama al LLM
+para los elementos que faltan. Al completarse el trabajo se borran sus
+checkpoints.
+
+Configuración:
+    CHECKPOINT_DB     ruta del archivo SQLite (compartido entre workers del host)
+    CHECKPOINT_TTL    segundos que se conservan los checkpoints de trabajos sin terminar
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import time
+
+import metrics
+
+CHECKPOINT_DB = os.getenv("CHECKPOINT_DB", os.path.join(tempfile.gettempdir(), "nexus_checkpoints.sqlite"))
+CHECKPOINT_TTL = float(os.getenv("CHECKPOINT_TTL", "86400"))
+
+
+def _connect():
+    conn = sqlite3.connect(CHECKPOINT_DB, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS checkpoints ("
+        "job TEXT NOT NULL, item TEXT NOT NULL, payload TEXT NOT NULL, created REAL NOT NULL, "
+        "PRIMARY KEY (job, item))"
+    )
+    return conn
+
+
+def job_key(pipeline, text, params):
+    """Huella de un trabajo: pipeline, texto del documento y parámetros de generación."""
+    digest = hashlib.sha256()
+    digest.update(pipeline.encode("utf-8"))
+    digest.update(text.encode("utf-8"))
+    digest.update(json.dumps(params, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def load(job):
+    """Devuelve {item: valor} con los elementos ya completados del trabajo."""
+    conn = _connect()
+    try:
+        conn.execute("DELETE FROM checkpoints WHERE created < ?", (time.time() - CHECKPOINT_TTL,))
+        filas = conn.execute("SELECT item, payload FROM checkpoints WHERE job = ?", (job,)).fetchall()
+    finally:
+        conn.close()
+    return {item: json.loads(payload) for item, payload in filas}
+
+
+def save(job, item, value):
+    """Guarda el resultado de un elemento (fragmento, lote...) del trabajo."""
+    conn = _connect()
+    try:
+        conn.execute("INSERT OR REPLACE INTO checkpoints (job, item, payload, created) VALUES (?, ?, ?, ?)",
+                     (job, item, json.dumps(value, ensure_ascii=False), time.time()))
+    finally:
+        conn.close()
+
+
+def clear(job):
+    """Borra los checkpoints de un trabajo terminado."""
+    conn = _connect()
+    try:
+        conn.execute("DELETE FROM checkpoints WHERE job = ?", (job,))
+    finally:
+        conn.close()
+
+
+def lookup(completados, item):
+    """Busca un elemento entre los ya completados y registra el acierto o fallo."""
+    hit = item in completados
+    metrics.record_cache("checkpoint", hit)
+    return completados.get(item)
@@ -0,0 +1,227 @@
+"""
+Análisis local de cobertura de requerimientos por la matriz de pruebas.
+
+Cada oración de requerimiento del documento se compara con los casos de
+prueba generados (título, descripción y pasos) mediante TF-IDF disperso
+con NumPy y similitud coseno: los casos se guardan como índice invertido y
+los requerimientos se puntúan por bloques, sin una matriz densa casos x
+vocabulario. Los requerimientos cuyo mejor caso no alcanza
+COVERAGE_THRESHOLD se reportan como brechas; el modo de seguimiento de
+/api/matrix/coverage pide al LLM casos solo para esas brechas.
+
+No hace llamadas al LLM ni usa servicios externos.
+"""
+import os
+import re
+import unicodedata
+
+import numpy as np
+
+COVERAGE_THRESHOLD = float(os.getenv("COVERAGE_THRESHOLD", "0.25"))
+# Oraciones más cortas que esto no se consideran requerimientos (títulos, viñetas sueltas)
+MIN_REQUIREMENT_CHARS = 25
+# Puntajes (consulta x caso) y entradas del índice que se acumulan a la vez (acota la memoria)
+_BLOCK_ENTRIES = 1 << 22
+
+_HISTORIA = re.compile(r"^HISTORIA #\d+:")
+_SEPARADOR_ORACIONES = re.compile(r"(?<=[.!?;])\s+|\n+")
+_TOKEN = re.compile(r"[a-z0-9ñ]{3,}")
+_STOPWORDS = frozenset("""
+    los las del con para por que una uno unos unas como sus este esta estos estas ese esa eso
+    debe deben puede pueden sera será ser son sin sobre entre cuando donde cual cuales desde
+    hasta todo todos toda todas tambien también mas más muy pero otro otra otros otras the and
+""".split())
+
+
+def tokenize(text):
+    """Términos significativos del texto: minúsculas, sin acentos ni stopwords."""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return [t for t in _TOKEN.findall(text) if t not in _STOPWORDS]
+
+
+def split_requirements(text):
+    """
+    Divide el documento en oraciones de requerimiento.
+    Devuelve una lista de (historia, oración) donde historia es el encabezado
+    "HISTORIA #n: ..." que precede a la oración (o None).
+    """
+    requisitos = []
+    historia = None
+    for parrafo in text.split("\n"):
+        parrafo = parrafo.strip()
+        if not parrafo:
+            continue
+        if _HISTORIA.match(parrafo):
+            historia = parrafo
+            continue
+        for oracion in _SEPARADOR_ORACIONES.split(parrafo):
+            oracion = oracion.strip()
+            if len(oracion) >= MIN_REQUIREMENT_CHARS:
+                requisitos.append((historia, oracion))
+    return requisitos
+
+
+def remove_requirements(text, oraciones):
+    """
+    Texto sin las oraciones de requerimiento indicadas (tal como las devuelve
+    split_requirements). Encabezados, líneas cortas y el resto de cada párrafo quedan igual.
+    """
+    quitar = set(oraciones)
+    if not quitar:
+        return text
+    lineas = []
+    for linea in text.split("\n"):
+        partes = [o.strip() for o in _SEPARADOR_ORACIONES.split(linea.strip())]
+        restantes = [o for o in partes if o and o not in quitar]
+        if len(restantes) == len([o for o in partes if o]):
+            lineas.append(linea)
+        elif restantes:
+            lineas.append(" ".join(restantes))
+    return "\n".join(lineas)
+
+
+def case_text(case):
+    """Texto de un caso que se compara con los requerimientos."""
+    pasos = case.get("Pasos") or []
+    if isinstance(pasos, list):
+        pasos = " ".join(str(p) for p in pasos)
+    return f"{case.get('titulo_caso_prueba') or ''} {case.get('Descripcion') or ''} {pasos}"
+
+
+def _term_counts(documents, vocabulario):
+    """Apariciones de cada término por documento como tres arrays (fila, término, conteo), ordenados."""
+    filas = np.fromiter((i for i, tokens in enumerate(documents) for _ in tokens), dtype=np.int64)
+    terminos = np.fromiter((vocabulario[t] for tokens in documents for t in tokens), dtype=np.int64)
+    if not len(filas):
+        return filas, terminos, np.zeros(0, dtype=np.int64)
+    claves, conteo = np.unique(filas * len(vocabulario) + terminos, return_counts=True)
+    filas, terminos = np.divmod(claves, len(vocabulario))
+    return filas, terminos, conteo
+
+
+def _tfidf(filas, terminos, conteo, idf, n_filas):
+    """Pesos TF-IDF dispersos (float32) con cada fila normalizada L2 sobre todos sus términos."""
+    # TF sublineal
+    pesos = np.log1p(conteo).astype(np.float32) * idf[terminos]
+    normas = np.sqrt(np.bincount(filas, weights=pesos * pesos, minlength=n_filas)).astype(np.float32)
+    return pesos / normas[filas]
+
+
+def best_matches(consultas, documentos):
+    """
+    Para cada consulta (lista de tokens) devuelve el índice del documento más parecido
+    y su similitud coseno TF-IDF, como dos arrays. Sin documentos o sin ningún término
+    en común el índice es -1.
+    """
+    mejores = np.zeros(len(consultas), dtype=np.float32)
+    indices = np.full(len(consultas), -1)
+    if not consultas or not documentos:
+        return indices, mejores
+
+    # Vocabulario completo: la norma de cada documento incluye también los términos que
+    # no aparecen en ninguna consulta (si no, un solo término compartido daría similitud ~1)
+    vocabulario = {}
+    for tokens in consultas + documentos:
+        for token in tokens:
+            vocabulario.setdefault(token, len(vocabulario))
+    if not vocabulario:
+        return indices, mejores
+
+    q_filas, q_terminos, q_conteo = _term_counts(consultas, vocabulario)
+    d_filas, d_terminos, d_conteo = _term_counts(documentos, vocabulario)
+    # IDF sobre el conjunto de consultas y documentos
+    df = np.bincount(q_terminos, minlength=len(vocabulario)) + np.bincount(d_terminos, minlength=len(vocabulario))
+    n_total = len(consultas) + len(documentos)
+    idf = (np.log((1 + n_total) / (1 + df)) + 1).astype(np.float32)
+    q_pesos = _tfidf(q_filas, q_terminos, q_conteo, idf, len(consultas))
+    d_pesos = _tfidf(d_filas, d_terminos, d_conteo, idf, len(documentos))
+
+    # Índice invertido de los documentos: sus entradas ordenadas por término
+    orden = np.argsort(d_terminos, kind="stable")
+    post_docs, post_pesos = d_filas[orden], d_pesos[orden]
+    ptr = np.zeros(len(vocabulario) + 1, dtype=np.int64)
+    ptr[1:] = np.cumsum(np.bincount(d_terminos, minlength=len(vocabulario)))
+
+    # Entradas del índice que toca cada término de cada consulta, y el total por consulta
+    largos = ptr[q_terminos + 1] - ptr[q_terminos]
+    carga = np.bincount(q_filas, weights=largos, minlength=len(consultas))
+    q_ptr = np.zeros(len(consultas) + 1, dtype=np.int64)
+    q_ptr[1:] = np.cumsum(np.bincount(q_filas, minlength=len(consultas)))
+
+    n_docs = len(documentos)
+    inicio = 0
+    while inicio < len(consultas):
+        # Bloque de consultas cuya matriz de puntajes y entradas acumuladas caben en _BLOCK_ENTRIES
+        fin, acumulado = inicio + 1, carga[inicio]
+        while (fin < len(consultas) and (fin + 1 - inicio) * n_docs <= _BLOCK_ENTRIES
+               and acumulado + carga[fin] <= _BLOCK_ENTRIES):
+            acumulado += carga[fin]
+            fin += 1
+
+        entradas = slice(q_ptr[inicio], q_ptr[fin])
+        largo = largos[entradas]
+        repetidas = np.repeat(np.arange(len(largo)), largo)
+        desplazamiento = np.arange(int(largo.sum())) - np.repeat(np.cumsum(largo) - largo, largo)
+        posiciones = ptr[q_terminos[entradas]][repetidas] + desplazamiento
+        filas = q_filas[entradas][repetidas] - inicio
+        puntajes = np.bincount(filas * n_docs + post_docs[posiciones],
+                               weights=q_pesos[entradas][repetidas] * post_pesos[posiciones],
+                               minlength=(fin - inicio) * n_docs).reshape(fin - inicio, n_docs)
+        mejores[inicio:fin] = puntajes.max(axis=1)
+        indices[inicio:fin] = np.where(mejores[inicio:fin] > 0, puntajes.argmax(axis=1), -1)
+        inicio = fin
+    return indices, mejores
+
+
+def analyze_coverage(text, cases, threshold=None):
+    """
+    Compara los requerimientos del documento con los casos de prueba.
+    Devuelve un informe con la proporción cubierta y la lista de requerimientos sin cubrir.
+    """
+    threshold = COVERAGE_THRESHOLD if threshold is None else threshold
+    requisitos = split_requirements(text)
+    cases = list(cases)
+    informe = {
+        "requirements_total": len(requisitos),
+        "cases_total": len(cases),
+        "threshold": threshold,
+        "covered": 0,
+        "coverage_ratio": 1.0,
+        "uncovered": []
+    }
+    if not requisitos:
+        return informe
+
+    mejor_caso, mejores = best_matches([tokenize(oracion) for _, oracion in requisitos],
+                                       [tokenize(case_text(case)) for case in cases])
+
+    cubiertos = mejores >= threshold
+    informe["covered"] = int(cubiertos.sum())
+    informe["coverage_ratio"] = round(informe["covered"] / len(requisitos), 3)
+    for i in np.flatnonzero(~cubiertos):
+        historia, oracion = requisitos[i]
+        informe["uncovered"].append({
+            "index": int(i),
+            "historia": historia,
+            "text": oracion,
+            "best_score": round(float(mejores[i]), 3),
+            "best_case": cases[mejor_caso[i]].get("titulo_caso_prueba") if mejor_caso[i] >= 0 else None
+        })
+    return informe
+
+
+def gaps_document(informe):
+    """
+    Texto con solo los requerimientos sin cubrir, agrupados bajo su encabezado
+    "HISTORIA #n" para que generar_matriz_test asigne la historia de cada caso.
+    """
+    lineas = []
+    historia_actual = object()
+    for brecha in informe["uncovered"]:
+        if brecha["historia"] != historia_actual:
+            historia_actual = brecha["historia"]
+            if historia_actual:
+                lineas.append(historia_actual)
+        lineas.append(brecha["text"])
+    return "\n".join(lineas)
@@ -0,0 +1,92 @@
+"""
+Plazo (deadline) de las peticiones de generación.
+
+Cada petición larga recibe un presupuesto de tiempo total. Las llamadas al
+LLM ajustan su timeout al tiempo que queda y los bucles de fragmentos/lotes
+dejan de despachar trabajo nuevo cuando el presupuesto se agota, de modo que
+la petición devuelve lo que tenga (marcado como parcial) en lugar de acabar
+en un 502 del proxy o del worker.
+
+Una parte del presupuesto (DEADLINE_RESERVE_SECONDS) se reserva para la
+deduplicación y la exportación que vienen después de las llamadas al LLM.
+
+El plazo de la petición actual viaja en un contextvar, igual que el token de
+cancelación.
+
+Configuración:
+    REQUEST_DEADLINE_SECONDS    presupuesto total por petición
+    DEADLINE_RESERVE_SECONDS    tiempo reservado para el post-procesamiento
+    DEADLINE_MIN_CALL_SECONDS   no se inicia una llamada al LLM con menos tiempo que esto
+"""
+import contextvars
+import os
+import time
+
+REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", "270"))
+DEADLINE_RESERVE_SECONDS = float(os.getenv("DEADLINE_RESERVE_SECONDS", "30"))
+DEADLINE_MIN_CALL_SECONDS = float(os.getenv("DEADLINE_MIN_CALL_SECONDS", "10"))
+
+_current_deadline = contextvars.ContextVar("request_deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    """No queda presupuesto de tiempo para más llamadas al LLM en esta petición."""
+
+
+class Deadline:
+    def __init__(self, seconds, reserve=DEADLINE_RESERVE_SECONDS, min_call=DEADLINE_MIN_CALL_SECONDS):
+        self.expires_at = time.monotonic() + seconds
+        self.reserve = reserve
+        self.min_call = min_call
+
+    def remaining(self):
+        """Segundos que quedan del presupuesto total."""
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def llm_budget(self):
+        """Segundos disponibles para llamadas al LLM (el total menos la reserva)."""
+        return max(0.0, self.remaining() - self.reserve)
+
+    @property
+    def exhausted(self):
+        """True si ya no tiene sentido iniciar otra llamada al LLM."""
+        return self.llm_budget() < self.min_call
+
+    def check(self):
+        if self.exhausted:
+            raise DeadlineExceeded(f"Presupuesto de tiempo agotado ({self.remaining():.0f}s restantes)")
+
+    def call_timeout(self, timeout=None):
+        """Timeout para una llamada al LLM: el solicitado, sin pasar del presupuesto disponible."""
+        presupuesto = self.llm_budget()
+        return presupuesto if timeout is None else min(timeout, presupuesto)
+
+
+def current():
+    return _current_deadline.get()
+
+
+def exhausted():
+    """Indica si el plazo de la petición actual está agotado (False si no hay plazo)."""
+    plazo = _current_deadline.get()
+    return plazo is not None and plazo.exhausted
+
+
+def bind(seconds):
+    """Fija el plazo de la petición actual; devuelve el token del contextvar para release()."""
+    return _current_deadline.set(Deadline(seconds))
+
+
+def release(context_token):
+    _current_deadline.reset(context_token)
+
+
+def coverage(total, completed, failed, skipped):
+    """Informe de cobertura de un trabajo troceado en elementos (fragmentos, lotes...)."""
+    return {
+        "total": total,
+        "completed": completed,
+        "failed": failed,
+        "skipped": skipped,
+        "ratio": round(completed / total, 3) if total else 1.0
+    }
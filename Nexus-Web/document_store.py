@@ -0,0 +1,332 @@
+"""
+Documentos subidos por adelantado (subida en dos fases).
+
+La página sube el archivo en cuanto el usuario lo elige (POST /api/upload) y
+la extracción de texto empieza en segundo plano mientras el usuario completa
+el formulario. La subida devuelve un identificador (document_id) que los
+endpoints de generación aceptan en lugar del archivo.
+
+Cada documento vive en su propio directorio bajo DOCUMENT_DIR:
+
+    source.<ext>         archivo original
+    <pipeline>.started   marca de extracción en curso, con el PID del proceso que extrae
+    <pipeline>.txt       texto extraído por el extractor del pipeline
+    <pipeline>.error     mensaje de error si la extracción falló
+
+Así cualquier worker de gunicorn del host encuentra el documento, aunque la
+subida la haya recibido otro. Si el texto aún no está listo, la generación
+espera hasta DOCUMENT_WAIT_SECONDS (o lo que le quede de plazo) mientras el
+proceso que extrae siga vivo y, si la extracción nunca empezó, murió o no
+terminó a tiempo, extrae el texto ella misma. La espera se corta si el
+cliente cancela.
+
+Como los documentos sobreviven a la petición, el espacio está acotado: cada
+cliente puede tener como mucho DOCUMENT_MAX_PER_CLIENT documentos vivos y el
+directorio no pasa de DOCUMENT_MAX_TOTAL_MB. Las cuotas se llevan en SQLite
+(DOCUMENT_QUOTA_DB, compartido entre los workers del host) y cada subida
+reserva su lugar con una sola sentencia que comprueba y registra a la vez:
+subidas simultáneas del mismo cliente no pueden pasar todas la comprobación.
+
+Configuración:
+    DOCUMENT_DIR                directorio de los documentos subidos
+    DOCUMENT_TTL                segundos que se conserva un documento
+    DOCUMENT_WAIT_SECONDS       espera máxima por una extracción en curso
+    DOCUMENT_EXTRACT_WORKERS    extracciones simultáneas en segundo plano por worker
+    DOCUMENT_MAX_PER_CLIENT     documentos vivos por cliente
+    DOCUMENT_MAX_TOTAL_MB       espacio máximo de todos los documentos
+    DOCUMENT_QUOTA_DB           ruta del archivo SQLite de las cuotas
+"""
+import hashlib
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.utils import secure_filename
+
+import cancellation
+import deadline
+import metrics
+
+DOCUMENT_DIR = os.getenv("DOCUMENT_DIR", os.path.join(tempfile.gettempdir(), "nexus_documents"))
+DOCUMENT_TTL = float(os.getenv("DOCUMENT_TTL", "3600"))
+DOCUMENT_WAIT_SECONDS = float(os.getenv("DOCUMENT_WAIT_SECONDS", "120"))
+DOCUMENT_EXTRACT_WORKERS = int(os.getenv("DOCUMENT_EXTRACT_WORKERS", "2"))
+DOCUMENT_MAX_PER_CLIENT = int(os.getenv("DOCUMENT_MAX_PER_CLIENT", "20"))
+DOCUMENT_MAX_TOTAL_MB = float(os.getenv("DOCUMENT_MAX_TOTAL_MB", "2048"))
+DOCUMENT_QUOTA_DB = os.getenv("DOCUMENT_QUOTA_DB", os.path.join(tempfile.gettempdir(), "nexus_documents.sqlite"))
+
+STATUS_PROCESSING = "processing"
+STATUS_READY = "ready"
+STATUS_ERROR = "error"
+
+_DOCUMENT_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+_POLL_INTERVAL = 0.2
+# Segundos que una reserva de cuota puede existir sin su directorio
+_RESERVATION_GRACE = 60
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+class DocumentNotFound(Exception):
+    """El documento no existe o ya expiró."""
+
+
+class QuotaExceeded(Exception):
+    """No se acepta el documento: el cliente o el directorio llegó a su límite."""
+
+    def __init__(self, message, per_client):
+        super().__init__(message)
+        self.per_client = per_client
+
+
+def _get_executor():
+    """Pool de extracción del proceso, creado de nuevo tras un fork."""
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=DOCUMENT_EXTRACT_WORKERS,
+                                           thread_name_prefix="document-extract")
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def _document_dir(document_id):
+    if not document_id or not _DOCUMENT_ID_RE.match(document_id):
+        raise DocumentNotFound(document_id)
+    ruta = os.path.join(DOCUMENT_DIR, document_id)
+    if not os.path.isdir(ruta):
+        raise DocumentNotFound(document_id)
+    return ruta
+
+
+def _write_atomic(path, text):
+    temporal = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporal, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(temporal, path)
+
+
+def _client_key(client):
+    return hashlib.sha256(str(client).encode("utf-8")).hexdigest()[:32]
+
+
+def _connect():
+    conn = sqlite3.connect(DOCUMENT_QUOTA_DB, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS documents ("
+        "id TEXT PRIMARY KEY, client TEXT NOT NULL, size INTEGER NOT NULL, created REAL NOT NULL)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS documents_client ON documents (client)")
+    return conn
+
+
+def _reserve(document_id, client_key, size):
+    """
+    Reserva el lugar del documento en las cuotas. La comprobación y el registro son una
+    sola sentencia, así que es atómica entre hilos y workers. Lanza QuotaExceeded si no cabe.
+    """
+    limite_total = int(DOCUMENT_MAX_TOTAL_MB * 1024 * 1024)
+    conn = _connect()
+    try:
+        reservado = conn.execute(
+            "INSERT INTO documents (id, client, size, created) SELECT ?, ?, ?, ? "
+            "WHERE (SELECT COUNT(*) FROM documents WHERE client = ?) < ? "
+            "AND (SELECT COALESCE(SUM(size), 0) FROM documents) + ? <= ?",
+            (document_id, client_key, size, time.time(), client_key, DOCUMENT_MAX_PER_CLIENT, size, limite_total)
+        ).rowcount
+        if reservado:
+            return
+        # Solo para el mensaje: cuál de los dos límites no se cumplió
+        del_cliente = conn.execute("SELECT COUNT(*) FROM documents WHERE client = ?", (client_key,)).fetchone()[0]
+    finally:
+        conn.close()
+    if del_cliente >= DOCUMENT_MAX_PER_CLIENT:
+        raise QuotaExceeded(f"Límite de {DOCUMENT_MAX_PER_CLIENT} documentos subidos alcanzado. "
+                            f"Intenta de nuevo más tarde.", per_client=True)
+    raise QuotaExceeded("No hay espacio para más documentos. Intenta de nuevo más tarde.", per_client=False)
+
+
+def _release(document_ids):
+    conn = _connect()
+    try:
+        conn.executemany("DELETE FROM documents WHERE id = ?", [(document_id,) for document_id in document_ids])
+    finally:
+        conn.close()
+
+
+def create(file, client, size=None):
+    """
+    Guarda un archivo subido (FileStorage) y devuelve su document_id. `client` identifica
+    a quien lo sube y `size` es el tamaño esperado (Content-Length) para las cuotas.
+    Lanza QuotaExceeded si se superan DOCUMENT_MAX_PER_CLIENT o DOCUMENT_MAX_TOTAL_MB.
+    """
+    os.makedirs(DOCUMENT_DIR, exist_ok=True)
+    _cleanup_expired()
+    document_id = uuid.uuid4().hex
+    _reserve(document_id, _client_key(client), size or 0)
+    ruta = os.path.join(DOCUMENT_DIR, document_id)
+    try:
+        os.makedirs(ruta)
+        # Los extractores deciden el formato por la extensión
+        _, extension = os.path.splitext(secure_filename(file.filename))
+        destino = os.path.join(ruta, f"source{extension.lower()}")
+        file.save(destino)
+    except BaseException:
+        shutil.rmtree(ruta, ignore_errors=True)
+        _release([document_id])
+        raise
+    # La reserva usó el Content-Length de la petición: se ajusta al tamaño real del archivo
+    conn = _connect()
+    try:
+        conn.execute("UPDATE documents SET size = ? WHERE id = ?", (os.path.getsize(destino), document_id))
+    finally:
+        conn.close()
+    return document_id
+
+
+def source_path(document_id):
+    """Ruta del archivo original del documento."""
+    ruta = _document_dir(document_id)
+    for nombre in os.listdir(ruta):
+        if nombre.startswith("source"):
+            return os.path.join(ruta, nombre)
+    raise DocumentNotFound(document_id)
+
+
+def _extract(document_id, pipeline, extractor):
+    """Extrae el texto del documento y lo guarda (o guarda el error)."""
+    ruta = _document_dir(document_id)
+    try:
+        with metrics.stage(pipeline, "extract"):
+            text = extractor(source_path(document_id))
+        _write_atomic(os.path.join(ruta, f"{pipeline}.txt"), text)
+        print(f"Documento {document_id} extraído para {pipeline}: {len(text)} caracteres")
+        return text
+    except Exception as e:
+        _write_atomic(os.path.join(ruta, f"{pipeline}.error"), str(e))
+        print(f"Error extrayendo el documento {document_id} para {pipeline}: {e}")
+        raise
+
+
+def start_extraction(document_id, pipeline, extractor):
+    """Lanza la extracción en segundo plano (no espera a que termine)."""
+    ruta = _document_dir(document_id)
+    _write_atomic(os.path.join(ruta, f"{pipeline}.started"), f"{os.getpid()} {time.time()}")
+    _get_executor().submit(_extract_quietly, document_id, pipeline, extractor)
+
+
+def _extract_quietly(document_id, pipeline, extractor):
+    # El error queda guardado en <pipeline>.error; get_text lo relanza
+    try:
+        _extract(document_id, pipeline, extractor)
+    except Exception:
+        pass
+
+
+def status(document_id, pipeline):
+    """Estado de la extracción: processing, ready o error (con el mensaje si lo hay)."""
+    ruta = _document_dir(document_id)
+    texto = os.path.join(ruta, f"{pipeline}.txt")
+    if os.path.exists(texto):
+        return {"status": STATUS_READY, "characters": os.path.getsize(texto)}
+    error = os.path.join(ruta, f"{pipeline}.error")
+    if os.path.exists(error):
+        with open(error, encoding="utf-8") as f:
+            return {"status": STATUS_ERROR, "message": f.read()}
+    return {"status": STATUS_PROCESSING}
+
+
+def _extraction_owner(started_path):
+    """PID del proceso que está extrayendo, o None si no hay extracción en curso."""
+    try:
+        with open(started_path, encoding="utf-8") as f:
+            return int(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def get_text(document_id, pipeline, extractor, timeout=None):
+    """
+    Texto extraído del documento. Espera una extracción en curso hasta `timeout`
+    segundos (sin pasar del plazo de la petición) mientras el proceso que extrae siga
+    vivo; si no hay extracción, murió o no termina a tiempo, extrae aquí mismo.
+    Lanza DocumentNotFound si el documento no existe, cancellation.JobCancelled si el
+    cliente cancela durante la espera y relanza el error de extracción.
+    """
+    timeout = DOCUMENT_WAIT_SECONDS if timeout is None else timeout
+    plazo = deadline.current()
+    if plazo is not None:
+        timeout = min(timeout, plazo.llm_budget())
+    ruta = _document_dir(document_id)
+    texto = os.path.join(ruta, f"{pipeline}.txt")
+    error = os.path.join(ruta, f"{pipeline}.error")
+    propietario = _extraction_owner(os.path.join(ruta, f"{pipeline}.started"))
+
+    listo = os.path.exists(texto)
+    metrics.record_cache("document_text", listo)
+    if not listo and propietario is not None:
+        with metrics.stage(pipeline, "extract_wait"):
+            limite = time.monotonic() + timeout
+            while not os.path.exists(texto) and not os.path.exists(error) and time.monotonic() < limite:
+                cancellation.check()
+                # Worker reciclado o muerto: su extracción no va a terminar
+                if not _pid_alive(propietario):
+                    print(f"La extracción de {document_id} para {pipeline} se interrumpió; se extrae de nuevo")
+                    break
+                time.sleep(_POLL_INTERVAL)
+
+    if os.path.exists(texto):
+        with open(texto, encoding="utf-8") as f:
+            return f.read()
+    if os.path.exists(error):
+        with open(error, encoding="utf-8") as f:
+            raise ValueError(f.read())
+    return _extract(document_id, pipeline, extractor)
+
+
+def _cleanup_expired():
+    """Borra documentos más antiguos que DOCUMENT_TTL y libera su cuota (se llama de forma oportunista)."""
+    ahora = time.time()
+    try:
+        nombres = os.listdir(DOCUMENT_DIR)
+    except OSError:
+        return
+    borrados = []
+    for nombre in nombres:
+        ruta = os.path.join(DOCUMENT_DIR, nombre)
+        try:
+            if ahora - os.path.getmtime(ruta) > DOCUMENT_TTL:
+                shutil.rmtree(ruta, ignore_errors=True)
+                borrados.append(nombre)
+        except OSError:
+            pass
+    conn = _connect()
+    try:
+        conn.executemany("DELETE FROM documents WHERE id = ?", [(nombre,) for nombre in borrados])
+        # Reservas cuyo directorio ya no existe (borrado a mano o por otro worker); las recientes
+        # se respetan porque la reserva se registra antes de crear el directorio
+        huerfanos = [fila[0] for fila in conn.execute(
+            "SELECT id FROM documents WHERE created < ?", (ahora - _RESERVATION_GRACE,))
+            if not os.path.isdir(os.path.join(DOCUMENT_DIR, fila[0]))]
+        conn.executemany("DELETE FROM documents WHERE id = ?", [(document_id,) for document_id in huerfanos])
+    finally:
+        conn.close()
@@ -0,0 +1,112 @@
+"""
+Extracción de texto de DOCX en streaming.
+
+Lee word/document.xml directamente del ZIP con lxml.iterparse y emite los
+párrafos y las celdas de tabla en el orden en que aparecen en el cuerpo del
+documento. Cada bloque se libera en cuanto se emite, así que la memoria no
+crece con el tamaño del documento (python-docx carga el árbol completo).
+
+El orden importa: generar_matriz_test divide el texto por los encabezados
+"HISTORIA #n:", y una tabla de requerimientos debe quedar bajo la historia
+en la que aparece, no al final del texto.
+
+El texto de cada párrafo se arma igual que Paragraph.text de python-docx
+(w:t, tabulaciones, saltos de línea y guiones de no separación de las
+ejecuciones y los hipervínculos). Las celdas combinadas se emiten una sola vez.
+
+Qué se emite es lo mismo que veía el extractor anterior con python-docx
+(doc.paragraphs y las celdas de doc.tables):
+
+    - párrafos hijos directos de w:body
+    - celdas de tablas hijas directas de w:body, con sus párrafos directos
+    - nada de lo que está dentro de cuadros de texto (w:txbxContent, que
+      cuelgan de una ejecución del párrafo ancla) ni de controles de
+      contenido de bloque (w:sdt/w:sdtContent), ni tablas anidadas
+"""
+import zipfile
+
+from lxml import etree
+
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_BODY = _W + "body"
+_P = _W + "p"
+_TC = _W + "tc"
+_TBL = _W + "tbl"
+_TR = _W + "tr"
+_SDT = _W + "sdt"
+_R = _W + "r"
+_HYPERLINK = _W + "hyperlink"
+_T = _W + "t"
+_TAB = _W + "tab"
+_PTAB = _W + "ptab"
+_BR = _W + "br"
+_CR = _W + "cr"
+_NO_BREAK_HYPHEN = _W + "noBreakHyphen"
+_TYPE = _W + "type"
+
+
+def _run_text(run):
+    partes = []
+    for e in run:
+        if e.tag == _T:
+            partes.append(e.text or "")
+        elif e.tag in (_TAB, _PTAB):
+            partes.append("\t")
+        elif e.tag == _CR or (e.tag == _BR and e.get(_TYPE, "textWrapping") == "textWrapping"):
+            partes.append("\n")
+        elif e.tag == _NO_BREAK_HYPHEN:
+            partes.append("-")
+    return "".join(partes)
+
+
+def paragraph_text(p):
+    """Texto de un w:p (mismo resultado que Paragraph.text de python-docx)."""
+    partes = []
+    for hijo in p:
+        if hijo.tag == _R:
+            partes.append(_run_text(hijo))
+        elif hijo.tag == _HYPERLINK:
+            partes.extend(_run_text(run) for run in hijo.iterchildren(_R))
+    return "".join(partes)
+
+
+def iter_docx_blocks(file_path, tables=True, skip_empty=True):
+    """
+    Genera el texto de cada párrafo y cada celda de tabla en orden del cuerpo.
+    Con tables=False solo se emiten los párrafos del cuerpo (como doc.paragraphs).
+    """
+    with zipfile.ZipFile(file_path) as paquete, paquete.open("word/document.xml") as xml:
+        for _, elem in etree.iterparse(xml, events=("end",), tag=(_P, _TC, _TBL, _SDT)):
+            padre = elem.getparent()
+            # Un w:p dentro de un cuadro de texto o de un control de contenido termina antes que
+            # su ancla: por eso se mira el contenedor inmediato y no solo si hay una tabla encima
+            if elem.tag == _P and padre.tag == _BODY:
+                texto = paragraph_text(elem)
+                if texto.strip() or not skip_empty:
+                    yield texto
+            elif elem.tag == _TC and tables and _body_table_cell(elem):
+                # Los párrafos de una celda se emiten juntos al cerrar la celda
+                texto = "\n".join(paragraph_text(p) for p in elem.iterchildren(_P))
+                if texto.strip():
+                    yield texto
+
+            if padre.tag == _BODY:
+                # Bloque de primer nivel ya procesado: se libera junto con los anteriores
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del padre[0]
+
+
+def _body_table_cell(tc):
+    """Indica si la celda es de una tabla de primer nivel (w:body/w:tbl/w:tr/w:tc)."""
+    fila = tc.getparent()
+    if fila is None or fila.tag != _TR:
+        return False
+    tabla = fila.getparent()
+    return tabla is not None and tabla.tag == _TBL and tabla.getparent() is not None \
+        and tabla.getparent().tag == _BODY
+
+
+def extract_docx_text(file_path, tables=True, skip_empty=True):
+    """Texto del DOCX con un bloque (párrafo o celda) por línea, en orden del documento."""
+    return "\n".join(iter_docx_blocks(file_path, tables=tables, skip_empty=skip_empty))
@@ -0,0 +1,43 @@
+"""
+Configuración de gunicorn.
+
+Prepara el directorio compartido de métricas de prometheus_client para que
+/metrics agregue los valores de todos los workers.
+
+Las peticiones pasan casi todo su tiempo esperando al LLM, y esas llamadas se
+multiplexan en el event loop de cada proceso (ver llm_client). Por eso se usan
+workers gthread: pocos procesos, cada uno con muchos hilos baratos que solo
+esperan resultados del loop.
+
+El parseo de documentos no corre en los workers sino en procesos hijos de
+cada worker con límites de CPU y memoria (ver parse_pool).
+"""
+import os
+import shutil
+import tempfile
+
+worker_class = "gthread"
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+threads = int(os.getenv("GUNICORN_THREADS", "32"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "300"))
+
+# Debe definirse antes de que los workers importen prometheus_client
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "nexus_prometheus"))
+
+
+def on_starting(server):
+    # Limpiar métricas de ejecuciones anteriores
+    directorio = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(directorio, ignore_errors=True)
+    os.makedirs(directorio, exist_ok=True)
+
+
+def post_worker_init(worker):
+    # Procesos de parseo lanzados por adelantado en cada worker (ver parse_pool)
+    import parse_pool
+    parse_pool.warm()
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,293 @@
+"""
+Snapshot binario del conocimiento del chat (texto + índice de búsqueda).
+
+Extraer el texto del PPTX con python-pptx cuesta en cada worker al arrancar,
+y cualquier índice de recuperación tendría que reconstruirse también en cada
+uno. El snapshot se construye una sola vez (tools/build_knowledge_snapshot.py
+o, si falta, el primer worker que arranca) y los workers lo abren con mmap:
+los arreglos del índice son vistas de NumPy sobre el archivo mapeado, así que
+la carga no copia nada y todos los workers comparten las mismas páginas
+físicas. Tampoco el texto se copia al heap de cada worker: text y passage()
+lo decodifican del archivo mapeado cada vez que se piden.
+
+El chat no manda el conocimiento completo en cada prompt: search() devuelve
+las KNOWLEDGE_PASSAGES diapositivas más parecidas a la pregunta y solo esas
+van al LLM.
+
+Formato (little-endian):
+
+    b"NXKS" | versión (u32) | largo del encabezado (u32) | encabezado JSON
+    secciones alineadas a 8 bytes, descritas en el encabezado como
+    {nombre: [offset, largo en bytes, dtype]}
+
+    text              texto completo de la presentación
+    passages          texto de cada diapositiva, concatenado (UTF-8)
+    passage_offsets   int64, límites de cada diapositiva dentro de passages
+    terms             términos del índice ordenados, separados por "\\n"
+    postings_ptr      int64, inicio de la lista de cada término
+    postings_doc      int32, diapositiva de cada entrada
+    postings_weight   float32, peso TF-IDF normalizado de cada entrada
+    idf               float32, IDF de cada término
+
+El encabezado guarda el SHA-256 del PPTX: si el PPTX cambió, el snapshot
+está obsoleto y se reconstruye desde el PPTX. También guarda su tamaño y
+mtime: si coinciden con los del PPTX actual no se vuelve a calcular el hash,
+así abrir el snapshot al arrancar no lee el PPTX entero.
+
+Por defecto el snapshot va al directorio temporal (nexus_knowledge/), no
+junto al PPTX, para no dejar archivos generados en el árbol de la app.
+
+Configuración:
+    KNOWLEDGE_SNAPSHOT    ruta del snapshot (por defecto, en el temporal del sistema según la ruta del PPTX)
+    KNOWLEDGE_PASSAGES    diapositivas que devuelve una búsqueda (las que van al prompt del chat)
+"""
+import bisect
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from datetime import datetime
+
+import numpy as np
+from pptx import Presentation
+
+import coverage_gaps
+
+KNOWLEDGE_PASSAGES = int(os.getenv("KNOWLEDGE_PASSAGES", "4"))
+
+MAGIC = b"NXKS"
+VERSION = 1
+_PREFIJO = struct.Struct("<4sII")
+_ALINEACION = 8
+
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+
+class StaleSnapshot(Exception):
+    """El snapshot no existe, es de otra versión o no corresponde al PPTX actual."""
+
+
+def snapshot_path(source):
+    if os.getenv("KNOWLEDGE_SNAPSHOT"):
+        return os.getenv("KNOWLEDGE_SNAPSHOT")
+    # Un snapshot por PPTX: el nombre lleva un resumen de la ruta absoluta
+    ruta = hashlib.sha256(os.path.abspath(source).encode("utf-8")).hexdigest()[:12]
+    nombre = f"{os.path.splitext(os.path.basename(source))[0]}-{ruta}.knowledge"
+    return os.path.join(tempfile.gettempdir(), "nexus_knowledge", nombre)
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for bloque in iter(lambda: f.read(1 << 20), b""):
+            digest.update(bloque)
+    return digest.hexdigest()
+
+
+def _matches_source(header, source):
+    """Indica si el snapshot corresponde al PPTX: por tamaño y mtime y, si no coinciden, por SHA-256."""
+    estado = os.stat(source)
+    if header.get("source_size") == estado.st_size and header.get("source_mtime_ns") == estado.st_mtime_ns:
+        return True
+    return header["source_sha256"] == _sha256(source)
+
+
+def extract_slides(source):
+    """Texto de cada diapositiva: el texto de cada forma seguido de un espacio."""
+    prs = Presentation(source)
+    return ["".join(shape.text + " " for shape in slide.shapes if hasattr(shape, "text"))
+            for slide in prs.slides]
+
+
+def _build_index(slides):
+    """Índice invertido TF-IDF por diapositiva (los mismos pesos que case_library)."""
+    tokens_list = [coverage_gaps.tokenize(texto) for texto in slides]
+    n = len(tokens_list)
+    df = {}
+    for tokens in tokens_list:
+        for token in set(tokens):
+            df[token] = df.get(token, 0) + 1
+    terms = sorted(df)
+    idf = np.array([np.log((1 + n) / (1 + df[t])) + 1 for t in terms], dtype=np.float32)
+    posicion = {t: i for i, t in enumerate(terms)}
+
+    entradas = [[] for _ in terms]
+    for doc, tokens in enumerate(tokens_list):
+        conteo = {}
+        for token in tokens:
+            conteo[token] = conteo.get(token, 0) + 1
+        pesos = {token: np.log1p(c) * idf[posicion[token]] for token, c in conteo.items()}
+        norma = np.sqrt(sum(p * p for p in pesos.values())) or 1.0
+        for token, peso in pesos.items():
+            entradas[posicion[token]].append((doc, peso / norma))
+
+    ptr = np.zeros(len(terms) + 1, dtype=np.int64)
+    ptr[1:] = np.cumsum([len(e) for e in entradas])
+    docs = np.array([d for e in entradas for d, _ in e], dtype=np.int32)
+    weights = np.array([w for e in entradas for _, w in e], dtype=np.float32)
+    return terms, idf, ptr, docs, weights
+
+
+def build(source, destination=None):
+    """Construye el snapshot del PPTX (escritura atómica) y devuelve su ruta."""
+    destination = destination or snapshot_path(source)
+    slides = extract_slides(source)
+    terms, idf, ptr, docs, weights = _build_index(slides)
+
+    codificadas = [s.encode("utf-8") for s in slides]
+    offsets = np.zeros(len(codificadas) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(c) for c in codificadas])
+    secciones = {
+        "text": np.frombuffer("".join(slides).strip().encode("utf-8"), dtype=np.uint8),
+        "passages": np.frombuffer(b"".join(codificadas), dtype=np.uint8),
+        "passage_offsets": offsets,
+        "terms": np.frombuffer("\n".join(terms).encode("utf-8"), dtype=np.uint8),
+        "postings_ptr": ptr,
+        "postings_doc": docs,
+        "postings_weight": weights,
+        "idf": idf,
+    }
+
+    # El estado se toma antes del hash: si el PPTX cambia mientras tanto, el mtime ya no coincide
+    estado = os.stat(source)
+    encabezado = {
+        "source": os.path.basename(source),
+        "source_size": estado.st_size,
+        "source_mtime_ns": estado.st_mtime_ns,
+        "source_sha256": _sha256(source),
+        "built": datetime.now().isoformat(timespec="seconds"),
+        "passages": len(slides),
+        "terms": len(terms),
+        "sections": {}
+    }
+    # Los offsets dependen del largo del encabezado: se reserva espacio y se ajusta al final
+    reserva = len(json.dumps(encabezado)) + 128 * len(secciones)
+    offset = _align(_PREFIJO.size + reserva)
+    for nombre, arreglo in secciones.items():
+        encabezado["sections"][nombre] = [offset, arreglo.nbytes, arreglo.dtype.str]
+        offset = _align(offset + arreglo.nbytes)
+    datos_encabezado = json.dumps(encabezado).encode("utf-8").ljust(reserva)
+
+    os.makedirs(os.path.dirname(destination) or ".", exist_ok=True)
+    temporal = f"{destination}.{os.getpid()}.tmp"
+    with open(temporal, "wb") as f:
+        f.write(_PREFIJO.pack(MAGIC, VERSION, len(datos_encabezado)))
+        f.write(datos_encabezado)
+        for nombre, arreglo in secciones.items():
+            f.seek(encabezado["sections"][nombre][0])
+            f.write(arreglo.tobytes())
+    os.replace(temporal, destination)
+    return destination
+
+
+def _align(offset):
+    return (offset + _ALINEACION - 1) // _ALINEACION * _ALINEACION
+
+
+def _view(buffer, offset, largo, dtype):
+    """Arreglo de solo lectura sobre el buffer mapeado (sin copiar)."""
+    if not largo:
+        return np.empty(0, dtype=dtype)
+    return np.frombuffer(buffer, dtype=dtype, count=largo // dtype.itemsize, offset=offset)
+
+
+class KnowledgeSnapshot:
+    """Snapshot abierto con mmap; los arreglos del índice apuntan directo al archivo."""
+
+    def __init__(self, path, source=None):
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, largo = _PREFIJO.unpack_from(self._mmap, 0)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError("formato o versión distintos")
+            self.header = json.loads(bytes(self._mmap[_PREFIJO.size:_PREFIJO.size + largo]))
+        except (struct.error, ValueError) as e:
+            self._mmap.close()
+            raise StaleSnapshot(f"{path}: {e}")
+        if source is not None and not _matches_source(self.header, source):
+            self._mmap.close()
+            raise StaleSnapshot(f"{path}: no corresponde a {os.path.basename(source)}")
+
+        self.path = path
+        self._sections = {nombre: _view(self._mmap, offset, largo, np.dtype(dtype))
+                          for nombre, (offset, largo, dtype) in self.header["sections"].items()}
+        self._terms = None
+
+    @property
+    def text(self):
+        """Texto completo, decodificado del mmap en cada acceso (no se guarda en el proceso)."""
+        return self._sections["text"].tobytes().decode("utf-8")
+
+    def __len__(self):
+        return self.header["passages"]
+
+    def passage(self, i):
+        offsets = self._sections["passage_offsets"]
+        return self._sections["passages"][offsets[i]:offsets[i + 1]].tobytes().decode("utf-8")
+
+    def _term_id(self, token):
+        if self._terms is None:
+            # Se decodifican al primer uso: el arranque solo lee el encabezado
+            self._terms = self._sections["terms"].tobytes().decode("utf-8").split("\n")
+        i = bisect.bisect_left(self._terms, token)
+        return i if i < len(self._terms) and self._terms[i] == token else -1
+
+    def search(self, query, k=KNOWLEDGE_PASSAGES):
+        """Las k diapositivas más parecidas a la consulta: lista de (similitud, texto)."""
+        conteo = {}
+        for token in coverage_gaps.tokenize(query):
+            conteo[token] = conteo.get(token, 0) + 1
+        if not conteo or not len(self):
+            return []
+        idf, ptr = self._sections["idf"], self._sections["postings_ptr"]
+        docs, weights = self._sections["postings_doc"], self._sections["postings_weight"]
+        # Términos fuera del índice cuentan en la norma de la consulta con el IDF máximo
+        idf_nuevo = float(np.log(1 + len(self)) + 1)
+        pesos = []
+        for token, c in conteo.items():
+            t = self._term_id(token)
+            pesos.append((t, np.log1p(c) * (idf[t] if t >= 0 else idf_nuevo)))
+        norma = np.sqrt(sum(p * p for _, p in pesos)) or 1.0
+
+        puntajes = np.zeros(len(self), dtype=np.float32)
+        for t, peso in pesos:
+            if t >= 0:
+                inicio, fin = ptr[t], ptr[t + 1]
+                puntajes[docs[inicio:fin]] += (peso / norma) * weights[inicio:fin]
+        mejores = np.argsort(-puntajes, kind="stable")[:k]
+        return [(float(puntajes[i]), self.passage(int(i))) for i in mejores if puntajes[i] > 0]
+
+
+def load(source):
+    """
+    Snapshot del PPTX `source` (uno por proceso). Si falta o está obsoleto se
+    reconstruye desde el PPTX; si no se puede escribir, se usa uno temporal en memoria.
+    """
+    with _snapshots_lock:
+        snapshot = _snapshots.get(source)
+        if snapshot is not None:
+            return snapshot
+        ruta = snapshot_path(source)
+        try:
+            snapshot = KnowledgeSnapshot(ruta, source)
+        except (OSError, ValueError, StaleSnapshot) as e:
+            print(f"Snapshot de conocimiento no disponible ({e}); reconstruyendo desde el PPTX")
+            try:
+                snapshot = KnowledgeSnapshot(build(source, ruta))
+            except OSError as e:
+                # Directorio de solo lectura: se construye en el temporal del proceso
+                print(f"⚠️ No se pudo guardar el snapshot en {ruta}: {e}")
+                temporal = os.path.join(tempfile.gettempdir(), f"nexus_knowledge_{os.getpid()}.knowledge")
+                snapshot = KnowledgeSnapshot(build(source, temporal))
+        _snapshots[source] = snapshot
+        return snapshot
+
+
+def get(source):
+    """Snapshot ya cargado del PPTX, o None."""
+    return _snapshots.get(source)
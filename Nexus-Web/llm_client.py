@@ -0,0 +1,245 @@
+"""
+Punto único de llamada al LLM.
+
+Todas las llamadas a generate_content de los backends pasan por aquí para
+medir latencia, errores y timeouts por etapa.
+
+Las llamadas son asíncronas (generate_content_async) y se ejecutan en un único
+event loop por proceso que corre en un hilo dedicado. Así un worker mantiene
+muchas generaciones en vuelo a la vez y el canal gRPC asíncrono del SDK queda
+ligado siempre al mismo loop. El código síncrono (vistas de Flask) entrega las
+corrutinas al loop con run() y espera el resultado.
+
+Cada llamada espera cuota (rate_governor) y un hueco del limitador adaptativo
+(adaptive_limiter) concedido por el planificador de prioridades (llm_scheduler),
+y se reintenta con backoff exponencial con jitter según la clase de error.
+Si el cliente cancela el trabajo (cancellation), la llamada se aborta tanto en
+cola como en vuelo. Si la petición tiene un plazo (deadline), el timeout de
+cada intento se ajusta al tiempo que queda y no se inician llamadas sin
+presupuesto. El modelo de cada llamada lo elige model_router según la etapa y
+el tamaño del prompt.
+
+Con GEMINI_API_ENDPOINT las llamadas van a otro servidor compatible (por
+ejemplo tools/mock_gemini.py en las pruebas de carga) en lugar de la API de
+Google.
+"""
+import asyncio
+import os
+import random
+import threading
+import time
+
+import google.generativeai as genai
+
+import cancellation
+import deadline
+import llm_scheduler
+import metrics
+import model_router
+import rate_governor
+from adaptive_limiter import AdaptiveLimiter
+
+# Etapas conocidas (se usan como etiqueta en las métricas)
+STAGE_STORY_ANALYSIS = "story_analysis"
+STAGE_STORY_BATCH = "story_batch"
+STAGE_STORY_CHUNK = "story_chunk"
+STAGE_MATRIX_CHUNK = "matrix_chunk"
+STAGE_CHAT = "chat"
+STAGE_CHAT_SUMMARY = "chat_summary"
+
+# Servidor alternativo de la API (host:puerto); vacío = API de Google
+GEMINI_API_ENDPOINT = os.getenv("GEMINI_API_ENDPOINT", "")
+
+# Reintentos ante errores transitorios y parámetros del backoff (segundos)
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "1.0"))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "30.0"))
+
+# Clases de error
+ERROR_THROTTLE = "throttle"
+ERROR_TIMEOUT = "timeout"
+ERROR_RETRYABLE = "retryable"
+ERROR_FATAL = "fatal"
+
+limiter = AdaptiveLimiter.from_env()
+scheduler = llm_scheduler.LLMScheduler(limiter)
+
+_loop = None
+_loop_pid = None
+_loop_lock = threading.Lock()
+
+
+def configure(api_key):
+    """Configura el SDK con la API key y, si está definido, con GEMINI_API_ENDPOINT."""
+    if GEMINI_API_ENDPOINT:
+        genai.configure(api_key=api_key, client_options={"api_endpoint": GEMINI_API_ENDPOINT})
+    else:
+        genai.configure(api_key=api_key)
+
+
+def get_loop():
+    """Devuelve el event loop del proceso, creándolo (también tras un fork) si hace falta."""
+    global _loop, _loop_pid
+    with _loop_lock:
+        if _loop is None or _loop_pid != os.getpid():
+            _loop = asyncio.new_event_loop()
+            _loop_pid = os.getpid()
+            threading.Thread(target=_loop.run_forever, name="llm-event-loop", daemon=True).start()
+        return _loop
+
+
+def run(coro):
+    """
+    Ejecuta una corrutina en el event loop compartido y bloquea hasta obtener su resultado.
+    No debe llamarse desde el propio loop (usar await en ese caso).
+    """
+    loop = get_loop()
+    try:
+        en_loop = asyncio.get_running_loop() is loop
+    except RuntimeError:
+        en_loop = False
+    if en_loop:
+        coro.close()
+        raise RuntimeError("llm_client.run() no puede usarse dentro del event loop; usa await.")
+    # run_coroutine_threadsafe copia los contextvars del hilo que llama
+    return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+
+def is_timeout_error(error):
+    """Indica si la excepción corresponde a un timeout de la llamada."""
+    if isinstance(error, (TimeoutError, asyncio.TimeoutError)) or \
+            type(error).__name__ in ("DeadlineExceeded", "Timeout", "ReadTimeout"):
+        return True
+    mensaje = str(error).lower()
+    return "deadline" in mensaje or "timed out" in mensaje or "timeout" in mensaje
+
+
+def classify_error(error):
+    """Clasifica un error del LLM: throttle, timeout, retryable o fatal."""
+    nombre = type(error).__name__
+    # Las excepciones de google.api_core exponen el código HTTP en .code
+    codigo = getattr(error, "code", None)
+    mensaje = str(error).lower()
+    if codigo in (429, 503) or nombre in ("ResourceExhausted", "TooManyRequests", "ServiceUnavailable") or \
+            "quota" in mensaje or "rate limit" in mensaje or "overloaded" in mensaje:
+        return ERROR_THROTTLE
+    if is_timeout_error(error):
+        return ERROR_TIMEOUT
+    if codigo in (500, 502) or nombre in ("InternalServerError", "ServerError", "BadGateway", "Aborted", "Unknown",
+                                          "ConnectionError", "ConnectionResetError"):
+        return ERROR_RETRYABLE
+    return ERROR_FATAL
+
+
+def backoff_delay(intento):
+    """Backoff exponencial con jitter completo."""
+    return random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** intento))
+
+
+async def generate_content_async(model, prompt, stage, **kwargs):
+    """
+    Llama a model.generate_content_async registrando métricas de la etapa.
+    Cada intento espera cuota (RPM/TPM) y un hueco del limitador adaptativo según
+    la prioridad de la petición; los errores de throttling, timeout o transitorios
+    se reintentan con backoff. Lanza cancellation.JobCancelled si el trabajo de la
+    petición actual se cancela mientras tanto, y deadline.DeadlineExceeded si se
+    agota el plazo de la petición.
+    """
+    model = model_router.route(model, stage, prompt)
+    plazo = deadline.current()
+    coro = _generate_with_retries(model, prompt, stage, plazo, **kwargs)
+    if plazo is not None:
+        coro = _within_deadline(coro, plazo, stage)
+    return await cancellation.run_cancellable(coro, stage)
+
+
+async def _within_deadline(coro, plazo, stage):
+    """Limita la llamada completa (cuota, cola, intentos y esperas) al presupuesto del plazo."""
+    try:
+        plazo.check()
+        return await asyncio.wait_for(coro, plazo.llm_budget())
+    except asyncio.TimeoutError:
+        if not plazo.exhausted:
+            # Timeout de la propia llamada, no del plazo
+            raise
+        metrics.LLM_DEADLINE_SKIPPED.labels(stage).inc()
+        raise deadline.DeadlineExceeded(f"Plazo de la petición agotado durante la llamada al LLM ({stage})")
+    except deadline.DeadlineExceeded:
+        metrics.LLM_DEADLINE_SKIPPED.labels(stage).inc()
+        raise
+    finally:
+        # Si plazo.check() falló la corrutina nunca se inició
+        coro.close()
+
+
+async def _generate_with_retries(model, prompt, stage, plazo=None, **kwargs):
+    prioridad, usuario = llm_scheduler.current_context()
+    costo = rate_governor.estimate_tokens(prompt) / 1000
+    for intento in range(LLM_MAX_RETRIES + 1):
+        await rate_governor.acquire(prompt)
+        async with scheduler.slot(prioridad, usuario, costo):
+            if plazo is not None:
+                # El timeout del intento no puede pasar del tiempo que le queda a la petición
+                plazo.check()
+                opciones = dict(kwargs.get("request_options") or {})
+                opciones["timeout"] = plazo.call_timeout(opciones.get("timeout"))
+                kwargs["request_options"] = opciones
+            try:
+                response = await _call_model(model, prompt, stage, **kwargs)
+            except Exception as e:
+                if plazo is not None and plazo.exhausted:
+                    # Timeout recortado por el plazo: no es señal de saturación ni vale la pena reintentar
+                    raise deadline.DeadlineExceeded(f"Plazo de la petición agotado en la llamada al LLM ({stage})") from e
+                clase = classify_error(e)
+                if clase == ERROR_FATAL or intento == LLM_MAX_RETRIES:
+                    raise
+                if clase in (ERROR_THROTTLE, ERROR_TIMEOUT):
+                    limiter.on_throttle()
+                espera = backoff_delay(intento)
+                metrics.LLM_BACKOFFS.labels(stage, clase).inc()
+                print(f"⚠️ Error {clase} en llamada al LLM ({stage}), reintento {intento + 1}/{LLM_MAX_RETRIES} "
+                      f"en {espera:.1f}s: {e}")
+            else:
+                limiter.on_success()
+                return response
+        # La espera se hace fuera del limitador para no ocupar un hueco
+        await asyncio.sleep(espera)
+
+
+async def _call_model(model, prompt, stage, **kwargs):
+    """Una única llamada al modelo, con métricas de latencia, en vuelo y resultado (por etapa y por modelo)."""
+    metrics.LLM_IN_FLIGHT.labels(stage).inc()
+    inicio = time.perf_counter()
+    outcome = "ok"
+    try:
+        response = await model.generate_content_async(prompt, **kwargs)
+        model_router.record_usage(stage, model, prompt, response)
+        return response
+    except asyncio.CancelledError:
+        outcome = "cancelled"
+        raise
+    except Exception as e:
+        outcome = "timeout" if is_timeout_error(e) else "error"
+        raise
+    finally:
+        duracion = time.perf_counter() - inicio
+        nombre = model_router.model_name(model)
+        metrics.LLM_IN_FLIGHT.labels(stage).dec()
+        metrics.LLM_LATENCY.labels(stage).observe(duracion)
+        metrics.LLM_CALLS.labels(stage, outcome).inc()
+        metrics.LLM_ROUTE_LATENCY.labels(stage, nombre).observe(duracion)
+        metrics.LLM_ROUTE_CALLS.labels(stage, nombre, outcome).inc()
+
+
+async def _scheduler_stats():
+    return scheduler.get_stats()
+
+
+def get_scheduler_stats():
+    """Estadísticas del planificador (se leen dentro del loop para no competir con él)."""
+    return run(_scheduler_stats())
+
+
+def generate_content(model, prompt, stage, **kwargs):
+    """Versión síncrona de generate_content_async (ejecuta la llamada en el loop compartido)."""
+    return run(generate_content_async(model, prompt, stage, **kwargs))
@@ -0,0 +1,143 @@
+"""
+Planificador de llamadas al LLM con clases de prioridad y reparto justo por usuario.
+
+Todas las llamadas de un proceso compiten por los huecos del limitador
+adaptativo. Cuando se libera un hueco se atiende primero la clase de mayor
+prioridad (chat interactivo > vista previa > generación masiva) y, dentro de
+cada clase, se aplica weighted fair queuing entre usuarios: cada llamada
+recibe una etiqueta de tiempo virtual proporcional a su coste (tokens
+estimados), de modo que un usuario con una matriz de 40 fragmentos no acapara
+los huecos frente a otro que acaba de llegar.
+
+Además, la generación masiva nunca ocupa los últimos LLM_INTERACTIVE_RESERVE
+huecos, para que el chat no tenga que esperar a que terminen llamadas largas.
+
+La clase y el usuario de la petición actual viajan en un contextvar
+(request_context), que llm_client.run() propaga al event loop.
+"""
+import asyncio
+import contextvars
+import heapq
+import itertools
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+import metrics
+
+# Clases de prioridad (menor valor = mayor prioridad)
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_PREVIEW = "preview"
+PRIORITY_BULK = "bulk"
+PRIORITY_CLASSES = (PRIORITY_INTERACTIVE, PRIORITY_PREVIEW, PRIORITY_BULK)
+
+INTERACTIVE_RESERVE = int(os.getenv("LLM_INTERACTIVE_RESERVE", "1"))
+
+_request_context = contextvars.ContextVar("llm_request_context", default=(PRIORITY_BULK, "anonimo"))
+
+
+@contextmanager
+def request_context(priority, user):
+    """Fija la clase de prioridad y el usuario de las llamadas al LLM hechas dentro del bloque."""
+    token = _request_context.set((priority, user or "anonimo"))
+    try:
+        yield
+    finally:
+        _request_context.reset(token)
+
+
+def set_request_context(priority, user):
+    """Versión sin bloque de request_context; devuelve el token para reset_request_context."""
+    return _request_context.set((priority, user or "anonimo"))
+
+
+def reset_request_context(token):
+    _request_context.reset(token)
+
+
+def current_context():
+    return _request_context.get()
+
+
+class LLMScheduler:
+    def __init__(self, limiter, interactive_reserve=INTERACTIVE_RESERVE):
+        self.limiter = limiter
+        self.interactive_reserve = interactive_reserve
+        self._queues = {clase: [] for clase in PRIORITY_CLASSES}
+        self._virtual_time = {clase: 0.0 for clase in PRIORITY_CLASSES}
+        self._last_finish = {clase: {} for clase in PRIORITY_CLASSES}
+        self._seq = itertools.count()
+        # Últimas esperas por clase, para estadísticas rápidas en /health
+        self._recent_waits = {clase: deque(maxlen=500) for clase in PRIORITY_CLASSES}
+
+    @asynccontextmanager
+    async def slot(self, priority, user, cost=1.0):
+        """Espera un hueco del limitador según prioridad y reparto justo, y lo libera al salir."""
+        if priority not in self._queues:
+            priority = PRIORITY_BULK
+        future = asyncio.get_running_loop().create_future()
+        ultimo_fin = self._last_finish[priority]
+        etiqueta = max(self._virtual_time[priority], ultimo_fin.get(user, 0.0)) + cost
+        ultimo_fin[user] = etiqueta
+        heapq.heappush(self._queues[priority], (etiqueta, next(self._seq), future))
+        metrics.LLM_QUEUE_DEPTH.labels(priority).inc()
+
+        inicio = time.monotonic()
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # El hueco se concedió justo antes de la cancelación: devolverlo
+                self._release()
+            else:
+                future.cancel()
+                metrics.LLM_QUEUE_DEPTH.labels(priority).dec()
+            raise
+
+        espera = time.monotonic() - inicio
+        metrics.LLM_QUEUE_WAIT.labels(priority).observe(espera)
+        self._recent_waits[priority].append(espera)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _release(self):
+        self.limiter.release()
+        self._dispatch()
+
+    def _dispatch(self):
+        """Concede huecos libres a los primeros de la cola de mayor prioridad."""
+        for priority in PRIORITY_CLASSES:
+            queue = self._queues[priority]
+            reserve = self.interactive_reserve if priority == PRIORITY_BULK else 0
+            while queue:
+                etiqueta, _, future = queue[0]
+                if future.cancelled():
+                    heapq.heappop(queue)
+                    continue
+                if not self.limiter.try_acquire(reserve):
+                    break
+                heapq.heappop(queue)
+                metrics.LLM_QUEUE_DEPTH.labels(priority).dec()
+                self._virtual_time[priority] = etiqueta
+                future.set_result(None)
+            if not queue:
+                # Sin esperas pendientes no hace falta recordar el historial de los usuarios
+                self._last_finish[priority].clear()
+
+    def get_stats(self):
+        """Longitud de cola y percentiles recientes de espera por clase."""
+        stats = {}
+        for priority in PRIORITY_CLASSES:
+            esperas = sorted(self._recent_waits[priority])
+            stats[priority] = {
+                "queued": sum(1 for _, _, f in self._queues[priority] if not f.cancelled()),
+                "p50_wait_s": round(esperas[len(esperas) // 2], 3) if esperas else 0.0,
+                "p95_wait_s": round(esperas[int(len(esperas) * 0.95)], 3) if esperas else 0.0
+            }
+        stats["in_flight"] = self.limiter.in_flight
+        stats["limit"] = int(self.limiter.limit)
+        return stats
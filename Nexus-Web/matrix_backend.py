@@ -1,16 +1,187 @@
 import os
 import google.generativeai as genai
-import docx
-from pypdf import PdfReader
 import csv
 import json
 import re
 import io
 import zipfile
+import threading
+import asyncio
+import time
 from datetime import datetime
 from difflib import SequenceMatcher
 import pandas as pd
 
+import cancellation
+import case_library
+import checkpoints
+from case_model import FIELDNAMES, LIST_FIELDS, LIST_SEPARATOR, TestCase, as_cases
+import coverage_gaps
+import deadline
+import llm_client
+import metrics
+import model_router
+import parse_pool
+import zip_stream
+
+
+# ----------------------------
+# Salida estructurada (JSON schema)
+# ----------------------------
+# Modos de salida soportados por generar_matriz_test:
+#   - "prompt": se pide el JSON en el prompt y se repara con clean_json_response
+#   - "schema": se usa response_mime_type/response_schema del modelo y se valida
+#               la respuesta contra el esquema compilado, sin reparación por regex
+OUTPUT_MODES = ("prompt", "schema")
+DEFAULT_OUTPUT_MODE = os.getenv("MATRIX_OUTPUT_MODE", "prompt")
+
+# Fragmentos del documento que se envían al LLM en paralelo por cada matriz
+MATRIX_CHUNK_CONCURRENCY = int(os.getenv("MATRIX_CHUNK_CONCURRENCY", "8"))
+
+# Un documento con menos texto que esto se considera vacío (archivo escaneado, sin texto legible)
+MIN_DOCUMENT_CHARS = 50
+
+_CAMPOS_TEXTO_CASO = [
+    "titulo_caso_prueba",
+    "Descripcion",
+    "Precondiciones",
+    "Tipo_de_prueba",
+    "Nivel_de_prueba",
+    "Tipo_de_ejecucion",
+    "Categoria",
+    "Ambiente",
+    "Ciclo",
+    "issuetype",
+    "Prioridad",
+    "historia_de_usuario"
+]
+
+# Esquema de un caso de prueba en el formato que acepta la API de Gemini
+TEST_CASE_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": {
+            **{campo: {"type": "STRING"} for campo in _CAMPOS_TEXTO_CASO},
+            "Pasos": {"type": "ARRAY", "items": {"type": "STRING"}},
+            "Resultado_esperado": {"type": "ARRAY", "items": {"type": "STRING"}}
+        },
+        "required": ["titulo_caso_prueba", "Descripcion", "Tipo_de_prueba", "Pasos", "Resultado_esperado"]
+    }
+}
+
+_TIPOS_PYTHON = {
+    "STRING": str,
+    "NUMBER": (int, float),
+    "INTEGER": int,
+    "BOOLEAN": bool,
+    "ARRAY": list,
+    "OBJECT": dict
+}
+
+
+def compile_schema(schema):
+    """
+    Compila un esquema (subconjunto OpenAPI usado por Gemini) en una función
+    validadora. La función devuelve None si el valor es válido o un mensaje de error.
+    """
+    tipo = _TIPOS_PYTHON[schema["type"].upper()]
+
+    if schema["type"].upper() == "ARRAY":
+        validar_item = compile_schema(schema["items"]) if "items" in schema else None
+
+        def validar(valor):
+            if not isinstance(valor, tipo):
+                return f"se esperaba array, se recibió {type(valor).__name__}"
+            if validar_item:
+                for i, item in enumerate(valor):
+                    error = validar_item(item)
+                    if error:
+                        return f"[{i}]: {error}"
+            return None
+        return validar
+
+    if schema["type"].upper() == "OBJECT":
+        propiedades = {nombre: compile_schema(sub) for nombre, sub in schema.get("properties", {}).items()}
+        requeridos = tuple(schema.get("required", []))
+
+        def validar(valor):
+            if not isinstance(valor, tipo):
+                return f"se esperaba objeto, se recibió {type(valor).__name__}"
+            for nombre in requeridos:
+                if nombre not in valor:
+                    return f"falta el campo requerido '{nombre}'"
+            for nombre, validar_propiedad in propiedades.items():
+                if nombre in valor:
+                    error = validar_propiedad(valor[nombre])
+                    if error:
+                        return f"{nombre}: {error}"
+            return None
+        return validar
+
+    def validar(valor):
+        if not isinstance(valor, tipo) or (tipo is int and isinstance(valor, bool)):
+            return f"se esperaba {schema['type'].lower()}, se recibió {type(valor).__name__}"
+        return None
+    return validar
+
+
+# Validador de un caso individual (los casos inválidos se descartan uno a uno)
+validate_test_case = compile_schema(TEST_CASE_SCHEMA["items"])
+
+# Estadísticas de parseo por modo: llamadas, fallos de parseo y casos descartados
+_parse_stats_lock = threading.Lock()
+_parse_stats = {modo: {"calls": 0, "failures": 0, "invalid_cases": 0} for modo in OUTPUT_MODES}
+
+
+def record_parse_result(modo, ok, invalid_cases=0):
+    """Registra el resultado del parseo de una respuesta del modelo."""
+    with _parse_stats_lock:
+        stats = _parse_stats[modo]
+        stats["calls"] += 1
+        if not ok:
+            stats["failures"] += 1
+        stats["invalid_cases"] += invalid_cases
+    metrics.MATRIX_PARSE.labels(modo, "ok" if ok else "failure").inc()
+
+
+def get_parse_stats():
+    """Devuelve las estadísticas de parseo por modo, incluyendo la tasa de fallos."""
+    with _parse_stats_lock:
+        return {
+            modo: {
+                **stats,
+                "failure_rate": round(stats["failures"] / stats["calls"], 4) if stats["calls"] else 0.0
+            }
+            for modo, stats in _parse_stats.items()
+        }
+
+
+def parse_structured_response(response_text):
+    """
+    Parsea una respuesta generada con response_schema.
+    Devuelve (casos_validos, casos_descartados) o (None, 0) si la respuesta no es un array JSON.
+    """
+    try:
+        data = json.loads(response_text)
+    except (TypeError, json.JSONDecodeError) as e:
+        print(f"Error parsing JSON estructurado: {e}")
+        return None, 0
+
+    if not isinstance(data, list):
+        return None, 0
+
+    casos = []
+    descartados = 0
+    for case in data:
+        error = validate_test_case(case)
+        if error:
+            print(f"Caso descartado por esquema: {error}")
+            descartados += 1
+        else:
+            casos.append(case)
+    return casos, descartados
+
 
 # ----------------------------
 # Utilidades de lectura
@@ -20,26 +191,35 @@ def similarity(a, b):
     return SequenceMatcher(None, a.lower(), b.lower()).ratio()
 
 
-def deduplicate_cases(cases):
-    """Elimina casos duplicados de manera más inteligente."""
+_STOPWORDS_TITULO = re.compile(r'\b(el|la|de|en|a|por|para|con|verificar|validar|comprobar)\b')
+_PUNTUACION = re.compile(r'[^\w\s]')
+
+
+def _case_fingerprint(case):
+    """Huella de un caso para la deduplicación: título normalizado + tipo + categoría."""
+    title = (case['titulo_caso_prueba'] or '').lower().strip()
+    test_type = (case['Tipo_de_prueba'] or '').lower()
+    category = case['Categoria'].lower() if case.get('Categoria') else ''
+
+    # Normalizar el título (remover stopwords, puntuación)
+    normalized_title = _STOPWORDS_TITULO.sub('', title)
+    normalized_title = _PUNTUACION.sub('', normalized_title).strip()
+    return f"{normalized_title}_{test_type}_{category}"
+
+
+def deduplicate_cases(cases, existing=()):
+    """
+    Elimina casos duplicados de manera más inteligente. Con `existing`, también descarta
+    los que duplican esos casos (que no se devuelven ni se comparan entre sí).
+    """
     if not cases:
         return cases
 
     unique_cases = []
-    seen_patterns = set()
+    seen_patterns = set(_case_fingerprint(case) for case in existing)
 
     for case in cases:
-        # Crear un patrón único basado en título + tipo + categoría
-        title = case['titulo_caso_prueba'].lower().strip()
-        test_type = case['Tipo_de_prueba'].lower()
-        category = case['Categoria'].lower() if case.get('Categoria') else ''
-
-        # Normalizar el título (remover stopwords, puntuación)
-        normalized_title = re.sub(r'\b(el|la|de|en|a|por|para|con|verificar|validar|comprobar)\b', '', title)
-        normalized_title = re.sub(r'[^\w\s]', '', normalized_title).strip()
-
-        # Crear huella digital del caso
-        case_fingerprint = f"{normalized_title}_{test_type}_{category}"
+        case_fingerprint = _case_fingerprint(case)
 
         # Verificar similitud con casos existentes
         is_duplicate = False
@@ -56,128 +236,28 @@ def deduplicate_cases(cases):
 
 
 def normalize_matrix_data(matrix_data):
-    """Normaliza los datos de la matriz para consistencia."""
-    normalized_data = []
-
-    for i, case in enumerate(matrix_data, 1):
-        # Crear una copia del caso para no modificar el original
-        normalized_case = case.copy()
-
+    """
+    Normaliza los datos de la matriz para consistencia y asigna IDs secuenciales.
+    Los casos que aún son diccionarios se convierten a TestCase (la normalización se hace
+    una sola vez, en TestCase.from_raw); los que ya son TestCase solo reciben su ID.
+    """
+    normalized_data = [case if isinstance(case, TestCase) else TestCase.from_raw(case) for case in matrix_data]
+    for i, case in enumerate(normalized_data, 1):
         # ASIGNAR NUEVO ID SECUENCIAL (sobreescribir cualquier ID existente)
-        normalized_case['id_caso_prueba'] = f"TC{i:03d}"
-
-        # Normalizar Pasos (siempre array)
-        pasos = normalized_case.get('Pasos', [])
-        if not isinstance(pasos, list):
-            if isinstance(pasos, str):
-                steps = []
-                lines = pasos.split('\n')
-                for line in lines:
-                    line = line.strip()
-                    if line:
-                        # Remover numeración si existe (1., 2., etc.)
-                        line = re.sub(r'^\d+[\.\)]\s*', '', line)
-                        steps.append(line)
-                normalized_case['Pasos'] = steps if steps else ['Paso por definir']
-            else:
-                normalized_case['Pasos'] = ['Paso por definir']
-        else:
-            # Limpiar cada paso si ya es array
-            cleaned_steps = []
-            for step in pasos:
-                if isinstance(step, str):
-                    step = step.strip()
-                    step = re.sub(r'^\d+[\.\)]\s*', '', step)
-                    if step:
-                        cleaned_steps.append(step)
-                elif step:
-                    cleaned_steps.append(str(step))
-            normalized_case['Pasos'] = cleaned_steps if cleaned_steps else ['Paso por definir']
-
-        # Normalizar Resultado_esperado (siempre array)
-        resultados = normalized_case.get('Resultado_esperado', [])
-        if not isinstance(resultados, list):
-            if isinstance(resultados, str):
-                results = []
-                # Separar por puntos, saltos de línea o números
-                lines = re.split(r'[\.\n]|\d+[\.\)]\s*', resultados)
-                for line in lines:
-                    line = line.strip()
-                    if line:
-                        if not line.endswith('.'):
-                            line += '.'
-                        results.append(line)
-                normalized_case['Resultado_esperado'] = results if results else ['Resultado por definir']
-            else:
-                normalized_case['Resultado_esperado'] = ['Resultado por definir']
-        else:
-            # Limpiar cada resultado si ya es array
-            cleaned_results = []
-            for result in resultados:
-                if isinstance(result, str):
-                    result = result.strip()
-                    if result:
-                        if not result.endswith('.'):
-                            result += '.'
-                        cleaned_results.append(result)
-                elif result:
-                    result_str = str(result).strip()
-                    if result_str:
-                        if not result_str.endswith('.'):
-                            result_str += '.'
-                        cleaned_results.append(result_str)
-            normalized_case['Resultado_esperado'] = cleaned_results if cleaned_results else ['Resultado por definir']
-
-        # Asegurar campos requeridos
-        required_fields = {
-            'titulo_caso_prueba': 'Título por definir',
-            'Descripcion': 'Descripción por definir',
-            'Precondiciones': 'Precondiciones por definir',
-            'Tipo_de_prueba': 'Funcional',
-            'Nivel_de_prueba': 'UAT',
-            'Tipo_de_ejecucion': 'Manual',
-            'Categoria': 'Flujo Principal',
-            'Ambiente': 'QA',
-            'Ciclo': 'Ciclo 1',
-            'issuetype': 'Test Case',
-            'Prioridad': 'Media',
-            'historia_de_usuario': 'Historia de usuario general'
-        }
-
-        for field, default_value in required_fields.items():
-            if field not in normalized_case or not normalized_case[field]:
-                normalized_case[field] = default_value
-
-        normalized_data.append(normalized_case)
-
+        case.id_caso_prueba = f"TC{i:03d}"
     return normalized_data
 
 def extract_text_from_file(file_path):
-    """Extrae texto de archivos .docx o .pdf."""
+    """Extrae texto de archivos .docx o .pdf (en un proceso aislado, ver parse_pool)."""
     try:
-        if file_path.endswith('.docx'):
-            doc = docx.Document(file_path)
-            full_text = []
-            for para in doc.paragraphs:
-                if para.text.strip():
-                    full_text.append(para.text)
-            for table in doc.tables:
-                for row in table.rows:
-                    for cell in row.cells:
-                        if cell.text.strip():
-                            full_text.append(cell.text)
-            return "\n".join(full_text)
-        elif file_path.endswith('.pdf'):
-            with open(file_path, 'rb') as f:
-                reader = PdfReader(f)
-                text = ""
-                for page in reader.pages:
-                    extracted = page.extract_text()
-                    if extracted:
-                        text += extracted + "\n"
-                return text.strip()
-        else:
-            raise ValueError("Formato de archivo no soportado. Usa .docx o .pdf.")
+        # Párrafos y celdas en orden del documento: las tablas quedan bajo su "HISTORIA #n"
+        return parse_pool.extract(file_path)
+    except parse_pool.ParseError as e:
+        if e.outcome != "error":
+            # Límite de recursos excedido: mejor un error claro que "contenido insuficiente"
+            raise
+        print(f"Error extrayendo texto del archivo: {e}")
+        return ""
     except Exception as e:
         print(f"Error extrayendo texto del archivo: {e}")
         return ""
@@ -275,19 +355,33 @@ def extract_stories_from_text(text):
     matches = re.findall(pattern, text, re.MULTILINE)
     return matches if matches else ['Historia de usuario general']
 
-def generar_matriz_test(contexto, flujo, historia, texto_documento, tipos_prueba=['funcional', 'no_funcional']):
+def generar_matriz_test(contexto, flujo, historia, texto_documento, tipos_prueba=['funcional', 'no_funcional'],
+                        modo_salida=None, min_chars=MIN_DOCUMENT_CHARS):
     try:
+        modo_salida = modo_salida or DEFAULT_OUTPUT_MODE
+        if modo_salida not in OUTPUT_MODES:
+            return {"status": "error",
+                    "message": f"Modo de salida no soportado: {modo_salida}. Usa uno de {', '.join(OUTPUT_MODES)}."}
+
         api_key = os.getenv("GEMINI_API_KEY")
         if not api_key:
             return {"status": "error",
                     "message": "API Key no configurada. Configura GEMINI_API_KEY como variable de entorno."}
 
-        if not texto_documento or len(texto_documento.strip()) < 50:
+        if not texto_documento or len(texto_documento.strip()) < min_chars:
             return {"status": "error",
                     "message": "El documento parece estar vacío o es demasiado corto. Verifica que el archivo contenga texto legible."}
 
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel("gemini-1.5-flash-latest")
+        llm_client.configure(api_key)
+        model = genai.GenerativeModel(model_router.LLM_DEFAULT_MODEL)
+
+        # En modo schema el modelo devuelve directamente JSON con la forma del caso de prueba
+        generation_config = None
+        if modo_salida == "schema":
+            generation_config = genai.GenerationConfig(
+                response_mime_type="application/json",
+                response_schema=TEST_CASE_SCHEMA
+            )
 
         # Definir prompt_base
         prompt_base = """
@@ -422,91 +516,198 @@ GENERA SOLO CASOS NO FUNCIONALES (no tengas un limite de casos generados, siempr
 
         print(f"Procesando {total_chunks} fragmentos del documento...")
 
-        for i, (historia_chunk, chunk) in enumerate(chunks):
+        # Fragmentos ya completados por una ejecución anterior del mismo trabajo (reanudación)
+        checkpoint_job = checkpoints.job_key("matrix", texto_documento, {
+            "contexto": contexto, "flujo": flujo, "historia": historia,
+            "tipos_prueba": list(tipos_prueba), "modo_salida": modo_salida
+        })
+        completados = checkpoints.load(checkpoint_job)
+        fallidos = []
+        # Fragmentos que no se llegaron a procesar por agotarse el plazo de la petición
+        omitidos = []
+        if completados:
+            print(f"Reanudando trabajo: {len(completados)}/{total_chunks} fragmentos ya completados")
+
+        # Biblioteca de casos de trabajos anteriores: requerimientos ya vistos no se vuelven a pedir al LLM
+        perfil = case_library.profile_key(tipos_prueba)
+        biblioteca = case_library.load_index(perfil) if case_library.CASE_LIBRARY_ENABLED else None
+        reuso = {"requirements": 0, "reused": 0, "cases": 0, "llm_calls_avoided": 0}
+
+        # Los fragmentos se procesan concurrentemente en el event loop compartido
+        async def procesar_fragmento(semaforo, i, historia_chunk, chunk):
+            # Si el cliente canceló, no se procesan más fragmentos
+            cancellation.check()
             if not chunk.strip():
                 print(f"Fragmento {i + 1}/{total_chunks} está vacío, omitiendo...")
-                continue
+                return []
 
             print(f"Procesando fragmento {i + 1}/{total_chunks} (Historia: {historia_chunk})")
             prompt_completo = f"{prompt_base}\n\n{prompt_tipos}\n\nCONTEXTO DEL SISTEMA: {contexto}\n\nFLUJOS A CONSIDERAR: {flujo}\n\nHISTORIA DE USUARIO: {historia}\n\nTEXTO DEL DOCUMENTO (REQUERIMIENTOS): {chunk}\n\nGenera casos de prueba basados en este requerimiento específico."
 
             try:
-                response = model.generate_content(prompt_completo)
-                if response.text.strip():
+                async with semaforo:
+                    response = await llm_client.generate_content_async(
+                        model, prompt_completo, llm_client.STAGE_MATRIX_CHUNK, generation_config=generation_config)
+                if modo_salida == "schema":
+                    # El esquema ya garantiza Pasos/Resultado_esperado como arrays: sin reparación
+                    cases_chunk, descartados = parse_structured_response(response.text)
+                    record_parse_result(modo_salida, cases_chunk is not None, descartados)
+                    if cases_chunk is None:
+                        print(f"No se pudo procesar JSON del fragmento {i + 1}: {response.text[:500]}...")
+                        return []
+                    for case in cases_chunk:
+                        case['historia_de_usuario'] = historia_chunk
+                    return cases_chunk
+                elif response.text.strip():
                     print(f"Respuesta del modelo para fragmento {i + 1}: {response.text[:200]}...")
                     cases_chunk = clean_json_response(response.text)
+                    record_parse_result(modo_salida, cases_chunk is not None)
                     if cases_chunk:
-                        # NORMALIZAR Y ASIGNAR IDs ÚNICOS
+                        # La normalización de Pasos/Resultado_esperado se hace una sola vez en TestCase.from_raw
+                        cases_chunk = [case for case in cases_chunk if isinstance(case, dict)]
                         for case in cases_chunk:
-                            # NORMALIZAR FORMATO DE PASOS (siempre array)
-                            if not isinstance(case.get('Pasos'), list):
-                                if isinstance(case.get('Pasos'), str):
-                                    # Convertir string numerado a array
-                                    steps = []
-                                    lines = case['Pasos'].split('\n')
-                                    for line in lines:
-                                        line = line.strip()
-                                        if line and any(char.isdigit() for char in line[:3]):
-                                            # Remover numeración si existe
-                                            step_text = re.sub(r'^\d+[\.\)]\s*', '', line)
-                                            if step_text:
-                                                steps.append(step_text)
-                                        elif line:
-                                            steps.append(line)
-                                    case['Pasos'] = steps if steps else ['Paso por definir']
-                                else:
-                                    case['Pasos'] = ['Paso por definir']
-
-                            # NORMALIZAR FORMATO DE RESULTADOS (siempre array)
-                            if not isinstance(case.get('Resultado_esperado'), list):
-                                if isinstance(case.get('Resultado_esperado'), str):
-                                    # Convertir string a array (separar por puntos o saltos de línea)
-                                    results = []
-                                    lines = case['Resultado_esperado'].split('.')
-                                    for line in lines:
-                                        line = line.strip()
-                                        if line and not line.endswith('.'):
-                                            line += '.'
-                                        if line:
-                                            results.append(line)
-                                    case['Resultado_esperado'] = results if results else ['Resultado por definir']
-                                else:
-                                    case['Resultado_esperado'] = ['Resultado por definir']
-
-                            # Asegurar que la historia de usuario se asigne correctamente
                             case['historia_de_usuario'] = historia_chunk
-
-                        all_cases.extend(cases_chunk)
+                        return cases_chunk
                     else:
                         print(f"No se pudo procesar JSON del fragmento {i + 1}: {response.text[:500]}...")
                 else:
+                    record_parse_result(modo_salida, False)
                     print(f"Respuesta vacía del modelo para fragmento {i + 1}")
+            except (cancellation.JobCancelled, deadline.DeadlineExceeded):
+                raise
             except Exception as e:
                 print(f"Error procesando fragmento {i + 1}: {str(e)}")
-                continue
+            return []
+
+        def contar_reuso(coincidencia, casos_reutilizados):
+            # Solo fragmentos que terminaron bien: lo reutilizado de un fragmento fallido no llega a la matriz
+            reuso["requirements"] += coincidencia.total
+            reuso["reused"] += coincidencia.reused
+            reuso["cases"] += casos_reutilizados
+
+        async def procesar_con_biblioteca(semaforo, i, historia_chunk, chunk):
+            if biblioteca is None:
+                return await procesar_fragmento(semaforo, i, historia_chunk, chunk)
+
+            loop = asyncio.get_running_loop()
+            # La búsqueda es CPU: fuera del event loop para no frenar las llamadas al LLM en curso
+            coincidencia = await loop.run_in_executor(None, case_library.match, biblioteca, chunk)
+            reutilizados = coincidencia.cases
+            for case in reutilizados:
+                case['historia_de_usuario'] = historia_chunk
+            if coincidencia.total and not coincidencia.pending:
+                print(f"Fragmento {i + 1}/{total_chunks} cubierto por la biblioteca ({len(reutilizados)} casos reutilizados)")
+                contar_reuso(coincidencia, len(reutilizados))
+                reuso["llm_calls_avoided"] += 1
+                return reutilizados
+
+            # Al LLM se le envía el fragmento original sin las oraciones que ya están en la
+            # biblioteca: encabezados y líneas cortas se conservan
+            texto = chunk
+            if coincidencia.reused:
+                texto = coverage_gaps.remove_requirements(chunk, coincidencia.covered)
+                print(f"Fragmento {i + 1}/{total_chunks}: {coincidencia.reused}/{coincidencia.total} requerimientos reutilizados")
+            cases_chunk = await procesar_fragmento(semaforo, i, historia_chunk, texto)
+            if not cases_chunk:
+                # Si falla la parte nueva el fragmento cuenta como fallido y se reintenta completo;
+                # lo reutilizado no se cuenta porque no llega a la matriz
+                return []
+            await loop.run_in_executor(None, case_library.store, perfil, coincidencia.pending, cases_chunk)
+            contar_reuso(coincidencia, len(reutilizados))
+            return reutilizados + cases_chunk
+
+        async def procesar_con_checkpoint(semaforo, i, historia_chunk, chunk):
+            guardado = checkpoints.lookup(completados, f"chunk:{i}")
+            if guardado is not None:
+                return guardado
+            # Sin presupuesto de tiempo no se despacha trabajo nuevo: se devuelve lo que haya
+            if deadline.exhausted():
+                omitidos.append(i)
+                return []
+            try:
+                cases_chunk = await procesar_con_biblioteca(semaforo, i, historia_chunk, chunk)
+            except deadline.DeadlineExceeded:
+                omitidos.append(i)
+                return []
+            # Los fragmentos fallidos no se guardan: se reintentan al reanudar
+            if cases_chunk:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, checkpoints.save, checkpoint_job, f"chunk:{i}", cases_chunk)
+            elif chunk.strip():
+                fallidos.append(i)
+            return cases_chunk
+
+        async def procesar_fragmentos():
+            semaforo = asyncio.Semaphore(MATRIX_CHUNK_CONCURRENCY)
+            return await asyncio.gather(*(procesar_con_checkpoint(semaforo, i, historia_chunk, chunk)
+                                          for i, (historia_chunk, chunk) in enumerate(chunks)))
+
+        # gather conserva el orden de los fragmentos, así la deduplicación es determinista
+        for cases_chunk in llm_client.run(procesar_fragmentos()):
+            all_cases.extend(TestCase.from_raw(case) for case in cases_chunk)
+
+        # La deduplicación es costosa: no se hace si el cliente ya se fue
+        cancellation.check()
 
         # Deduplicar casos
-        all_cases = deduplicate_cases(all_cases)
-        all_cases = normalize_matrix_data(all_cases)
+        with metrics.stage("matrix", "dedup"):
+            all_cases = deduplicate_cases(all_cases)
+        with metrics.stage("matrix", "normalize"):
+            all_cases = normalize_matrix_data(all_cases)
         print(
             f"Casos después de deduplicación: {len(all_cases)}")
 
+        if omitidos:
+            print(f"Plazo agotado: {len(omitidos)}/{total_chunks} fragmentos sin procesar, resultado parcial")
+
         if not all_cases:
+            if omitidos:
+                return {
+                    "status": "error",
+                    "message": "Se agotó el tiempo disponible antes de completar algún fragmento. Intenta de nuevo: los fragmentos ya generados se reutilizarán."
+                }
             return {
                 "status": "error",
                 "message": "No se pudieron generar casos de prueba. Verifica que el documento contenga información clara sobre requerimientos o funcionalidades."
             }
 
-        funcional_count = sum(1 for case in all_cases if case.get('Tipo_de_prueba', '').lower() == 'funcional')
+        funcional_count = sum(1 for case in all_cases if case.Tipo_de_prueba.lower() == 'funcional')
         no_funcional_count = len(all_cases) - funcional_count
 
+        # Trabajo completo: sus checkpoints ya no hacen falta. Si hubo fragmentos fallidos u
+        # omitidos se conservan, y reenviar el documento solo procesa esos fragmentos
+        if fallidos or omitidos:
+            print(f"{len(fallidos) + len(omitidos)} fragmentos pendientes; el trabajo puede reanudarse para completarlos")
+        else:
+            checkpoints.clear(checkpoint_job)
+
+        if omitidos:
+            metrics.PARTIAL_RESULTS.labels("matrix").inc()
+
+        if reuso["reused"]:
+            print(f"Biblioteca: {reuso['reused']}/{reuso['requirements']} requerimientos reutilizados, "
+                  f"{reuso['llm_calls_avoided']} llamadas al LLM evitadas")
+
         return {
             "status": "success",
             "matrix": all_cases,
             "total_cases": len(all_cases),
             "funcional_cases": funcional_count,
-            "no_funcional_cases": no_funcional_count
+            "no_funcional_cases": no_funcional_count,
+            "output_mode": modo_salida,
+            "partial": bool(omitidos),
+            "coverage": deadline.coverage(total_chunks, total_chunks - len(fallidos) - len(omitidos),
+                                          len(fallidos), len(omitidos)),
+            "reuse": {
+                "reuse_ratio": round(reuso["reused"] / reuso["requirements"], 3) if reuso["requirements"] else 0.0,
+                "reused_requirements": reuso["reused"],
+                "reused_cases": reuso["cases"],
+                "llm_calls_avoided": reuso["llm_calls_avoided"]
+            }
         }
+    except cancellation.JobCancelled:
+        print("Generación de matriz cancelada por el cliente")
+        raise
     except Exception as e:
         error_message = str(e).lower()
         print(f"Error general: {str(e)}")
@@ -529,133 +730,239 @@ def save_to_xlsx_buffer(data):
     if not data:
         return b""
 
-    # Campos en el orden deseado (igual que CSV)
-    fieldnames = [
-        "id_caso_prueba",
-        "titulo_caso_prueba",
-        "Descripcion",
-        "Precondiciones",
-        "Tipo_de_prueba",
-        "Nivel_de_prueba",
-        "Tipo_de_ejecucion",
-        "Pasos",
-        "Resultado_esperado",
-        "Categoria",
-        "Ambiente",
-        "Ciclo",
-        "issuetype",
-        "Prioridad",
-        "historia_de_usuario"
-    ]
+    # Filas con Pasos/Resultado_esperado unidos por " | " (igual que CSV); los anchos de
+    # columna se calculan en la misma pasada en lugar de recorrer después todas las celdas
+    anchos = [len(field) for field in FIELDNAMES]
+    filas = []
+    for case in as_cases(data):
+        fila = case.row()
+        for i, valor in enumerate(fila):
+            if len(valor) > anchos[i]:
+                anchos[i] = len(valor)
+        filas.append(fila)
 
     # Crear DataFrame con pandas
-    df = pd.DataFrame(data)[fieldnames]  # Selecciona solo las columnas en orden
+    df = pd.DataFrame.from_records(filas, columns=FIELDNAMES)
 
     # Buffer para XLSX
     output = io.BytesIO()
     with pd.ExcelWriter(output, engine='openpyxl') as writer:
         df.to_excel(writer, sheet_name='Matriz de Pruebas', index=False)
-        # Opcional: Auto-ajustar columnas para mejor legibilidad
+        # Auto-ajustar columnas para mejor legibilidad
         worksheet = writer.sheets['Matriz de Pruebas']
-        for column in worksheet.columns:
-            max_length = 0
-            column_letter = column[0].column_letter
-            for cell in column:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            adjusted_width = min(max_length + 2, 50)  # Límite para no hacer columnas eternas
-            worksheet.column_dimensions[column_letter].width = adjusted_width
+        for column, ancho in zip(worksheet.iter_cols(min_row=1, max_row=1), anchos):
+            # Límite para no hacer columnas eternas
+            worksheet.column_dimensions[column[0].column_letter].width = min(ancho + 2, 50)
 
     output.seek(0)
     return output.getvalue()
 
-def save_to_csv_buffer(data):
-    """Guarda los datos de la matriz en un buffer de memoria como CSV."""
-    if not data:
-        return b""
+# ----------------------------
+# Seguimiento de cobertura de una matriz previa
+# ----------------------------
+def read_matrix_file(raw, filename):
+    """
+    Lee una matriz exportada previamente (ZIP de /api/matrix, JSON, NDJSON o CSV)
+    y devuelve sus casos como TestCase. Los casos ya se exportaron normalizados: se
+    reconstruyen con from_dict, sin volver a limpiarlos, para devolverlos sin cambios.
+    """
+    nombre = filename.lower()
+    if nombre.endswith(".zip"):
+        with zipfile.ZipFile(io.BytesIO(raw)) as archivo:
+            miembros = [m for m in archivo.namelist() if m.lower().endswith(".json")]
+            if not miembros:
+                raise ValueError("El ZIP no contiene la matriz en JSON")
+            raw = archivo.read(miembros[0])
+        nombre = miembros[0].lower()
+    texto = raw.decode("utf-8-sig")
+    if nombre.endswith(".csv"):
+        # Solo las listas van unidas con LIST_SEPARATOR; el resto se conserva tal cual
+        filas = list(csv.DictReader(io.StringIO(texto)))
+        for fila in filas:
+            for field in LIST_FIELDS:
+                fila[field] = fila[field].split(LIST_SEPARATOR) if fila.get(field) else []
+    elif nombre.endswith(".ndjson"):
+        filas = [json.loads(linea) for linea in texto.splitlines() if linea.strip()]
+    else:
+        filas = json.loads(texto)
+        if not isinstance(filas, list):
+            raise ValueError("El JSON de la matriz debe ser un array de casos")
+    return [TestCase.from_dict(fila) for fila in filas if isinstance(fila, dict)]
 
-    # Campos en el orden deseado
-    fieldnames = [
-        "id_caso_prueba",
-        "titulo_caso_prueba",
-        "Descripcion",
-        "Precondiciones",
-        "Tipo_de_prueba",
-        "Nivel_de_prueba",
-        "Tipo_de_ejecucion",
-        "Pasos",
-        "Resultado_esperado",
-        "Categoria",
-        "Ambiente",
-        "Ciclo",
-        "issuetype",
-        "Prioridad",
-        "historia_de_usuario"
-    ]
 
-    output = io.StringIO()
-    writer = csv.DictWriter(output, fieldnames=fieldnames)
-    writer.writeheader()
+_ID_SECUENCIAL = re.compile(r"^TC(\d+)$")
 
-    for row in data:
-        # Crear una copia del row para no modificar el original
-        csv_row = {}
 
-        for field in fieldnames:
-            value = row.get(field, '')
+def _assign_ids_after(nuevos, previos):
+    """Numera los casos nuevos a continuación del mayor ID TCnnn de los casos previos."""
+    ultimo = max((int(m.group(1)) for m in (_ID_SECUENCIAL.match(str(case.id_caso_prueba or ''))
+                                                for case in previos) if m), default=0)
+    for i, case in enumerate(nuevos, ultimo + 1):
+        case.id_caso_prueba = f"TC{i:03d}"
+    return nuevos
 
-            # Convertir listas a string separado por " | "
-            if field in ['Pasos', 'Resultado_esperado'] and isinstance(value, list):
-                csv_row[field] = " | ".join(str(item) for item in value if item)
-            elif isinstance(value, list):
-                csv_row[field] = ", ".join(str(item) for item in value if item)
-            else:
-                csv_row[field] = str(value) if value else ''
 
-        writer.writerow(csv_row)
+def generar_casos_para_brechas(contexto, flujo, historia, texto_documento, casos_previos,
+                               tipos_prueba=['funcional', 'no_funcional'], modo_salida=None, umbral=None):
+    """
+    Modo de seguimiento: analiza qué requerimientos no cubre la matriz previa y pide
+    al LLM casos solo para esos requerimientos. Los casos previos se devuelven intactos
+    (con sus IDs, que pueden estar ya importados en Jira); los nuevos se deduplican contra
+    ellos y se numeran a continuación del mayor ID existente.
+    """
+    with metrics.stage("matrix", "coverage"):
+        informe = coverage_gaps.analyze_coverage(texto_documento, casos_previos, umbral)
+    print(f"Cobertura previa: {informe['covered']}/{informe['requirements_total']} requerimientos, "
+          f"{len(informe['uncovered'])} sin cubrir")
 
-    return output.getvalue().encode('utf-8')
+    if not informe["uncovered"]:
+        return {
+            "status": "success",
+            "matrix": list(casos_previos),
+            "total_cases": len(casos_previos),
+            "new_cases": 0,
+            "coverage_report": informe,
+            "partial": False
+        }
 
+    # Una sola brecha corta es un documento válido aunque no llegue a MIN_DOCUMENT_CHARS
+    resultado = generar_matriz_test(contexto, flujo, historia, coverage_gaps.gaps_document(informe),
+                                    tipos_prueba, modo_salida, min_chars=coverage_gaps.MIN_REQUIREMENT_CHARS)
+    if resultado["status"] != "success":
+        return resultado
+
+    # Ante un duplicado se conserva el caso que ya tenía el usuario
+    with metrics.stage("matrix", "dedup"):
+        nuevos = deduplicate_cases(resultado["matrix"], existing=casos_previos)
+    nuevos = _assign_ids_after(nuevos, casos_previos)
+    casos = list(casos_previos) + nuevos
+    print(f"Seguimiento: {len(nuevos)} casos nuevos tras deduplicación")
+
+    resultado.update({
+        "matrix": casos,
+        "total_cases": len(casos),
+        "funcional_cases": sum(1 for case in casos if (case.Tipo_de_prueba or '').lower() == 'funcional'),
+        "new_cases": len(nuevos),
+        "coverage_report": informe
+    })
+    resultado["no_funcional_cases"] = len(casos) - resultado["funcional_cases"]
+    return resultado
 
-def save_to_json_buffer(data):
-    """Guarda los datos de la matriz en un buffer de memoria como JSON."""
-    if not data:
-        return b"[]"
 
-    output = io.StringIO()
-    json.dump(data, output, indent=4, ensure_ascii=False)
-    return output.getvalue().encode('utf-8')
+# ----------------------------
+# Exportación en streaming
+# ----------------------------
+# Los exportadores iter_* generan bytes por bloques (~EXPORT_CHUNK_BYTES) a medida que
+# recorren los casos, para que Flask los envíe sin armar el archivo completo en memoria
+EXPORT_CHUNK_BYTES = 64 * 1024
+
+# Formatos de descarga directa de /api/matrix (además del ZIP): extensión y mimetype
+STREAM_FORMATS = {
+    "ndjson": ("ndjson", "application/x-ndjson"),
+    "csv": ("csv", "text/csv; charset=utf-8"),
+    "json": ("json", "application/json"),
+}
 
 
-def create_zip_with_matrix(data, output_filename):
-    """
-    Crea un archivo ZIP con la matriz en formato CSV, JSON y XLSX.
-    """
+def iter_csv(data):
+    """CSV de la matriz por bloques de filas (mismas columnas y formato que save_to_csv_buffer)."""
     if not data:
-        return None
+        return
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(FIELDNAMES)
+    for case in as_cases(data):
+        writer.writerow(case.row())
+        if output.tell() >= EXPORT_CHUNK_BYTES:
+            yield output.getvalue().encode('utf-8')
+            output.seek(0)
+            output.truncate()
+    if output.tell():
+        yield output.getvalue().encode('utf-8')
+
+
+def iter_json_array(data):
+    """Array JSON con indent=4 (igual que json.dump) generado caso a caso."""
+    if not data:
+        yield b"[]"
+        return
+    partes = ["["]
+    tamano = 1
+    separador = "\n    "
+    for case in as_cases(data):
+        # Los saltos de línea dentro de cadenas JSON van escapados: indentar por líneas es seguro
+        texto = separador + json.dumps(case.to_dict(), indent=4, ensure_ascii=False).replace("\n", "\n    ")
+        separador = ",\n    "
+        partes.append(texto)
+        tamano += len(texto)
+        if tamano >= EXPORT_CHUNK_BYTES:
+            yield "".join(partes).encode('utf-8')
+            partes = []
+            tamano = 0
+    partes.append("\n]")
+    yield "".join(partes).encode('utf-8')
+
+
+def iter_ndjson(data):
+    """Un caso por línea en JSON compacto (NDJSON), para procesar la matriz fila a fila."""
+    partes = []
+    tamano = 0
+    for case in as_cases(data):
+        linea = json.dumps(case.to_dict(), ensure_ascii=False) + "\n"
+        partes.append(linea)
+        tamano += len(linea)
+        if tamano >= EXPORT_CHUNK_BYTES:
+            yield "".join(partes).encode('utf-8')
+            partes = []
+            tamano = 0
+    if partes:
+        yield "".join(partes).encode('utf-8')
+
+
+def iter_matrix_export(data, formato):
+    """Bytes de la matriz en un formato de STREAM_FORMATS, midiendo la etapa de exportación."""
+    exportadores = {"ndjson": iter_ndjson, "csv": iter_csv, "json": iter_json_array}
+    return _export_member(f"export_{formato}", exportadores[formato](data))
+
 
-    zip_buffer = io.BytesIO()
+def save_to_csv_buffer(data):
+    """Guarda los datos de la matriz en un buffer de memoria como CSV."""
+    if not data:
+        return b""
+    return b"".join(iter_csv(data))
 
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-        # Agregar archivo CSV (igual que antes)
-        csv_data = save_to_csv_buffer(data)
-        zip_file.writestr(f"{output_filename}.csv", csv_data)
 
-        # Agregar archivo JSON (igual que antes)
-        json_data = save_to_json_buffer(data)
-        zip_file.writestr(f"{output_filename}.json", json_data)
+def save_to_json_buffer(data):
+    """Guarda los datos de la matriz en un buffer de memoria como JSON."""
+    if not data:
+        return b"[]"
+    return b"".join(iter_json_array(data))
 
-        # NUEVO: Agregar archivo XLSX
-        xlsx_data = save_to_xlsx_buffer(data)
-        zip_file.writestr(f"{output_filename}.xlsx", xlsx_data)
 
-        # Agregar archivo README actualizado con mención al XLSX
-        funcional_count = sum(1 for case in data if case.get('Tipo_de_prueba', '').lower() == 'funcional')
-        no_funcional_count = len(data) - funcional_count
-        readme_content = f"""MATRIZ DE PRUEBAS GENERADA
+def _export_member(stage_name, chunks):
+    """
+    Reenvía los bloques de un exportador midiendo solo el tiempo de generación
+    (no el tiempo que el cliente tarda en consumirlos).
+    """
+    total = 0.0
+    iterador = iter(chunks)
+    while True:
+        inicio = time.perf_counter()
+        try:
+            chunk = next(iterador)
+        except StopIteration:
+            break
+        finally:
+            total += time.perf_counter() - inicio
+        yield chunk
+    metrics.STAGE_LATENCY.labels("matrix", stage_name).observe(total)
+
+
+def _readme_content(data, output_filename):
+    """Contenido del README.txt incluido en el ZIP de la matriz."""
+    funcional_count = sum(1 for case in data if (case.get('Tipo_de_prueba') or '').lower() == 'funcional')
+    no_funcional_count = len(data) - funcional_count
+    return f"""MATRIZ DE PRUEBAS GENERADA
 ============================
 
 Archivo generado automáticamente por Matrix Generator
@@ -695,10 +1002,36 @@ INSTRUCCIONES DE USO:
 3. Usa el JSON para scripts automatizados.
 4. Revisa y ajusta los casos según tus necesidades específicas.
 """
-        zip_file.writestr("README.txt", readme_content.encode('utf-8'))
 
-    zip_buffer.seek(0)
-    return zip_buffer.getvalue()
+
+def iter_matrix_zip(data, output_filename, include_readme=False):
+    """
+    Genera en streaming un ZIP con la matriz en JSON, CSV y XLSX (y opcionalmente README).
+    JSON y CSV se escriben por bloques a medida que se generan. El XLSX no es
+    incremental: se genera aquí, antes de empezar a enviar, para que un fallo
+    llegue como error y no como un ZIP truncado; ya está comprimido, así que se
+    almacena sin volver a comprimir.
+    """
+    with metrics.stage("matrix", "export_xlsx"):
+        xlsx = save_to_xlsx_buffer(data)
+    members = [
+        (f"{output_filename}.json", _export_member("export_json", iter_json_array(data)), True),
+        (f"{output_filename}.csv", _export_member("export_csv", iter_csv(data)), True),
+        (f"{output_filename}.xlsx", [xlsx], False),
+    ]
+    if include_readme:
+        members.append(("README.txt", [_readme_content(data, output_filename).encode('utf-8')], True))
+    return zip_stream.stream_zip(members)
+
+
+def create_zip_with_matrix(data, output_filename):
+    """
+    Crea un archivo ZIP con la matriz en formato CSV, JSON y XLSX.
+    """
+    if not data:
+        return None
+
+    return b"".join(iter_matrix_zip(data, output_filename, include_readme=True))
 
 
 def process_matrix_request(file_path, contexto="", flujo="", historia="", tipos_prueba=['funcional', 'no_funcional'],
@@ -722,7 +1055,7 @@ def process_matrix_request(file_path, contexto="", flujo="", historia="", tipos_
         print(f"Extrayendo texto del archivo: {file_path}")
         texto_documento = extract_text_from_file(file_path)
 
-        if not texto_documento or len(texto_documento.strip()) < 50:
+        if not texto_documento or len(texto_documento.strip()) < MIN_DOCUMENT_CHARS:
             return {
                 "status": "error",
                 "message": "No se pudo extraer texto del documento o el contenido es insuficiente."
@@ -0,0 +1,195 @@
+"""
+Métricas de la aplicación en formato Prometheus.
+
+Con gunicorn cada worker es un proceso distinto: si la variable de entorno
+PROMETHEUS_MULTIPROC_DIR está definida (gunicorn.conf.py la configura), cada
+proceso escribe sus valores en ese directorio y /metrics los agrega todos.
+"""
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# Las generaciones con LLM tardan desde segundos hasta varios minutos
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+
+REQUEST_LATENCY = Histogram(
+    "nexus_request_duration_seconds",
+    "Latencia de las peticiones HTTP por endpoint",
+    ["endpoint", "status"],
+    buckets=LATENCY_BUCKETS
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "nexus_requests_in_flight",
+    "Peticiones HTTP en curso por endpoint",
+    ["endpoint"],
+    multiprocess_mode="livesum"
+)
+STAGE_LATENCY = Histogram(
+    "nexus_stage_duration_seconds",
+    "Latencia de cada etapa de los pipelines (extracción, deduplicación, exportación...)",
+    ["pipeline", "stage"],
+    buckets=LATENCY_BUCKETS
+)
+LLM_CALLS = Counter(
+    "nexus_llm_calls_total",
+    "Llamadas al LLM por etapa y resultado (ok, error, timeout, cancelled)",
+    ["stage", "outcome"]
+)
+LLM_LATENCY = Histogram(
+    "nexus_llm_call_duration_seconds",
+    "Latencia de las llamadas al LLM por etapa",
+    ["stage"],
+    buckets=LATENCY_BUCKETS
+)
+LLM_IN_FLIGHT = Gauge(
+    "nexus_llm_calls_in_flight",
+    "Llamadas al LLM en curso por etapa",
+    ["stage"],
+    multiprocess_mode="livesum"
+)
+LLM_QUOTA_WAIT = Histogram(
+    "nexus_llm_quota_wait_seconds",
+    "Tiempo de espera por cuota (RPM/TPM) antes de cada llamada al LLM",
+    buckets=LATENCY_BUCKETS
+)
+LLM_CONCURRENCY_LIMIT = Gauge(
+    "nexus_llm_concurrency_limit",
+    "Límite adaptativo (AIMD) de llamadas al LLM en vuelo, sumado entre workers",
+    multiprocess_mode="livesum"
+)
+LLM_BACKOFFS = Counter(
+    "nexus_llm_backoffs_total",
+    "Reintentos con backoff de llamadas al LLM por etapa y clase de error",
+    ["stage", "reason"]
+)
+LLM_QUEUE_WAIT = Histogram(
+    "nexus_llm_queue_wait_seconds",
+    "Espera en el planificador de llamadas al LLM por clase de prioridad",
+    ["priority"],
+    buckets=LATENCY_BUCKETS
+)
+LLM_QUEUE_DEPTH = Gauge(
+    "nexus_llm_queue_depth",
+    "Llamadas al LLM esperando en el planificador por clase de prioridad",
+    ["priority"],
+    multiprocess_mode="livesum"
+)
+CACHE_REQUESTS = Counter(
+    "nexus_cache_requests_total",
+    "Consultas a cachés internas por resultado (hit, miss); ratio = hit / (hit + miss)",
+    ["cache", "result"]
+)
+ADMISSION_QUEUE_WAIT = Histogram(
+    "nexus_admission_queue_wait_seconds",
+    "Tiempo de espera en la cola de admisión por endpoint",
+    ["endpoint"],
+    buckets=LATENCY_BUCKETS
+)
+ADMISSION_QUEUE_DEPTH = Gauge(
+    "nexus_admission_queue_depth",
+    "Peticiones esperando en la cola de admisión por endpoint",
+    ["endpoint"],
+    multiprocess_mode="livesum"
+)
+ADMISSION_REJECTED = Counter(
+    "nexus_admission_rejected_total",
+    "Peticiones rechazadas con 429 por endpoint y motivo (queue_full, queue_timeout)",
+    ["endpoint", "reason"]
+)
+LLM_CALLS_CANCELLED = Counter(
+    "nexus_llm_calls_cancelled_total",
+    "Llamadas al LLM evitadas o abortadas (en cola o en vuelo) por cancelación del cliente",
+    ["stage"]
+)
+JOBS_CANCELLED = Counter(
+    "nexus_jobs_cancelled_total",
+    "Generaciones canceladas por el cliente por endpoint",
+    ["endpoint"]
+)
+LLM_DEADLINE_SKIPPED = Counter(
+    "nexus_llm_calls_deadline_skipped_total",
+    "Llamadas al LLM no iniciadas o cortadas por agotarse el plazo de la petición",
+    ["stage"]
+)
+PARTIAL_RESULTS = Counter(
+    "nexus_partial_results_total",
+    "Generaciones devueltas como resultado parcial por agotarse el plazo",
+    ["pipeline"]
+)
+LLM_ROUTE_CALLS = Counter(
+    "nexus_llm_route_calls_total",
+    "Llamadas al LLM por etapa, modelo elegido por el enrutador y resultado",
+    ["stage", "model", "outcome"]
+)
+LLM_ROUTE_LATENCY = Histogram(
+    "nexus_llm_route_duration_seconds",
+    "Latencia de las llamadas al LLM por etapa y modelo",
+    ["stage", "model"],
+    buckets=LATENCY_BUCKETS
+)
+LLM_ROUTE_TOKENS = Counter(
+    "nexus_llm_route_tokens_total",
+    "Tokens de entrada y salida por etapa y modelo (del uso reportado o estimados)",
+    ["stage", "model", "direction"]
+)
+LLM_ROUTE_COST = Counter(
+    "nexus_llm_route_cost_usd_total",
+    "Costo estimado en USD por etapa y modelo según LLM_MODEL_PRICES",
+    ["stage", "model"]
+)
+MATRIX_PARSE = Counter(
+    "nexus_matrix_parse_total",
+    "Respuestas del modelo parseadas en la generación de matrices por modo y resultado",
+    ["mode", "outcome"]
+)
+DOCUMENT_PARSE = Counter(
+    "nexus_document_parse_total",
+    "Documentos parseados en el pool aislado por resultado (ok, error, timeout, cpu_limit, memory_limit, crashed)",
+    ["outcome"]
+)
+DOCUMENT_PARSE_LATENCY = Histogram(
+    "nexus_document_parse_duration_seconds",
+    "Tiempo real de parseo de documentos en el pool aislado, incluida la espera de un proceso libre",
+    buckets=LATENCY_BUCKETS
+)
+REQUEST_PROFILES = Counter(
+    "nexus_request_profiles_total",
+    "Peticiones perfiladas bajo demanda por endpoint, disparador (header, sample) y resultado (stored, busy, error)",
+    ["endpoint", "trigger", "outcome"]
+)
+
+
+@contextmanager
+def stage(pipeline, name):
+    """Mide la duración de una etapa del pipeline."""
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_LATENCY.labels(pipeline, name).observe(time.perf_counter() - inicio)
+
+
+def record_cache(cache, hit):
+    """Registra un acierto o fallo de caché."""
+    CACHE_REQUESTS.labels(cache, "hit" if hit else "miss").inc()
+
+
+def render_metrics():
+    """Devuelve (cuerpo, content_type) con todas las métricas, agregadas entre procesos si aplica."""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
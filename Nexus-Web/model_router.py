@@ -0,0 +1,134 @@
+"""
+Enrutamiento de llamadas al LLM por etapa y tamaño de la entrada.
+
+Cada etapa (story_analysis, story_batch, story_chunk, matrix_chunk, chat,
+chat_summary) puede ir a un modelo distinto, y dentro de una etapa el modelo
+puede cambiar según el tamaño estimado del prompt: las llamadas pequeñas a un
+modelo más rápido y barato, las grandes a uno más capaz. Las etapas sin
+reglas usan el modelo con el que el backend hizo la llamada (LLM_DEFAULT_MODEL).
+
+Reglas en LLM_ROUTES, separadas por comas:
+    etapa:modelo            modelo de la etapa para cualquier tamaño
+    etapa>N:modelo          modelo cuando el prompt supera N tokens estimados
+
+Para cada llamada se aplica la regla de la etapa con el mayor umbral que el
+prompt supere. Ejemplo:
+
+    LLM_ROUTES="chat:gemini-1.5-flash-8b,story_batch:gemini-1.5-flash-8b,story_batch>6000:gemini-1.5-flash,story_analysis>30000:gemini-1.5-pro"
+
+El costo por ruta se estima con LLM_MODEL_PRICES (USD por millón de tokens
+de entrada/salida):
+
+    LLM_MODEL_PRICES="gemini-1.5-flash=0.075/0.30,gemini-1.5-flash-8b=0.0375/0.15,gemini-1.5-pro=1.25/5.00"
+"""
+import os
+import threading
+
+import google.generativeai as genai
+
+import metrics
+
+LLM_DEFAULT_MODEL = os.getenv("LLM_DEFAULT_MODEL", "gemini-1.5-flash-latest")
+
+_models = {}
+_models_lock = threading.Lock()
+
+
+def _parse_routes(spec):
+    """{etapa: [(umbral, modelo), ...]} ordenado por umbral descendente."""
+    rutas = {}
+    for regla in filter(None, (r.strip() for r in spec.split(","))):
+        try:
+            condicion, modelo = regla.split(":", 1)
+            etapa, _, umbral = condicion.partition(">")
+            rutas.setdefault(etapa.strip(), []).append((int(umbral) if umbral else 0, modelo.strip()))
+        except ValueError:
+            print(f"⚠️ Regla de LLM_ROUTES inválida, se ignora: {regla}")
+    for reglas in rutas.values():
+        reglas.sort(reverse=True)
+    return rutas
+
+
+def _parse_prices(spec):
+    """{modelo: (USD por millón de tokens de entrada, USD por millón de tokens de salida)}."""
+    precios = {}
+    for entrada in filter(None, (e.strip() for e in spec.split(","))):
+        try:
+            modelo, valores = entrada.split("=", 1)
+            precio_entrada, precio_salida = valores.split("/", 1)
+            precios[modelo.strip()] = (float(precio_entrada), float(precio_salida))
+        except ValueError:
+            print(f"⚠️ Precio de LLM_MODEL_PRICES inválido, se ignora: {entrada}")
+    return precios
+
+
+ROUTES = _parse_routes(os.getenv("LLM_ROUTES", ""))
+PRICES = _parse_prices(os.getenv("LLM_MODEL_PRICES", ""))
+
+
+def estimate_input_tokens(prompt):
+    """~4 caracteres por token (la misma estimación que rate_governor, sin la salida)."""
+    return len(str(prompt)) // 4
+
+
+def model_name(model):
+    """Nombre corto del modelo ("models/gemini-1.5-flash" -> "gemini-1.5-flash")."""
+    nombre = getattr(model, "model_name", None) or getattr(model, "name", None) or LLM_DEFAULT_MODEL
+    return nombre.split("/", 1)[1] if nombre.startswith("models/") else nombre
+
+
+def select_model(stage, prompt):
+    """Nombre del modelo que corresponde a la etapa y el tamaño del prompt, o None si no hay regla."""
+    reglas = ROUTES.get(stage)
+    if not reglas:
+        return None
+    tokens = estimate_input_tokens(prompt)
+    for umbral, modelo in reglas:
+        if tokens > umbral or umbral == 0:
+            return modelo
+    return None
+
+
+def get_model(name):
+    """GenerativeModel por nombre, uno por proceso (se reutiliza entre llamadas)."""
+    with _models_lock:
+        modelo = _models.get(name)
+        if modelo is None:
+            modelo = genai.GenerativeModel(name)
+            _models[name] = modelo
+        return modelo
+
+
+def route(model, stage, prompt):
+    """Modelo con el que se hace la llamada: el de la regla que aplique o el del backend."""
+    nombre = select_model(stage, prompt)
+    if nombre is None or nombre == model_name(model):
+        return model
+    return get_model(nombre)
+
+
+def record_usage(stage, model, prompt, response):
+    """Tokens y costo estimado de una llamada completada, por etapa y modelo."""
+    nombre = model_name(model)
+    uso = getattr(response, "usage_metadata", None)
+    entrada = getattr(uso, "prompt_token_count", None) or estimate_input_tokens(prompt)
+    try:
+        salida = getattr(uso, "candidates_token_count", None) or len(response.text) // 4
+    except (ValueError, AttributeError):
+        # response.text falla si la respuesta fue bloqueada
+        salida = 0
+    metrics.LLM_ROUTE_TOKENS.labels(stage, nombre, "input").inc(entrada)
+    metrics.LLM_ROUTE_TOKENS.labels(stage, nombre, "output").inc(salida)
+    precios = PRICES.get(nombre)
+    if precios:
+        metrics.LLM_ROUTE_COST.labels(stage, nombre).inc((entrada * precios[0] + salida * precios[1]) / 1_000_000)
+
+
+def describe():
+    """Configuración de enrutamiento vigente (para /health)."""
+    return {
+        "default_model": LLM_DEFAULT_MODEL,
+        "routes": {etapa: [{"min_tokens": umbral, "model": modelo} for umbral, modelo in reglas]
+                   for etapa, reglas in ROUTES.items()},
+        "priced_models": sorted(PRICES)
+    }
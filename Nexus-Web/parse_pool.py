@@ -0,0 +1,237 @@
+"""
+Parseo de documentos aislado en procesos hijos con límites de recursos.
+
+Un PDF malformado o un DOCX enorme puede dejar a pypdf/lxml consumiendo CPU
+o memoria sin límite. Si eso ocurre dentro del worker de gunicorn, el worker
+entero (con sus 32 hilos y las peticiones en curso) termina bloqueado o
+muerto por el timeout de gunicorn. Aquí el parseo corre en un pool de
+procesos hijos (parse_worker.py) lanzados por adelantado:
+
+    - cada trabajo tiene un presupuesto de CPU (RLIMIT_CPU, lo aplica el hijo)
+    - cada hijo tiene un tope de memoria (RLIMIT_AS)
+    - el padre espera como máximo PARSE_TIMEOUT_SECONDS de tiempo real y, si
+      se agota, mata al hijo
+
+Cuando un hijo muere o se mata, la petición recibe un ParseError con un
+mensaje claro y el hijo se reemplaza; el worker web sigue atendiendo.
+
+Los hijos se lanzan como scripts nuevos (no con fork) para que no hereden la
+memoria ni los hilos del worker web. Cada worker de gunicorn tiene su propio
+pool (ver post_worker_init en gunicorn.conf.py).
+
+Configuración:
+    PARSE_POOL_SIZE          procesos de parseo por worker (0 = parsear en el propio proceso)
+    PARSE_CPU_SECONDS        segundos de CPU por documento
+    PARSE_MEMORY_MB          memoria virtual máxima de cada proceso de parseo
+    PARSE_TIMEOUT_SECONDS    tiempo real máximo por documento (y de espera por un proceso libre)
+    PARSE_MAX_JOBS           documentos que parsea un proceso antes de reemplazarse
+"""
+import os
+import queue
+import signal
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing.connection import Connection
+
+import metrics
+import parse_worker
+
+# Los límites usan resource y pipes POSIX: en Windows se parsea en el propio proceso
+PARSE_POOL_SIZE = int(os.getenv("PARSE_POOL_SIZE", "2" if os.name == "posix" else "0"))
+PARSE_CPU_SECONDS = int(os.getenv("PARSE_CPU_SECONDS", "60"))
+PARSE_MEMORY_MB = int(os.getenv("PARSE_MEMORY_MB", "1024"))
+PARSE_TIMEOUT_SECONDS = float(os.getenv("PARSE_TIMEOUT_SECONDS", "120"))
+PARSE_MAX_JOBS = int(os.getenv("PARSE_MAX_JOBS", "50"))
+
+_WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "parse_worker.py")
+
+_slots = None
+_slots_pid = None
+_slots_lock = threading.Lock()
+
+
+class ParseError(Exception):
+    """El documento no se pudo parsear (error del parser o límite de recursos excedido)."""
+
+    def __init__(self, outcome, message):
+        super().__init__(message)
+        self.outcome = outcome
+
+
+class _Worker:
+    """Proceso de parseo con sus dos extremos de pipe."""
+
+    def __init__(self):
+        lectura_hijo, escritura_padre = os.pipe()
+        lectura_padre, escritura_hijo = os.pipe()
+        try:
+            self.process = subprocess.Popen(
+                [sys.executable, _WORKER_SCRIPT, str(lectura_hijo), str(escritura_hijo),
+                 str(PARSE_CPU_SECONDS), str(PARSE_MEMORY_MB), str(PARSE_MAX_JOBS)],
+                pass_fds=(lectura_hijo, escritura_hijo),
+                stdin=subprocess.DEVNULL
+            )
+        except Exception:
+            os.close(escritura_padre)
+            os.close(lectura_padre)
+            raise
+        finally:
+            os.close(lectura_hijo)
+            os.close(escritura_hijo)
+        self.conn_out = Connection(escritura_padre, readable=False)
+        self.conn_in = Connection(lectura_padre, writable=False)
+        self.jobs = 0
+
+    def usable(self):
+        return self.jobs < PARSE_MAX_JOBS and self.process.poll() is None
+
+    def stop(self, kill=False):
+        """Termina el proceso (cerrando su entrada o matándolo) y devuelve su código de salida."""
+        if kill:
+            try:
+                self.process.kill()
+            except OSError:
+                pass
+        self.conn_out.close()
+        self.conn_in.close()
+        try:
+            return self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            return self.process.wait()
+
+
+def _get_slots():
+    """Cola de procesos libres del pool de este proceso, creada de nuevo tras un fork."""
+    global _slots, _slots_pid
+    with _slots_lock:
+        if _slots is None or _slots_pid != os.getpid():
+            # None = hueco sin proceso; se lanza al usarlo
+            _slots = queue.Queue()
+            for _ in range(PARSE_POOL_SIZE):
+                _slots.put(None)
+            _slots_pid = os.getpid()
+        return _slots
+
+
+def warm():
+    """Lanza por adelantado los procesos del pool que falten."""
+    if PARSE_POOL_SIZE <= 0:
+        return
+    slots = _get_slots()
+    workers = []
+    for _ in range(PARSE_POOL_SIZE):
+        try:
+            workers.append(slots.get_nowait())
+        except queue.Empty:
+            break
+    for i, worker in enumerate(workers):
+        if worker is None or not worker.usable():
+            try:
+                workers[i] = _Worker()
+            except OSError as e:
+                print(f"⚠️ No se pudo lanzar un proceso de parseo: {e}")
+                workers[i] = None
+    for worker in workers:
+        slots.put(worker)
+
+
+def _crash_error(codigo):
+    if codigo == -signal.SIGXCPU:
+        return ParseError("cpu_limit", f"El parseo del documento excedió el límite de {PARSE_CPU_SECONDS} s de CPU")
+    if codigo == -signal.SIGKILL:
+        # Sin otra causa conocida, SIGKILL suele venir del OOM killer
+        return ParseError("memory_limit", "El proceso de parseo fue terminado por el sistema (memoria insuficiente)")
+    return ParseError("crashed", f"El proceso de parseo terminó inesperadamente (código {codigo})")
+
+
+def _send(worker, file_path, opciones):
+    """Envía el trabajo a un proceso libre. Devuelve el proceso que lo recibió."""
+    if worker is not None and not worker.usable():
+        worker.stop()
+        worker = None
+    if worker is None:
+        worker = _Worker()
+    try:
+        worker.conn_out.send((os.path.abspath(file_path), opciones))
+    except OSError:
+        # El proceso murió mientras estaba libre: se reintenta una vez con uno nuevo
+        worker.stop(kill=True)
+        worker = _Worker()
+        worker.conn_out.send((os.path.abspath(file_path), opciones))
+    worker.jobs += 1
+    return worker
+
+
+def _receive(worker):
+    """Espera la respuesta del proceso. Si se excede un límite el proceso queda terminado."""
+    if not worker.conn_in.poll(PARSE_TIMEOUT_SECONDS):
+        worker.stop(kill=True)
+        raise ParseError("timeout", f"El parseo del documento excedió {PARSE_TIMEOUT_SECONDS:g} s")
+    try:
+        resultado, valor = worker.conn_in.recv()
+    except (EOFError, OSError):
+        raise _crash_error(worker.stop(kill=True))
+
+    if resultado == parse_worker.RESULT_MEMORY:
+        worker.stop(kill=True)
+        raise ParseError("memory_limit", f"{valor} ({PARSE_MEMORY_MB} MB)")
+    if resultado == parse_worker.RESULT_ERROR:
+        raise ParseError("error", valor)
+    return valor
+
+
+def extract(file_path, tables=True, skip_empty=True, pdf_separator="\n"):
+    """
+    Texto del documento (.docx o .pdf) parseado en un proceso del pool.
+    Las opciones son las de parse_worker.parse_document.
+    Lanza ParseError si el parser falla o el documento excede algún límite.
+    """
+    opciones = {"tables": tables, "skip_empty": skip_empty, "pdf_separator": pdf_separator}
+    if PARSE_POOL_SIZE <= 0:
+        return parse_worker.parse_document(file_path, **opciones)
+
+    slots = _get_slots()
+    inicio = time.perf_counter()
+    outcome = "ok"
+    try:
+        try:
+            worker = slots.get(timeout=PARSE_TIMEOUT_SECONDS)
+        except queue.Empty:
+            raise ParseError("timeout", "No hay procesos de parseo libres; intenta de nuevo en unos momentos")
+        try:
+            worker = _send(worker, file_path, opciones)
+            return _receive(worker)
+        except ParseError as e:
+            # Un error del parser deja al proceso sano; los límites excedidos lo descartan
+            if e.outcome != "error":
+                worker = None
+            raise
+        except Exception:
+            if worker is not None:
+                worker.stop(kill=True)
+                worker = None
+            raise
+        finally:
+            slots.put(worker)
+    except ParseError as e:
+        outcome = e.outcome
+        print(f"Error parseando {os.path.basename(file_path)} ({outcome}): {e}")
+        raise
+    finally:
+        metrics.DOCUMENT_PARSE.labels(outcome).inc()
+        metrics.DOCUMENT_PARSE_LATENCY.observe(time.perf_counter() - inicio)
+
+
+def get_stats():
+    """Configuración y estado del pool de este proceso (para /health)."""
+    slots = _slots if _slots_pid == os.getpid() else None
+    return {
+        "pool_size": PARSE_POOL_SIZE,
+        "idle": slots.qsize() if slots is not None else 0,
+        "cpu_seconds": PARSE_CPU_SECONDS,
+        "memory_mb": PARSE_MEMORY_MB,
+        "timeout_seconds": PARSE_TIMEOUT_SECONDS
+    }
@@ -0,0 +1,90 @@
+"""
+Proceso de parseo de documentos (lado hijo de parse_pool).
+
+Se ejecuta como script independiente (python parse_worker.py ...) para que el
+proceso hijo solo cargue los parsers (lxml, pypdf) y no la aplicación web.
+Aplica sus propios límites de recursos:
+
+    - memoria: RLIMIT_AS fijo para todo el proceso (un PDF que la agota
+      produce MemoryError y el proceso se recicla)
+    - CPU: antes de cada trabajo el límite blando de RLIMIT_CPU se fija en el
+      tiempo de CPU ya consumido más el presupuesto del trabajo; si se supera,
+      el kernel envía SIGXCPU y el proceso muere
+
+El límite de tiempo real lo aplica el proceso padre.
+
+Los límites son solo POSIX: resource se importa en serve(), así este módulo
+(y con él parse_pool y la app) se importa también en Windows, donde
+parse_pool llama a parse_document en el propio proceso.
+
+Protocolo: el padre envía (ruta, opciones) por una multiprocessing.Connection
+y el hijo responde ("ok", texto) o (clase_de_error, mensaje).
+"""
+import os
+import sys
+from multiprocessing.connection import Connection
+
+import docx_stream
+from pypdf import PdfReader
+
+RESULT_OK = "ok"
+RESULT_ERROR = "error"
+RESULT_MEMORY = "memory"
+
+
+def parse_document(file_path, tables=True, skip_empty=True, pdf_separator="\n"):
+    """
+    Texto de un .docx o .pdf.
+    DOCX: párrafos (y celdas si tables) en orden del documento.
+    PDF: páginas unidas con pdf_separator; con separador el resultado se recorta.
+    """
+    if file_path.endswith('.docx'):
+        return docx_stream.extract_docx_text(file_path, tables=tables, skip_empty=skip_empty)
+    elif file_path.endswith('.pdf'):
+        with open(file_path, 'rb') as f:
+            reader = PdfReader(f)
+            texto = "".join(extracted + pdf_separator for extracted in
+                            (page.extract_text() for page in reader.pages) if extracted)
+        return texto.strip() if pdf_separator else texto
+    else:
+        raise ValueError("Formato de archivo no soportado. Usa .docx o .pdf.")
+
+
+def _cpu_seconds():
+    import resource
+
+    uso = resource.getrusage(resource.RUSAGE_SELF)
+    return uso.ru_utime + uso.ru_stime
+
+
+def serve(conn_in, conn_out, cpu_seconds, memory_mb, max_jobs):
+    """Atiende trabajos hasta que el padre cierra la conexión o se alcanzan max_jobs."""
+    import resource
+
+    if memory_mb:
+        limite = memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limite, limite))
+    _, cpu_hard = resource.getrlimit(resource.RLIMIT_CPU)
+
+    for _ in range(max_jobs):
+        try:
+            file_path, opciones = conn_in.recv()
+        except EOFError:
+            return
+        if cpu_seconds:
+            # Solo el límite blando: así se puede volver a subir en el siguiente trabajo
+            resource.setrlimit(resource.RLIMIT_CPU, (int(_cpu_seconds() + cpu_seconds) + 1, cpu_hard))
+        try:
+            conn_out.send((RESULT_OK, parse_document(file_path, **opciones)))
+        except MemoryError:
+            # Tras quedarse sin memoria el proceso no es confiable: responde y termina
+            conn_out.send((RESULT_MEMORY, "El documento excede la memoria permitida para el parseo"))
+            return
+        except Exception as e:
+            conn_out.send((RESULT_ERROR, str(e) or type(e).__name__))
+
+
+if __name__ == "__main__":
+    lectura, escritura, cpu, memoria, trabajos = (int(arg) for arg in sys.argv[1:6])
+    serve(Connection(lectura, writable=False), Connection(escritura, readable=False), cpu, memoria, trabajos)
+    os._exit(0)
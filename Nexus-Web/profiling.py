@@ -0,0 +1,260 @@
+"""
+Perfilado bajo demanda de peticiones individuales.
+
+Cuando un documento concreto hace lenta una generación, se puede perfilar esa
+petición: con la cabecera X-Profile-Token (igual a PROFILE_ADMIN_TOKEN) o por
+muestreo (PROFILE_SAMPLE_RATE). Se capturan un perfil de CPU (cProfile) del
+hilo que atiende la petición, incluida la exportación en streaming, y las
+asignaciones de memoria con tracemalloc: el pico, y las líneas con más
+memoria viva al terminar la vista y al terminar la respuesta.
+
+El resultado se guarda en PROFILE_DIR con un id que se devuelve en la
+cabecera X-Profile-Id: un JSON con el resumen (funciones con más tiempo
+acumulado y asignaciones principales) y el perfil completo en formato pstats
+(para pstats, snakeviz, etc.). El directorio es compartido entre los workers
+del host, así que cualquier worker puede servir el resultado.
+
+Las llamadas al LLM corren en el event loop de llm_client y el parseo en los
+procesos de parse_pool: en el perfil aparecen como espera en llm_client.run y
+parse_pool._receive. tracemalloc es global al proceso, así que las
+asignaciones incluyen las de otras peticiones simultáneas del mismo worker,
+y solo se perfila una petición a la vez por proceso (las demás se atienden
+sin perfilar). Sin perfilado activo el costo es una búsqueda en un conjunto y
+una cabecera por petición.
+
+Configuración:
+    PROFILE_ADMIN_TOKEN        token para pedir perfiles y consultarlos (vacío = solo muestreo)
+    PROFILE_SAMPLE_RATE        fracción de peticiones perfiladas al azar (0 = ninguna)
+    PROFILE_ENDPOINTS          endpoints de Flask perfilables, separados por comas
+    PROFILE_DIR                directorio de los perfiles (compartido entre workers del host)
+    PROFILE_TTL                segundos que se conservan los perfiles
+    PROFILE_TOP_FUNCTIONS      funciones del resumen de CPU
+    PROFILE_TOP_ALLOCATIONS    líneas del resumen de memoria
+"""
+import cProfile
+import hmac
+import json
+import os
+import pstats
+import random
+import re
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+
+import metrics
+
+PROFILE_ADMIN_TOKEN = os.getenv("PROFILE_ADMIN_TOKEN", "")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_ENDPOINTS = frozenset(filter(None, (e.strip() for e in os.getenv(
+    "PROFILE_ENDPOINTS", "generate_matrix,matrix_coverage,generate_and_download_story,preview").split(","))))
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(tempfile.gettempdir(), "nexus_profiles"))
+PROFILE_TTL = float(os.getenv("PROFILE_TTL", "86400"))
+PROFILE_TOP_FUNCTIONS = int(os.getenv("PROFILE_TOP_FUNCTIONS", "40"))
+PROFILE_TOP_ALLOCATIONS = int(os.getenv("PROFILE_TOP_ALLOCATIONS", "25"))
+
+TOKEN_HEADER = "X-Profile-Token"
+ID_HEADER = "X-Profile-Id"
+
+TRIGGER_HEADER = "header"
+TRIGGER_SAMPLE = "sample"
+
+_PROFILE_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+# Asignaciones del propio perfilado que no interesan en el resumen
+_TRACEMALLOC_FILTERS = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, cProfile.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+]
+
+# Una petición perfilada a la vez por proceso (tracemalloc es global)
+_busy = threading.Lock()
+
+
+class ProfileNotFound(Exception):
+    """El perfil no existe o expiró."""
+
+
+def authorized(token):
+    """Indica si el token coincide con PROFILE_ADMIN_TOKEN (siempre False si no está configurado)."""
+    return bool(PROFILE_ADMIN_TOKEN) and bool(token) and hmac.compare_digest(token, PROFILE_ADMIN_TOKEN)
+
+
+def should_profile(endpoint, token):
+    """Devuelve el disparador (header o sample) si la petición debe perfilarse, o None."""
+    if endpoint not in PROFILE_ENDPOINTS:
+        return None
+    if token is not None and authorized(token):
+        return TRIGGER_HEADER
+    if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+        return TRIGGER_SAMPLE
+    return None
+
+
+class RequestProfile:
+    """Perfilado de CPU y memoria de una petición, desde start() hasta finish()."""
+
+    def __init__(self, endpoint, path, trigger):
+        self.id = uuid.uuid4().hex
+        self.endpoint = endpoint
+        self.path = path
+        self.trigger = trigger
+        self._profiler = cProfile.Profile()
+        self._owns_tracemalloc = False
+        self._allocations = {}
+        self._started = None
+        self._start_time = None
+        self._finished = False
+
+    def start(self):
+        """Empieza a perfilar en el hilo actual. Devuelve False si otra petición del proceso ya se perfila."""
+        if not _busy.acquire(blocking=False):
+            metrics.REQUEST_PROFILES.labels(self.endpoint, self.trigger, "busy").inc()
+            return False
+        try:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._owns_tracemalloc = True
+            tracemalloc.reset_peak()
+            self._started = time.time()
+            self._start_time = time.perf_counter()
+            # Lanza ValueError si otra herramienta de perfilado ya está activa
+            self._profiler.enable()
+        except Exception:
+            self._release()
+            metrics.REQUEST_PROFILES.labels(self.endpoint, self.trigger, "error").inc()
+            raise
+        return True
+
+    def snapshot(self, phase):
+        """Guarda las líneas con más memoria viva en este punto de la petición (p. ej. al terminar la vista)."""
+        if self._finished:
+            return
+        self._profiler.disable()
+        try:
+            estadisticas = tracemalloc.take_snapshot().filter_traces(_TRACEMALLOC_FILTERS).statistics("lineno")
+            self._allocations[phase] = [
+                {"location": f"{s.traceback[0].filename}:{s.traceback[0].lineno}", "size_bytes": s.size,
+                 "count": s.count}
+                for s in estadisticas[:PROFILE_TOP_ALLOCATIONS]
+            ]
+        finally:
+            self._profiler.enable()
+
+    def finish(self, status):
+        """Detiene el perfilado, guarda el resultado y libera el perfilador. Se puede llamar más de una vez."""
+        if self._finished:
+            return
+        self._profiler.disable()
+        duracion = time.perf_counter() - self._start_time
+        try:
+            self.snapshot("response")
+            actual, pico = tracemalloc.get_traced_memory()
+        finally:
+            self._finished = True
+            self._release()
+        try:
+            self._save(status, duracion, actual, pico)
+        except Exception as e:
+            metrics.REQUEST_PROFILES.labels(self.endpoint, self.trigger, "error").inc()
+            print(f"Error guardando el perfil {self.id} de {self.endpoint}: {e}")
+            return
+        metrics.REQUEST_PROFILES.labels(self.endpoint, self.trigger, "stored").inc()
+
+    def _release(self):
+        if self._owns_tracemalloc:
+            tracemalloc.stop()
+            self._owns_tracemalloc = False
+        _busy.release()
+
+    def _top_functions(self):
+        estadisticas = pstats.Stats(self._profiler)
+        filas = sorted(estadisticas.stats.items(), key=lambda item: item[1][3], reverse=True)
+        return [
+            {"function": pstats.func_std_string(funcion), "calls": llamadas, "primitive_calls": primitivas,
+             "tottime": round(tottime, 6), "cumtime": round(cumtime, 6)}
+            for funcion, (primitivas, llamadas, tottime, cumtime, _) in filas[:PROFILE_TOP_FUNCTIONS]
+        ]
+
+    def _save(self, status, duracion, actual, pico):
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        _cleanup_expired()
+        resumen = {
+            "id": self.id,
+            "endpoint": self.endpoint,
+            "path": self.path,
+            "trigger": self.trigger,
+            "status": status,
+            "pid": os.getpid(),
+            "started": self._started,
+            "duration_seconds": round(duracion, 4),
+            "cpu": {"top_functions": self._top_functions()},
+            "memory": {"current_bytes": actual, "peak_bytes": pico, "top_allocations": self._allocations}
+        }
+        # Primero el pstats: el JSON es el que hace visible el perfil
+        temporal = os.path.join(PROFILE_DIR, f".{self.id}.prof.tmp")
+        self._profiler.dump_stats(temporal)
+        os.replace(temporal, _path(self.id, "prof"))
+        temporal = os.path.join(PROFILE_DIR, f".{self.id}.json.tmp")
+        with open(temporal, "w", encoding="utf-8") as f:
+            json.dump(resumen, f, ensure_ascii=False)
+        os.replace(temporal, _path(self.id, "json"))
+
+
+def _path(profile_id, extension):
+    return os.path.join(PROFILE_DIR, f"{profile_id}.{extension}")
+
+
+def summary(profile_id):
+    """Resumen JSON de un perfil. Lanza ProfileNotFound si no existe."""
+    if not profile_id or not _PROFILE_ID_RE.match(profile_id):
+        raise ProfileNotFound(profile_id)
+    try:
+        with open(_path(profile_id, "json"), encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        raise ProfileNotFound(profile_id)
+
+
+def pstats_path(profile_id):
+    """Ruta del perfil de CPU en formato pstats. Lanza ProfileNotFound si no existe."""
+    if not profile_id or not _PROFILE_ID_RE.match(profile_id) or not os.path.exists(_path(profile_id, "prof")):
+        raise ProfileNotFound(profile_id)
+    return _path(profile_id, "prof")
+
+
+def list_profiles(limit=50):
+    """Perfiles guardados más recientes primero, sin el detalle de CPU y memoria."""
+    try:
+        nombres = [n for n in os.listdir(PROFILE_DIR) if n.endswith(".json") and not n.startswith(".")]
+    except FileNotFoundError:
+        return []
+    perfiles = []
+    for nombre in nombres:
+        try:
+            datos = summary(nombre[:-len(".json")])
+        except (ProfileNotFound, ValueError):
+            continue
+        perfiles.append({
+            "id": datos["id"], "endpoint": datos["endpoint"], "path": datos["path"], "trigger": datos["trigger"],
+            "status": datos["status"], "started": datos["started"], "duration_seconds": datos["duration_seconds"],
+            "peak_bytes": datos["memory"]["peak_bytes"]
+        })
+    perfiles.sort(key=lambda p: p["started"], reverse=True)
+    return perfiles[:limit]
+
+
+def _cleanup_expired():
+    """Borra perfiles más antiguos que PROFILE_TTL (se llama de forma oportunista al guardar)."""
+    limite = time.time() - PROFILE_TTL
+    for nombre in os.listdir(PROFILE_DIR):
+        ruta = os.path.join(PROFILE_DIR, nombre)
+        try:
+            if os.path.getmtime(ruta) < limite:
+                os.remove(ruta)
+        except OSError:
+            pass
@@ -0,0 +1,100 @@
+"""
+Gobernador de cuota de Gemini compartido entre procesos.
+
+Mantiene dos token buckets (peticiones por minuto y tokens estimados por
+minuto) en una base SQLite local. Todos los workers de gunicorn del mismo
+host comparten el archivo, y cada llamada al LLM espera a que haya
+presupuesto en lugar de fallar por cuota excedida.
+
+Configuración:
+    GEMINI_RPM               peticiones por minuto (0 desactiva el límite)
+    GEMINI_TPM               tokens por minuto (0 desactiva el límite)
+    GEMINI_GOVERNOR_DB       ruta del archivo SQLite compartido
+    GEMINI_OUTPUT_TOKENS     tokens de salida estimados por llamada
+"""
+import asyncio
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+import metrics
+
+GEMINI_RPM = float(os.getenv("GEMINI_RPM", "300"))
+GEMINI_TPM = float(os.getenv("GEMINI_TPM", "1000000"))
+GOVERNOR_DB = os.getenv("GEMINI_GOVERNOR_DB", os.path.join(tempfile.gettempdir(), "nexus_gemini_governor.sqlite"))
+OUTPUT_TOKENS_ESTIMATE = int(os.getenv("GEMINI_OUTPUT_TOKENS", "2048"))
+
+# Espera máxima entre reintentos de adquisición (el presupuesto se recalcula en cada intento)
+_MAX_SLEEP = 5.0
+
+
+def estimate_tokens(prompt):
+    """Estimación barata de tokens de una llamada: ~4 caracteres por token más la salida esperada."""
+    return len(str(prompt)) // 4 + OUTPUT_TOKENS_ESTIMATE
+
+
+def _connect():
+    conn = sqlite3.connect(GOVERNOR_DB, timeout=30, isolation_level=None)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+    )
+    return conn
+
+
+def try_acquire(tokens):
+    """
+    Intenta consumir una petición y `tokens` tokens de forma atómica entre procesos.
+    Devuelve 0 si se consumió el presupuesto o los segundos a esperar antes de reintentar.
+    """
+    limites = [(nombre, capacidad, necesario)
+               for nombre, capacidad, necesario in (("rpm", GEMINI_RPM, 1), ("tpm", GEMINI_TPM, tokens))
+               if capacidad > 0]
+    if not limites:
+        return 0
+
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        ahora = time.time()
+        estado = {}
+        espera = 0.0
+        for nombre, capacidad, necesario in limites:
+            fila = conn.execute("SELECT tokens, updated FROM buckets WHERE name = ?", (nombre,)).fetchone()
+            disponibles, actualizado = fila if fila else (capacidad, ahora)
+            por_segundo = capacidad / 60.0
+            disponibles = min(capacidad, disponibles + (ahora - actualizado) * por_segundo)
+            # Una llamada mayor que la capacidad completa nunca cabría: se limita a la capacidad
+            necesario = min(necesario, capacidad)
+            estado[nombre] = (disponibles, necesario)
+            if disponibles < necesario:
+                espera = max(espera, (necesario - disponibles) / por_segundo)
+
+        for nombre, (disponibles, necesario) in estado.items():
+            restantes = disponibles if espera else disponibles - necesario
+            conn.execute("INSERT OR REPLACE INTO buckets (name, tokens, updated) VALUES (?, ?, ?)",
+                         (nombre, restantes, ahora))
+        conn.execute("COMMIT")
+        return espera
+    except Exception:
+        # Si falló el propio BEGIN no hay transacción que deshacer
+        if conn.in_transaction:
+            conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+async def acquire(prompt):
+    """Espera (sin bloquear el event loop) hasta que haya cuota para una llamada con este prompt."""
+    tokens = estimate_tokens(prompt)
+    loop = asyncio.get_running_loop()
+    inicio = time.monotonic()
+    while True:
+        espera = await loop.run_in_executor(None, try_acquire, tokens)
+        if not espera:
+            break
+        # Jitter para que los procesos que esperan no reintenten todos a la vez
+        await asyncio.sleep(min(espera, _MAX_SLEEP) * random.uniform(1.0, 1.2))
+    metrics.LLM_QUOTA_WAIT.observe(time.monotonic() - inicio)
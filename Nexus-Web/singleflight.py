@@ -0,0 +1,232 @@
+"""
+Coalescencia "single-flight" de peticiones de generación idénticas.
+
+Cuando varias personas suben el mismo archivo con los mismos parámetros casi
+a la vez, solo la primera petición (líder) ejecuta la generación; las demás
+esperan y reciben el mismo resultado.
+
+La coordinación se hace con archivos para que funcione entre workers de
+gunicorn del mismo host: el líder crea un archivo de bloqueo de forma
+exclusiva (O_EXCL) con su PID y, al terminar, escribe el resultado en JSON
+de forma atómica. Los resultados se conservan SINGLEFLIGHT_RESULT_TTL
+segundos para los seguidores que aún no lo han leído.
+
+Solo se rompe el bloqueo de un líder cuyo proceso ya no existe, y cada líder
+borra el bloqueo únicamente si sigue siendo suyo. Un seguidor espera como
+mucho SINGLEFLIGHT_WAIT_TIMEOUT o lo que le quede de plazo a su petición; si
+se le acaba, genera por su cuenta sin tomar el bloqueo ni publicar el
+resultado.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import time
+import uuid
+
+import cancellation
+import deadline
+import metrics
+
+SINGLEFLIGHT_DIR = os.getenv("SINGLEFLIGHT_DIR", os.path.join(tempfile.gettempdir(), "nexus_singleflight"))
+RESULT_TTL = float(os.getenv("SINGLEFLIGHT_RESULT_TTL", "30"))
+WAIT_TIMEOUT = float(os.getenv("SINGLEFLIGHT_WAIT_TIMEOUT", "900"))
+_POLL_INTERVAL = 0.25
+
+
+class SingleFlightError(Exception):
+    """Error de la ejecución líder, propagado a los seguidores."""
+
+
+def request_key(endpoint, file_path, params):
+    """Huella de una petición: endpoint, contenido del archivo y parámetros del formulario."""
+    digest = hashlib.sha256()
+    digest.update(endpoint.encode("utf-8"))
+    with open(file_path, "rb") as f:
+        for bloque in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(bloque)
+    digest.update(json.dumps(params, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _paths(key):
+    return os.path.join(SINGLEFLIGHT_DIR, f"{key}.lock"), os.path.join(SINGLEFLIGHT_DIR, f"{key}.json")
+
+
+def _try_lock(lock_path):
+    """Crea el bloqueo de forma exclusiva. Devuelve su contenido ("<pid> <id>") o None si ya existe."""
+    try:
+        fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return None
+    # El id distingue a líderes del mismo proceso (hilos de gthread)
+    propietario = f"{os.getpid()} {uuid.uuid4().hex}"
+    with os.fdopen(fd, "w") as f:
+        f.write(propietario)
+    return propietario
+
+
+def _read_lock(lock_path):
+    try:
+        with open(lock_path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _stale_lock(lock_path):
+    """Contenido del bloqueo si su líder murió (o nunca llegó a escribir su PID), si no None."""
+    contenido = _read_lock(lock_path)
+    if contenido is None:
+        return None
+    try:
+        pid = int(contenido.split()[0]) if contenido else 0
+    except ValueError:
+        pid = 0
+    if pid <= 0:
+        # El líder aún no escribió su PID: solo se da por abandonado pasado un margen
+        try:
+            return contenido if time.time() - os.path.getmtime(lock_path) > 5 else None
+        except OSError:
+            return None
+    return None if _pid_alive(pid) else contenido
+
+
+def _remove_lock_if(lock_path, contenido):
+    """
+    Borra el bloqueo solo si sigue teniendo `contenido`. Se renombra antes de
+    comprobarlo para no borrar el bloqueo que otro proceso acaba de crear.
+    """
+    apartado = f"{lock_path}.{os.getpid()}.{uuid.uuid4().hex}"
+    try:
+        os.rename(lock_path, apartado)
+    except FileNotFoundError:
+        return
+    if _read_lock(apartado) == contenido:
+        os.remove(apartado)
+        return
+    # Era el bloqueo de otro: se devuelve a su sitio (link falla si ya hay uno nuevo)
+    try:
+        os.link(apartado, lock_path)
+    except FileExistsError:
+        pass
+    os.remove(apartado)
+
+
+def _wait_limit():
+    """Hasta cuándo espera un seguidor: WAIT_TIMEOUT o el presupuesto que le queda a la petición."""
+    espera = WAIT_TIMEOUT
+    plazo = deadline.current()
+    if plazo is not None:
+        espera = min(espera, plazo.llm_budget())
+    return time.monotonic() + espera
+
+
+def _read_result(result_path):
+    try:
+        if time.time() - os.path.getmtime(result_path) > RESULT_TTL:
+            return None
+        with open(result_path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _to_json(obj):
+    """Serializa objetos del dominio que exponen to_dict() (por ejemplo, TestCase)."""
+    if hasattr(obj, "to_dict"):
+        return obj.to_dict()
+    raise TypeError(f"Objeto no serializable en JSON: {type(obj).__name__}")
+
+
+def _write_result(result_path, payload):
+    tmp_path = f"{result_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(payload, f, ensure_ascii=False, default=_to_json)
+    os.replace(tmp_path, result_path)
+
+
+def _cleanup_expired():
+    """Borra resultados vencidos (se llama de forma oportunista)."""
+    ahora = time.time()
+    try:
+        nombres = os.listdir(SINGLEFLIGHT_DIR)
+    except OSError:
+        return
+    for nombre in nombres:
+        if nombre.endswith(".json"):
+            ruta = os.path.join(SINGLEFLIGHT_DIR, nombre)
+            try:
+                if ahora - os.path.getmtime(ruta) > RESULT_TTL:
+                    os.remove(ruta)
+            except OSError:
+                pass
+
+
+def do(key, fn, private_errors=()):
+    """
+    Ejecuta fn() una sola vez para todas las peticiones concurrentes con la misma clave.
+    fn debe devolver un valor serializable en JSON (se admiten objetos con to_dict()).
+    Las excepciones de `private_errors` (por ejemplo, una cancelación del cliente) no se
+    comparten: el líder libera el bloqueo sin resultado y otro seguidor toma el relevo.
+    Un seguidor que agota su espera ejecuta fn() por su cuenta, sin bloqueo ni resultado compartido.
+    Devuelve (resultado, compartido) donde compartido indica que se reutilizó el de otra petición.
+    """
+    os.makedirs(SINGLEFLIGHT_DIR, exist_ok=True)
+    lock_path, result_path = _paths(key)
+    limite = _wait_limit()
+
+    hay_lider = False
+    while True:
+        # Si ya vimos un líder, su resultado tiene prioridad sobre tomar el bloqueo liberado
+        if hay_lider:
+            resultado = _read_result(result_path)
+            if resultado is not None:
+                metrics.record_cache("singleflight", True)
+                if "error" in resultado:
+                    raise SingleFlightError(resultado["error"])
+                return resultado["value"], True
+
+        propietario = _try_lock(lock_path)
+        if propietario is not None:
+            break
+        hay_lider = True
+
+        # Un seguidor cuyo cliente canceló deja de esperar
+        cancellation.check()
+        abandonado = _stale_lock(lock_path)
+        if abandonado is not None:
+            _remove_lock_if(lock_path, abandonado)
+            continue
+        if time.monotonic() > limite:
+            # El líder sigue vivo: nunca se le quita el bloqueo
+            print(f"Single-flight: espera agotada para {key[:12]}, se genera sin compartir")
+            metrics.record_cache("singleflight", False)
+            return fn(), False
+        time.sleep(_POLL_INTERVAL)
+
+    # Somos el líder
+    metrics.record_cache("singleflight", False)
+    _cleanup_expired()
+    try:
+        try:
+            valor = fn()
+        except private_errors:
+            raise
+        except Exception as e:
+            _write_result(result_path, {"error": str(e)})
+            raise
+        _write_result(result_path, {"value": valor})
+        return valor, False
+    finally:
+        _remove_lock_if(lock_path, propietario)
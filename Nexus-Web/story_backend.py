@@ -1,26 +1,29 @@
 import os
 import google.generativeai as genai
 import docx
-from pypdf import PdfReader
 import re
+import asyncio
+
+import cancellation
+import checkpoints
+import deadline
+import metrics
+import llm_client
+import model_router
+import parse_pool
+
+# Lotes de historias que se envían al LLM en paralelo por documento
+STORY_BATCH_CONCURRENCY = int(os.getenv("STORY_BATCH_CONCURRENCY", "4"))
 
 # -----------------------------
 # Funciones auxiliares
 # -----------------------------
 def extract_text_from_file(file_path):
-    """Extrae texto de archivos .docx o .pdf."""
-    if file_path.endswith('.docx'):
-        doc = docx.Document(file_path)
-        return "\n".join([para.text for para in doc.paragraphs])
-    elif file_path.endswith('.pdf'):
-        with open(file_path, 'rb') as f:
-            reader = PdfReader(f)
-            text = ""
-            for page in reader.pages:
-                text += page.extract_text() or ""
-            return text
-    else:
+    """Extrae texto de archivos .docx o .pdf (en un proceso aislado, ver parse_pool)."""
+    if not file_path.endswith(('.docx', '.pdf')):
         raise ValueError("Formato de archivo no soportado. Usa .docx o .pdf.")
+    # Solo párrafos del cuerpo, incluidos los vacíos; páginas del PDF sin separador
+    return parse_pool.extract(file_path, tables=False, skip_empty=False, pdf_separator="")
 
 def split_document_into_chunks(text, max_chunk_size=3000):
     """Divide el documento en chunks manejables."""
@@ -294,64 +297,122 @@ IMPORTANTE: Integra el contexto adicional de negocio en los criterios y métrica
 
     return prompt
 
+async def identificar_funcionalidades(model, document_text, role, business_context=None):
+    """Fase 1 de process_large_document: lista numerada de funcionalidades del documento."""
+    print("🔍 Fase 1: Identificando todas las funcionalidades...")
+    analysis_prompt = create_analysis_prompt(document_text, role, business_context)
+    analysis_response = await llm_client.generate_content_async(model, analysis_prompt, llm_client.STAGE_STORY_ANALYSIS,
+                                                                request_options={"timeout": 90})
+
+    # Extraer lista de funcionalidades
+    functionalities = [line.strip() for line in analysis_response.text.split('\n') if re.match(r'^\d+\.', line.strip())]
+    print(f"✅ Identificadas {len(functionalities)} funcionalidades")
+
+    # Validar número mínimo de funcionalidades
+    MIN_FUNCTIONALITIES = 10
+    if len(functionalities) < MIN_FUNCTIONALITIES:
+        print(f"⚠️ Solo se identificaron {len(functionalities)} funcionalidades, intentando generar más...")
+        extra_prompt = analysis_prompt + f"\nINSTRUCCIÓN ADICIONAL: Genera al menos {MIN_FUNCTIONALITIES} funcionalidades, extrapolando si es necesario."
+        extra_response = await llm_client.generate_content_async(model, extra_prompt, llm_client.STAGE_STORY_ANALYSIS,
+                                                                 request_options={"timeout": 90})
+        extra_functionalities = [line.strip() for line in extra_response.text.split('\n') if re.match(r'^\d+\.', line.strip())]
+        functionalities.extend(extra_functionalities[:MIN_FUNCTIONALITIES - len(functionalities)])
+        print(f"✅ Total funcionalidades tras reintento: {len(functionalities)}")
+
+    return functionalities
+
 def process_large_document(document_text, role, story_type, business_context=None):
     """Procesa documentos grandes dividiéndolos en chunks."""
+    return llm_client.run(process_large_document_async(document_text, role, story_type, business_context))
+
+async def process_large_document_async(document_text, role, story_type, business_context=None):
+    """Versión asíncrona de process_large_document: los lotes de historias se generan en paralelo."""
     try:
         api_key = os.getenv("GOOGLE_API_KEY")
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel("gemini-1.5-flash-latest")
+        llm_client.configure(api_key)
+        model = genai.GenerativeModel(model_router.LLM_DEFAULT_MODEL)
 
         print("📄 Documento grande detectado. Iniciando análisis por fases...")
         print(f"🔍 Debug - business_context recibido: {business_context[:200] if business_context else 'No proporcionado'}...")
         print(f"🔍 Debug - role: {role}")
         print(f"🔍 Debug - story_type: {story_type}")
 
+        # Fases ya completadas por una ejecución anterior del mismo trabajo (reanudación)
+        checkpoint_job = checkpoints.job_key("story", document_text, {
+            "role": role, "story_type": story_type, "business_context": business_context
+        })
+        loop = asyncio.get_running_loop()
+        completados = await loop.run_in_executor(None, checkpoints.load, checkpoint_job)
+
         # Fase 1: Análisis de funcionalidades
-        print("🔍 Fase 1: Identificando todas las funcionalidades...")
-        analysis_prompt = create_analysis_prompt(document_text, role, business_context)
-        analysis_response = model.generate_content(analysis_prompt, request_options={"timeout": 90})
-
-        # Extraer lista de funcionalidades
-        functionalities = [line.strip() for line in analysis_response.text.split('\n') if re.match(r'^\d+\.', line.strip())]
-        print(f"✅ Identificadas {len(functionalities)} funcionalidades")
-
-        # Validar número mínimo de funcionalidades
-        MIN_FUNCTIONALITIES = 10
-        if len(functionalities) < MIN_FUNCTIONALITIES:
-            print(f"⚠️ Solo se identificaron {len(functionalities)} funcionalidades, intentando generar más...")
-            extra_prompt = analysis_prompt + f"\nINSTRUCCIÓN ADICIONAL: Genera al menos {MIN_FUNCTIONALITIES} funcionalidades, extrapolando si es necesario."
-            extra_response = model.generate_content(extra_prompt, request_options={"timeout": 90})
-            extra_functionalities = [line.strip() for line in extra_response.text.split('\n') if re.match(r'^\d+\.', line.strip())]
-            functionalities.extend(extra_functionalities[:MIN_FUNCTIONALITIES - len(functionalities)])
-            print(f"✅ Total funcionalidades tras reintento: {len(functionalities)}")
-
-        # Fase 2: Generar historias por lotes
-        all_stories = []
+        functionalities = checkpoints.lookup(completados, "analysis")
+        if functionalities is not None:
+            print(f"♻️ Reanudando trabajo: {len(functionalities)} funcionalidades ya identificadas")
+        else:
+            functionalities = await identificar_funcionalidades(model, document_text, role, business_context)
+            # Los lotes dependen de esta lista: se guarda para que la reanudación use la misma
+            await loop.run_in_executor(None, checkpoints.save, checkpoint_job, "analysis", functionalities)
+
+        # Fase 2: Generar historias por lotes (en paralelo, limitado por STORY_BATCH_CONCURRENCY)
         batch_size = max(5, len(functionalities) // 2)  # Ajustar batch_size dinámicamente
         total_batches = (len(functionalities) + batch_size - 1) // batch_size
-
-        for batch_num in range(total_batches):
+        semaforo = asyncio.Semaphore(STORY_BATCH_CONCURRENCY)
+        # Lotes que no se llegaron a generar por agotarse el plazo de la petición
+        omitidos = []
+
+        async def generar_lote(batch_num):
+            guardado = checkpoints.lookup(completados, f"batch:{batch_num}")
+            if guardado is not None:
+                return guardado
+            # Si el cliente canceló, no se generan más lotes
+            cancellation.check()
+            # Sin presupuesto de tiempo no se despachan lotes nuevos: se devuelve lo que haya
+            if deadline.exhausted():
+                omitidos.append(batch_num)
+                return None
             start_idx = batch_num * batch_size
             print(f"🔨 Generando lote {batch_num + 1}/{total_batches} (funcionalidades {start_idx + 1}-{min(start_idx + batch_size, len(functionalities))})")
             story_prompt = create_story_generation_prompt(functionalities, document_text, role, business_context, start_idx, batch_size)
             try:
-                story_response = model.generate_content(story_prompt, request_options={"timeout": 120})
-                all_stories.append(story_response.text)
+                async with semaforo:
+                    story_response = await llm_client.generate_content_async(model, story_prompt, llm_client.STAGE_STORY_BATCH,
+                                                                             request_options={"timeout": 120})
                 print(f"✅ Lote {batch_num + 1} completado")
+                await loop.run_in_executor(None, checkpoints.save, checkpoint_job, f"batch:{batch_num}",
+                                           story_response.text)
+                return story_response.text
+            except cancellation.JobCancelled:
+                raise
+            except deadline.DeadlineExceeded:
+                omitidos.append(batch_num)
+                return None
             except Exception as e:
                 print(f"⚠️ Error en lote {batch_num + 1}: {e}")
-                continue
-
-        # Validar número mínimo de historias
+                return None
+
+        lotes = await asyncio.gather(*(generar_lote(batch_num) for batch_num in range(total_batches)))
+        all_stories = [lote for lote in lotes if lote is not None]
+        fallidos = len(lotes) - len(all_stories) - len(omitidos)
+        if omitidos:
+            print(f"⏱️ Plazo agotado: {len(omitidos)}/{total_batches} lotes sin generar, resultado parcial")
+            if not all_stories:
+                return {"status": "error",
+                        "message": "Se agotó el tiempo disponible antes de completar algún lote. Intenta de nuevo: el análisis ya realizado se reutilizará."}
+
+        # Validar número mínimo de historias (sin pasarse del plazo)
         MIN_STORIES = 5
         story_count = sum(story.count("HISTORIA #") for story in all_stories)
-        if story_count < MIN_STORIES:
+        if story_count < MIN_STORIES and not deadline.exhausted():
             print(f"⚠️ Solo se generaron {story_count} historias, intentando generar más...")
             extra_start_idx = len(functionalities)
             extra_prompt = create_story_generation_prompt(functionalities, document_text, role, business_context, 0, MIN_STORIES - story_count)
-            extra_response = model.generate_content(extra_prompt, request_options={"timeout": 120})
-            all_stories.append(extra_response.text)
-            print(f"✅ Historias adicionales generadas")
+            try:
+                extra_response = await llm_client.generate_content_async(model, extra_prompt, llm_client.STAGE_STORY_BATCH,
+                                                                         request_options={"timeout": 120})
+                all_stories.append(extra_response.text)
+                print(f"✅ Historias adicionales generadas")
+            except deadline.DeadlineExceeded:
+                print("⏱️ Plazo agotado, se omiten las historias adicionales")
 
         # Combinar todas las historias
         context_summary = ""
@@ -395,10 +456,24 @@ RESUMEN FINAL
 ✅ Contexto adicional: {'Aplicado' if business_context and not business_context.startswith("AIza") else 'No proporcionado'}
 ✅ Análisis completado exitosamente
 """
+        if omitidos:
+            final_content += f"""⚠️ Resultado parcial: se agotó el tiempo disponible y {len(omitidos)} de {total_batches} lotes quedaron sin generar.
+   Vuelve a enviar el documento para completarlos (los lotes ya generados se reutilizan).
+"""
+            metrics.PARTIAL_RESULTS.labels("story").inc()
 
+        # Trabajo completo: sus checkpoints ya no hacen falta. Si algún lote falló se conservan
+        # para que reenviar el documento solo reintente esos lotes
+        if None not in lotes:
+            await loop.run_in_executor(None, checkpoints.clear, checkpoint_job)
         print("🎉 Análisis completo finalizado exitosamente")
-        return {"status": "success", "story": final_content}
+        return {"status": "success", "story": final_content, "partial": bool(omitidos),
+                "coverage": deadline.coverage(total_batches, total_batches - fallidos - len(omitidos),
+                                              fallidos, len(omitidos))}
 
+    except cancellation.JobCancelled:
+        print("⛔ Procesamiento cancelado por el cliente")
+        raise
     except Exception as e:
         print(f"❌ Error en procesamiento por chunks: {e}")
         return {"status": "error", "message": f"Error en procesamiento avanzado: {e}"}
@@ -408,23 +483,28 @@ def generate_story_from_chunk(chunk, role, story_type, business_context=None):
     Genera una historia de usuario a partir de un fragmento de texto usando la API de Gemini.
     Versión mejorada con prompts avanzados y contexto de negocio.
     """
+    return llm_client.run(generate_story_from_chunk_async(chunk, role, story_type, business_context))
+
+async def generate_story_from_chunk_async(chunk, role, story_type, business_context=None):
+    """Versión asíncrona de generate_story_from_chunk."""
     try:
         api_key = os.getenv("GOOGLE_API_KEY")
         if not api_key:
             return {"status": "error", "message": "API Key no configurada."}
 
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel("gemini-1.5-flash-latest")
+        llm_client.configure(api_key)
+        model = genai.GenerativeModel(model_router.LLM_DEFAULT_MODEL)
 
         # Crear prompt avanzado y detectar si necesita procesamiento especial
         prompt = create_advanced_prompt(chunk, role, story_type, business_context)
 
         # Si el documento requiere procesamiento por chunks
         if prompt == "CHUNK_PROCESSING_NEEDED":
-            return process_large_document(chunk, role, story_type, business_context)
+            return await process_large_document_async(chunk, role, story_type, business_context)
 
         # Generar contenido con el prompt avanzado
-        response = model.generate_content(prompt, request_options={"timeout": 90})
+        response = await llm_client.generate_content_async(model, prompt, llm_client.STAGE_STORY_CHUNK,
+                                                           request_options={"timeout": 90})
 
         # Limpiar la respuesta
         story_text = response.text.strip()
@@ -435,6 +515,8 @@ def generate_story_from_chunk(chunk, role, story_type, business_context=None):
 
         return {"status": "success", "story": story_text}
 
+    except (cancellation.JobCancelled, deadline.DeadlineExceeded):
+        raise
     except Exception as e:
         return {"status": "error", "message": f"Error en la generación: {e}"}
 
@@ -463,17 +545,43 @@ def generate_story_from_text(text, role, story_type, business_context=None):
     Función wrapper para mantener compatibilidad con la API existente
     pero usando el nuevo sistema de chunks mejorado con contexto de negocio.
     """
+    return llm_client.run(generate_story_from_text_async(text, role, story_type, business_context))
+
+async def generate_story_from_text_async(text, role, story_type, business_context=None):
+    """Versión asíncrona de generate_story_from_text: los chunks se generan en paralelo."""
     chunks = split_document_into_chunks(text)
-    stories = []
+    semaforo = asyncio.Semaphore(STORY_BATCH_CONCURRENCY)
+
+    async def generar(chunk):
+        async with semaforo:
+            cancellation.check()
+            # Sin presupuesto de tiempo no se despachan chunks nuevos: se devuelve lo que haya
+            if deadline.exhausted():
+                return None
+            try:
+                return await generate_story_from_chunk_async(chunk, role, story_type, business_context)
+            except deadline.DeadlineExceeded:
+                return None
 
-    for chunk in chunks:
-        result = generate_story_from_chunk(chunk, role, story_type, business_context)
-        if result['status'] == 'success':
+    stories = []
+    omitidos = 0
+    for result in await asyncio.gather(*(generar(chunk) for chunk in chunks)):
+        if result is None:
+            omitidos += 1
+        elif result['status'] == 'success':
             stories.append(result['story'])
         else:
             return result  # Retorna el error
 
-    return {"status": "success", "stories": stories}
+    if omitidos:
+        print(f"⏱️ Plazo agotado: {omitidos}/{len(chunks)} fragmentos sin generar, resultado parcial")
+        if not stories:
+            return {"status": "error",
+                    "message": "Se agotó el tiempo disponible antes de generar alguna historia. Intenta de nuevo."}
+        metrics.PARTIAL_RESULTS.labels("story").inc()
+
+    return {"status": "success", "stories": stories, "partial": omitidos > 0,
+            "coverage": deadline.coverage(len(chunks), len(stories), 0, omitidos)}
 
 def generate_stories_with_context(document_text, role, story_type, business_context=None):
     """
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Los módulos de la app son planos en Nexus-Web/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
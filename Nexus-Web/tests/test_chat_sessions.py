@@ -0,0 +1,61 @@
+"""Compactación en segundo plano de las sesiones de chat."""
+import threading
+import time
+
+import pytest
+
+import chat_sessions
+import deadline
+import llm_scheduler
+
+
+@pytest.fixture(autouse=True)
+def base_de_datos(tmp_path, monkeypatch):
+    monkeypatch.setattr(chat_sessions, "CHAT_SESSION_DB", str(tmp_path / "sesiones.sqlite"))
+    monkeypatch.setattr(chat_sessions, "CHAT_HISTORY_TOKENS", 40)
+
+
+def _sesion_para_compactar():
+    session_id = chat_sessions.create()
+    for i in range(4):
+        chat_sessions.append(session_id, f"pregunta {i} " * 10, f"respuesta {i} " * 10)
+    assert chat_sessions.needs_compaction(session_id)
+    return session_id
+
+
+def test_compactacion_con_el_contexto_de_la_peticion():
+    session_id = _sesion_para_compactar()
+    vistos = []
+
+    def resumir(resumen, turnos):
+        vistos.append((llm_scheduler.current_context(), deadline.current()))
+        return "resumen"
+
+    token_llm = llm_scheduler.set_request_context(llm_scheduler.PRIORITY_INTERACTIVE, "ana")
+    token_plazo = deadline.bind(60)
+    try:
+        plazo = deadline.current()
+        chat_sessions.schedule_compaction(session_id, resumir)
+        assert chat_sessions.wait_for_compaction(session_id)
+    finally:
+        deadline.release(token_plazo)
+        llm_scheduler.reset_request_context(token_llm)
+
+    assert vistos == [((llm_scheduler.PRIORITY_INTERACTIVE, "ana"), plazo)]
+    assert chat_sessions.history(session_id).summary == "resumen"
+
+
+def test_la_espera_no_pasa_del_plazo_de_la_pregunta():
+    session_id = _sesion_para_compactar()
+    liberar = threading.Event()
+    chat_sessions.schedule_compaction(session_id, lambda resumen, turnos: liberar.wait(10) and "resumen")
+
+    token = deadline.bind(deadline.DEADLINE_RESERVE_SECONDS + deadline.DEADLINE_MIN_CALL_SECONDS + 0.3)
+    try:
+        inicio = time.monotonic()
+        assert not chat_sessions.wait_for_compaction(session_id, timeout=10)
+        assert time.monotonic() - inicio < 2
+    finally:
+        deadline.release(token)
+        liberar.set()
+    assert chat_sessions.wait_for_compaction(session_id)
@@ -0,0 +1,79 @@
+"""Similitud TF-IDF entre requerimientos y casos de prueba."""
+import random
+
+import numpy as np
+import pytest
+
+import coverage_gaps
+
+
+def _coseno_denso(consultas, documentos):
+    """Referencia: vectores TF-IDF densos sobre el vocabulario completo y coseno."""
+    vocabulario = sorted({t for tokens in consultas + documentos for t in tokens})
+    posicion = {t: i for i, t in enumerate(vocabulario)}
+
+    def matriz(textos):
+        m = np.zeros((len(textos), len(vocabulario)))
+        for i, tokens in enumerate(textos):
+            for t in tokens:
+                m[i, posicion[t]] += 1
+        return np.log1p(m)
+
+    q, d = matriz(consultas), matriz(documentos)
+    df = ((q > 0).sum(axis=0) + (d > 0).sum(axis=0))
+    idf = np.log((1 + len(consultas) + len(documentos)) / (1 + df)) + 1
+    q, d = q * idf, d * idf
+    q /= np.maximum(np.linalg.norm(q, axis=1, keepdims=True), 1e-12)
+    d /= np.maximum(np.linalg.norm(d, axis=1, keepdims=True), 1e-12)
+    return q @ d.T
+
+
+def test_texto_ajeno_con_un_termino_comun_no_cubre():
+    requisito = coverage_gaps.tokenize("El usuario debe poder cambiar su contraseña desde su perfil")
+    ajeno = coverage_gaps.tokenize(
+        "Generar el reporte de auditoría de facturación mensual con totales por cliente, impuestos, "
+        "notas de crédito y exportación a Excel; el administrador ingresa su contraseña para firmarlo")
+    indices, mejores = coverage_gaps.best_matches([requisito], [ajeno])
+    assert mejores[0] < coverage_gaps.COVERAGE_THRESHOLD
+    assert mejores[0] == pytest.approx(_coseno_denso([requisito], [ajeno])[0, 0], abs=1e-5)
+
+
+def test_caso_relacionado_cubre():
+    requisito = coverage_gaps.tokenize("El usuario debe poder cambiar su contraseña desde su perfil")
+    caso = coverage_gaps.tokenize("Cambiar contraseña desde el perfil del usuario con la contraseña actual")
+    _, mejores = coverage_gaps.best_matches([requisito], [caso])
+    assert mejores[0] >= coverage_gaps.COVERAGE_THRESHOLD
+
+
+def test_igual_al_coseno_denso_por_bloques(monkeypatch):
+    # Bloques chicos para que el puntaje se reparta en varios
+    monkeypatch.setattr(coverage_gaps, "_BLOCK_ENTRIES", 64)
+    rnd = random.Random(0)
+    palabras = [f"termino{i:03d}" for i in range(300)]
+    consultas = [rnd.choices(palabras[:120], k=rnd.randint(1, 12)) for _ in range(40)]
+    documentos = [rnd.choices(palabras, k=rnd.randint(5, 40)) for _ in range(60)] + [[]]
+    consultas.append(["inexistente"])
+
+    indices, mejores = coverage_gaps.best_matches(consultas, documentos)
+    esperado = _coseno_denso(consultas, documentos)
+    np.testing.assert_allclose(mejores, esperado.max(axis=1), atol=1e-5)
+    for i, fila in enumerate(esperado):
+        if fila.max() > 0:
+            assert fila[indices[i]] == pytest.approx(fila.max(), abs=1e-5)
+        else:
+            assert indices[i] == -1
+
+
+def test_quitar_requerimientos_conserva_encabezados_y_lineas_cortas():
+    texto = ("HISTORIA #1: Login\n"
+             "Campos: correo, clave\n"
+             "El sistema debe permitir iniciar sesión con correo y contraseña. "
+             "El sistema debe bloquear la cuenta tras tres intentos fallidos.\n"
+             "El sistema debe registrar la fecha del último acceso del usuario.")
+    reutilizadas = ["El sistema debe permitir iniciar sesión con correo y contraseña.",
+                    "El sistema debe registrar la fecha del último acceso del usuario."]
+    assert [o for _, o in coverage_gaps.split_requirements(texto) if o in reutilizadas] == reutilizadas
+    assert coverage_gaps.remove_requirements(texto, reutilizadas) == (
+        "HISTORIA #1: Login\n"
+        "Campos: correo, clave\n"
+        "El sistema debe bloquear la cuenta tras tres intentos fallidos.")
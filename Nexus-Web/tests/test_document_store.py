@@ -0,0 +1,63 @@
+"""Cuotas de los documentos subidos por adelantado."""
+import io
+import threading
+
+import pytest
+from werkzeug.datastructures import FileStorage
+
+import document_store
+
+
+@pytest.fixture(autouse=True)
+def directorio(tmp_path, monkeypatch):
+    monkeypatch.setattr(document_store, "DOCUMENT_DIR", str(tmp_path / "documentos"))
+    monkeypatch.setattr(document_store, "DOCUMENT_QUOTA_DB", str(tmp_path / "cuotas.sqlite"))
+    monkeypatch.setattr(document_store, "DOCUMENT_MAX_PER_CLIENT", 3)
+    return tmp_path
+
+
+def _subir(cliente, contenido=b"x" * 100):
+    archivo = FileStorage(io.BytesIO(contenido), filename="req.docx")
+    return document_store.create(archivo, cliente, len(contenido))
+
+
+def test_subidas_simultaneas_no_superan_la_cuota_del_cliente():
+    barrera = threading.Barrier(12)
+    resultados = []
+
+    def subir():
+        barrera.wait()
+        try:
+            resultados.append(_subir("cliente-a"))
+        except document_store.QuotaExceeded as e:
+            resultados.append(e)
+
+    hilos = [threading.Thread(target=subir) for _ in range(12)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+
+    aceptadas = [r for r in resultados if isinstance(r, str)]
+    rechazadas = [r for r in resultados if isinstance(r, document_store.QuotaExceeded)]
+    assert len(aceptadas) == 3 and len(rechazadas) == 9
+    assert all(e.per_client for e in rechazadas)
+    # Otro cliente no comparte la cuota
+    assert _subir("cliente-b")
+
+
+def test_cuota_total_y_liberacion(monkeypatch):
+    monkeypatch.setattr(document_store, "DOCUMENT_MAX_TOTAL_MB", 250 / (1024 * 1024))
+    primero = _subir("cliente-a")
+    _subir("cliente-b")
+    with pytest.raises(document_store.QuotaExceeded) as error:
+        _subir("cliente-c")
+    assert not error.value.per_client
+
+    # Al expirar un documento se libera su lugar
+    monkeypatch.setattr(document_store, "DOCUMENT_TTL", -1)
+    document_store._cleanup_expired()
+    monkeypatch.setattr(document_store, "DOCUMENT_TTL", 3600)
+    with pytest.raises(document_store.DocumentNotFound):
+        document_store.source_path(primero)
+    assert _subir("cliente-c")
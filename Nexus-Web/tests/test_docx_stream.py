@@ -0,0 +1,96 @@
+"""Extracción de DOCX en streaming frente a python-docx (doc.paragraphs y celdas de doc.tables)."""
+import docx
+import pytest
+from docx.oxml import parse_xml
+from docx.oxml.ns import nsdecls
+from docx.table import Table
+from docx.text.paragraph import Paragraph
+
+import docx_stream
+
+_VML = "urn:schemas-microsoft-com:vml"
+
+
+def _python_docx(path, tables=True):
+    """Mismos bloques que el extractor anterior, pero en orden del cuerpo y sin repetir celdas combinadas."""
+    documento = docx.Document(path)
+    bloques = []
+    for bloque in documento.iter_inner_content():
+        if isinstance(bloque, Paragraph):
+            if bloque.text.strip():
+                bloques.append(bloque.text)
+        elif isinstance(bloque, Table) and tables:
+            vistas = set()
+            for fila in bloque.rows:
+                for celda in fila.cells:
+                    # El conjunto mantiene vivos los elementos: lxml devuelve el mismo proxy para cada w:tc
+                    if celda._tc in vistas:
+                        continue
+                    vistas.add(celda._tc)
+                    if celda.text.strip():
+                        bloques.append(celda.text)
+    return "\n".join(bloques)
+
+
+def _cuadro_de_texto(texto):
+    """Ejecución con un cuadro de texto VML (w:pict/v:textbox/w:txbxContent)."""
+    return parse_xml(
+        f'<w:r {nsdecls("w")} xmlns:v="{_VML}"><w:pict><v:shape><v:textbox><w:txbxContent>'
+        f'<w:p><w:r><w:t>{texto}</w:t></w:r></w:p>'
+        f'</w:txbxContent></v:textbox></v:shape></w:pict></w:r>'
+    )
+
+
+def _control_de_contenido(texto):
+    """Control de contenido de bloque (w:sdt) con un párrafo."""
+    return parse_xml(
+        f'<w:sdt {nsdecls("w")}><w:sdtPr/><w:sdtContent>'
+        f'<w:p><w:r><w:t>{texto}</w:t></w:r></w:p>'
+        f'</w:sdtContent></w:sdt>'
+    )
+
+
+@pytest.fixture
+def documento(tmp_path):
+    doc = docx.Document()
+    ancla = doc.add_paragraph("Ancla")
+    ancla._p.append(_cuadro_de_texto("Caja"))
+    doc.element.body.append(_control_de_contenido("Control"))
+    doc.add_paragraph("Antes")
+
+    tabla = doc.add_table(rows=3, cols=3)
+    for i, fila in enumerate(tabla.rows):
+        for j, celda in enumerate(fila.cells):
+            celda.text = f"C{i}{j}"
+    tabla.cell(0, 0).merge(tabla.cell(0, 1))
+    tabla.cell(1, 2).merge(tabla.cell(2, 2))
+    tabla.cell(2, 0).add_table(rows=1, cols=1).cell(0, 0).text = "Anidada"
+    tabla.cell(2, 1).paragraphs[0]._p.append(_cuadro_de_texto("Caja en celda"))
+
+    parrafo = doc.add_paragraph("Con salto")
+    parrafo.add_run().add_break()
+    parrafo.add_run("\ty tabulación")
+    doc.add_paragraph("Despues")
+    doc.add_paragraph("   ")
+
+    ruta = tmp_path / "documento.docx"
+    doc.save(ruta)
+    return str(ruta)
+
+
+def test_parrafos_como_python_docx(documento):
+    texto = docx_stream.extract_docx_text(documento, tables=False)
+    assert texto == _python_docx(documento, tables=False)
+    assert texto == "Ancla\nAntes\nCon salto\n\ty tabulación\nDespues"
+
+
+def test_tablas_en_orden_del_cuerpo(documento):
+    texto = docx_stream.extract_docx_text(documento)
+    assert texto == _python_docx(documento)
+    assert "Caja" not in texto and "Control" not in texto and "Anidada" not in texto
+    assert texto.index("Antes") < texto.index("C00") < texto.index("Con salto")
+
+
+def test_parrafos_vacios(documento):
+    bloques = list(docx_stream.iter_docx_blocks(documento, tables=False, skip_empty=False))
+    assert bloques == [p.text for p in docx.Document(documento).paragraphs]
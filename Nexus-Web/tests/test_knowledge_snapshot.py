@@ -0,0 +1,47 @@
+"""Conocimiento del chat desde el snapshot: solo las diapositivas relacionadas van al prompt."""
+import pytest
+from pptx import Presentation
+from pptx.util import Inches
+
+import chat_backend
+import chat_sessions
+import knowledge_snapshot
+
+_DIAPOSITIVAS = [
+    "Plan de capacitación QA",
+    "Flujo de incidencias en Jira: reportar, asignar y cerrar un bug",
+    "Pruebas de regresión antes de cada liberación",
+    "Vacaciones y feriados del equipo",
+]
+
+
+@pytest.fixture
+def snapshot(tmp_path, monkeypatch):
+    presentacion = Presentation()
+    for texto in _DIAPOSITIVAS:
+        diapositiva = presentacion.slides.add_slide(presentacion.slide_layouts[6])
+        diapositiva.shapes.add_textbox(Inches(1), Inches(1), Inches(6), Inches(1)).text = texto
+    origen = tmp_path / "plan.pptx"
+    presentacion.save(origen)
+    monkeypatch.setenv("KNOWLEDGE_SNAPSHOT", str(tmp_path / "plan.knowledge"))
+    monkeypatch.setattr(knowledge_snapshot, "_snapshots", {})
+    return chat_backend.cargar_conocimiento(str(origen))
+
+
+def test_texto_desde_el_mmap(snapshot):
+    assert "text" not in vars(snapshot)
+    assert snapshot.text == " ".join(_DIAPOSITIVAS)
+
+
+def test_prompt_solo_con_las_diapositivas_relacionadas(snapshot):
+    prompt = chat_backend._construir_prompt("¿Cómo se reporta un bug en Jira?", snapshot)
+    assert "Flujo de incidencias en Jira" in prompt
+    assert "Vacaciones" not in prompt
+
+
+def test_pregunta_de_seguimiento_usa_la_pregunta_anterior(snapshot):
+    historial = chat_sessions.History("", [(chat_sessions.ROLE_USER, "¿Cuándo se hacen las pruebas de regresión?"),
+                                          (chat_sessions.ROLE_ASSISTANT, "Antes de cada liberación.")], 0)
+    prompt = chat_backend._construir_prompt("¿Y quién las ejecuta?", snapshot, historial)
+    assert "Pruebas de regresión antes de cada liberación" in prompt
+    assert "Vacaciones" not in prompt
@@ -0,0 +1,134 @@
+"""Protocolo de single-flight entre procesos (bloqueo por archivo en SINGLEFLIGHT_DIR)."""
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+import deadline
+import singleflight
+
+
+@pytest.fixture(autouse=True)
+def directorio(tmp_path, monkeypatch):
+    monkeypatch.setattr(singleflight, "SINGLEFLIGHT_DIR", str(tmp_path))
+    return tmp_path
+
+
+def _generar(contador, valor, segundos):
+    with open(contador, "a") as f:
+        f.write(f"{os.getpid()}\n")
+    time.sleep(segundos)
+    return valor
+
+
+def _fallar():
+    time.sleep(0.5)
+    raise RuntimeError("falló la generación")
+
+
+def _peticion(directorio, contador, salida):
+    singleflight.SINGLEFLIGHT_DIR = directorio
+    try:
+        valor, compartido = singleflight.do("clave", lambda: _generar(contador, {"casos": [1, 2]}, 1.0))
+        salida.put(("ok", valor, compartido))
+    except Exception as e:
+        salida.put((type(e).__name__, str(e), None))
+
+
+def _peticion_fallida(directorio, salida):
+    singleflight.SINGLEFLIGHT_DIR = directorio
+    try:
+        salida.put(("ok",) + singleflight.do("clave", _fallar))
+    except Exception as e:
+        salida.put((type(e).__name__, str(e)))
+
+
+def _ejecutar(destino, args, procesos=4):
+    contexto = multiprocessing.get_context("spawn")
+    salida = contexto.Queue()
+    hijos = [contexto.Process(target=destino, args=args + (salida,)) for _ in range(procesos)]
+    for hijo in hijos:
+        hijo.start()
+    resultados = [salida.get(timeout=60) for _ in hijos]
+    for hijo in hijos:
+        hijo.join(timeout=10)
+    return resultados
+
+
+def _lock_path(directorio):
+    return os.path.join(str(directorio), "clave.lock")
+
+
+def test_una_sola_generacion_entre_procesos(directorio):
+    contador = str(directorio / "llamadas.txt")
+    resultados = _ejecutar(_peticion, (str(directorio), contador))
+
+    with open(contador) as f:
+        assert len(f.read().split()) == 1
+    assert all(r[:2] == ("ok", {"casos": [1, 2]}) for r in resultados)
+    assert sorted(r[2] for r in resultados) == [False, True, True, True]
+    assert not os.path.exists(_lock_path(directorio))
+
+
+def test_error_del_lider_se_propaga_a_los_seguidores(directorio):
+    resultados = _ejecutar(_peticion_fallida, (str(directorio),), procesos=3)
+    assert [r[0] for r in resultados].count("RuntimeError") == 1
+    assert [r[0] for r in resultados].count("SingleFlightError") == 2
+
+
+def test_bloqueo_de_un_proceso_muerto_se_rompe(directorio):
+    muerto = subprocess.Popen([sys.executable, "-c", "pass"])
+    muerto.wait()
+    with open(_lock_path(directorio), "w") as f:
+        f.write(f"{muerto.pid} abc")
+
+    valor, compartido = singleflight.do("clave", lambda: "nuevo")
+    assert (valor, compartido) == ("nuevo", False)
+    assert not os.path.exists(_lock_path(directorio))
+
+
+def test_no_se_roba_el_bloqueo_de_un_lider_vivo(directorio, monkeypatch):
+    monkeypatch.setattr(singleflight, "WAIT_TIMEOUT", 0.5)
+    vivo = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(30)"])
+    try:
+        with open(_lock_path(directorio), "w") as f:
+            f.write(f"{vivo.pid} abc")
+
+        valor, compartido = singleflight.do("clave", lambda: "propio")
+        assert (valor, compartido) == ("propio", False)
+        with open(_lock_path(directorio)) as f:
+            assert f.read() == f"{vivo.pid} abc"
+        assert not os.path.exists(os.path.join(str(directorio), "clave.json"))
+    finally:
+        vivo.kill()
+        vivo.wait()
+
+
+def test_el_lider_no_borra_un_bloqueo_ajeno(directorio):
+    def generar():
+        # Otro líder tomó el bloqueo mientras tanto (p. ej. tras romperlo por error)
+        os.remove(_lock_path(directorio))
+        with open(_lock_path(directorio), "w") as f:
+            f.write("1 otro")
+        return "valor"
+
+    assert singleflight.do("clave", generar) == ("valor", False)
+    with open(_lock_path(directorio)) as f:
+        assert f.read() == "1 otro"
+
+
+def test_la_espera_respeta_el_plazo_de_la_peticion(directorio, monkeypatch):
+    monkeypatch.setattr(singleflight, "WAIT_TIMEOUT", 900)
+    with open(_lock_path(directorio), "w") as f:
+        f.write(f"{os.getppid()} abc")
+
+    token = deadline.bind(deadline.DEADLINE_RESERVE_SECONDS + 1)
+    try:
+        inicio = time.monotonic()
+        assert singleflight.do("clave", lambda: "parcial") == ("parcial", False)
+        assert time.monotonic() - inicio < 5
+    finally:
+        deadline.release(token)
@@ -0,0 +1,54 @@
+"""
+Construye el snapshot binario del conocimiento del chat a partir del PPTX.
+
+Pensado como paso de build (antes de arrancar gunicorn): los workers abren el
+snapshot con mmap en lugar de recorrer el PPTX. Si se omite, el primer worker
+que arranca lo construye igual.
+
+Uso (desde Nexus-Web/):
+    python tools/build_knowledge_snapshot.py
+    python tools/build_knowledge_snapshot.py --source "PLAN de Capacitacion.pptx" --output conocimiento.knowledge
+    python tools/build_knowledge_snapshot.py --check      # código 1 si el snapshot falta o está obsoleto
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import knowledge_snapshot  # noqa: E402
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Construye el snapshot de conocimiento del chat.")
+    parser.add_argument("--source", default="PLAN de Capacitacion.pptx", help="PPTX de origen")
+    parser.add_argument("--output", help="Ruta del snapshot (por defecto KNOWLEDGE_SNAPSHOT o el temporal del sistema)")
+    parser.add_argument("--check", action="store_true", help="Solo verifica que el snapshot esté al día")
+    args = parser.parse_args(argv)
+
+    destino = args.output or knowledge_snapshot.snapshot_path(args.source)
+    if args.check:
+        try:
+            knowledge_snapshot.KnowledgeSnapshot(destino, args.source)
+        except (OSError, ValueError, knowledge_snapshot.StaleSnapshot) as e:
+            print(f"Snapshot obsoleto o inválido: {e}")
+            return 1
+        print(f"Snapshot al día: {destino}")
+        return 0
+
+    inicio = time.perf_counter()
+    knowledge_snapshot.build(args.source, destino)
+    construido = time.perf_counter() - inicio
+
+    inicio = time.perf_counter()
+    snapshot = knowledge_snapshot.KnowledgeSnapshot(destino, args.source)
+    carga = time.perf_counter() - inicio
+    print(f"Snapshot guardado en {destino} ({os.path.getsize(destino) // 1024} KiB): "
+          f"{len(snapshot)} diapositivas, {snapshot.header['terms']} términos, {len(snapshot.text)} caracteres")
+    print(f"Construcción: {construido * 1000:.0f} ms, carga: {carga * 1000:.1f} ms")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,444 @@
+"""
+Prueba de carga de extremo a extremo de la API Flask.
+
+Lanza el mock de Gemini (tools/mock_gemini.py) y la app con gunicorn
+(gunicorn.conf.py) apuntando al mock, con bases SQLite y directorios propios
+para no tocar los de otra instancia. Genera un corpus de especificaciones
+DOCX de varios tamaños (o usa el de --corpus) y simula N usuarios
+concurrentes que suben documentos y chatean: cada usuario elige en bucle un
+endpoint según --mix (/api/matrix, /api/story, /api/preview, /api/chat; el
+chat mantiene su sesión de varios turnos).
+
+Reporta, por endpoint y en total: throughput, latencia p50/p95/p99, tasa de
+error y códigos de respuesta; y el RSS de cada worker de gunicorn muestreado
+a lo largo de la prueba. Con --base-url se prueba una app ya levantada (sin
+mock ni muestreo de RSS).
+
+Uso (desde Nexus-Web/):
+    python tools/loadtest.py --users 20 --duration 120 --mix matrix=2,story=1,preview=2,chat=5
+    python tools/loadtest.py --latency 3 --throttle-rate 0.05 --pages 5 20 60 --output loadtest_report.json
+    python tools/loadtest.py --base-url http://localhost:5000 --corpus specs/ --users 5 --duration 60
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import requests
+
+_APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _APP_DIR)
+sys.path.insert(0, os.path.join(_APP_DIR, "benchmarks"))
+
+from bench_docx import generate_docx  # noqa: E402
+
+ENDPOINTS = ("matrix", "story", "preview", "chat")
+DEFAULT_MIX = "matrix=2,story=1,preview=2,chat=5"
+DEFAULT_PAGES = [2, 10, 30]
+
+_PREGUNTAS = [
+    "¿Cómo debo registrar un bug en Jira?",
+    "¿Y qué prioridad le asigno si bloquea el flujo principal?",
+    "¿Qué campos son obligatorios en ese caso?",
+    "¿Cuál es la diferencia entre una épica y una historia?",
+    "¿Cómo se vincula un caso de prueba con la historia?",
+    "Resume lo que me recomendaste hasta ahora.",
+]
+_TIPOS = [["funcional"], ["funcional", "no_funcional"]]
+
+
+def parse_mix(spec):
+    """{"matrix": 2, ...} a partir de "matrix=2,chat=5"."""
+    mezcla = {}
+    for parte in filter(None, (p.strip() for p in spec.split(","))):
+        nombre, _, peso = parte.partition("=")
+        if nombre not in ENDPOINTS:
+            raise ValueError(f"Endpoint desconocido en --mix: {nombre}")
+        mezcla[nombre] = float(peso or 1)
+    return mezcla
+
+
+def build_corpus(directory, pages_list, per_size, seed):
+    """Especificaciones DOCX sintéticas: per_size documentos distintos por tamaño."""
+    rutas = []
+    for pages in pages_list:
+        for i in range(per_size):
+            ruta = os.path.join(directory, f"spec_{pages}p_{i}.docx")
+            generate_docx(ruta, pages, seed=seed + pages * 1000 + i)
+            rutas.append(ruta)
+    return rutas
+
+
+def load_corpus(directory):
+    rutas = sorted(os.path.join(directory, n) for n in os.listdir(directory)
+                   if n.lower().endswith((".docx", ".pdf")))
+    if not rutas:
+        raise ValueError(f"No hay archivos .docx o .pdf en {directory}")
+    return rutas
+
+
+def percentile(valores, p):
+    """Percentil por rango más cercano (valores ya ordenados)."""
+    if not valores:
+        return None
+    indice = max(0, min(len(valores) - 1, int(round(p / 100 * len(valores) + 0.5)) - 1))
+    return valores[indice]
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_for(check, timeout, what):
+    limite = time.monotonic() + timeout
+    while time.monotonic() < limite:
+        try:
+            if check():
+                return
+        except (OSError, requests.RequestException):
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"{what} no respondió en {timeout:g} s")
+
+
+class Stack:
+    """Mock de Gemini + app con gunicorn en puertos libres, con estado aislado en workdir."""
+
+    def __init__(self, args, workdir):
+        self.workdir = workdir
+        self.mock_port = _free_port()
+        self.app_port = _free_port()
+        self.base_url = f"http://127.0.0.1:{self.app_port}"
+        cert_dir = os.path.join(workdir, "cert")
+
+        self._logs = []
+        self.mock = self._spawn("mock_gemini.log", [
+            sys.executable, os.path.join(_APP_DIR, "tools", "mock_gemini.py"),
+            "--port", str(self.mock_port), "--cert-dir", cert_dir,
+            "--latency", str(args.latency), "--jitter", str(args.jitter),
+            "--ms-per-token", str(args.ms_per_token), "--output-tokens", str(args.output_tokens),
+            "--throttle-rate", str(args.throttle_rate), "--error-rate", str(args.error_rate),
+            "--seed", str(args.seed)
+        ], os.environ.copy())
+        crt = os.path.join(cert_dir, "mock_gemini.crt")
+        _wait_for(lambda: os.path.exists(crt) and socket.create_connection(("127.0.0.1", self.mock_port), 1),
+                  30, "El mock de Gemini")
+
+        env = os.environ.copy()
+        env.update({
+            "GEMINI_API_KEY": "mock",
+            "GOOGLE_API_KEY": "mock",
+            "GEMINI_API_ENDPOINT": f"localhost:{self.mock_port}",
+            "GRPC_DEFAULT_SSL_ROOTS_FILE_PATH": crt,
+            "WEB_CONCURRENCY": str(args.workers),
+            "PROMETHEUS_MULTIPROC_DIR": os.path.join(workdir, "prometheus"),
+            "CHECKPOINT_DB": os.path.join(workdir, "checkpoints.sqlite"),
+            "CASE_LIBRARY_DB": os.path.join(workdir, "case_library.sqlite"),
+            "CHAT_SESSION_DB": os.path.join(workdir, "chat_sessions.sqlite"),
+            "DOCUMENT_DIR": os.path.join(workdir, "documents"),
+            "DOCUMENT_QUOTA_DB": os.path.join(workdir, "documents.sqlite"),
+            "CANCEL_DIR": os.path.join(workdir, "cancel"),
+            "SINGLEFLIGHT_DIR": os.path.join(workdir, "singleflight"),
+            "GEMINI_GOVERNOR_DB": os.path.join(workdir, "governor.sqlite"),
+            "KNOWLEDGE_SNAPSHOT": os.path.join(workdir, "knowledge.snapshot"),
+            "PROFILE_DIR": os.path.join(workdir, "profiles"),
+        })
+        self.app = self._spawn("gunicorn.log", [
+            sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py",
+            "--bind", f"127.0.0.1:{self.app_port}", "App:app"
+        ], env)
+        _wait_for(lambda: requests.get(f"{self.base_url}/health", timeout=5).status_code == 200, 90, "La app")
+
+    def _spawn(self, log_name, cmd, env):
+        log = open(os.path.join(self.workdir, log_name), "w")
+        self._logs.append(log)
+        # Grupo de procesos propio: al terminar se mata también a workers y procesos de parseo
+        return subprocess.Popen(cmd, cwd=_APP_DIR, env=env, stdout=log, stderr=subprocess.STDOUT,
+                                start_new_session=True)
+
+    def worker_pids(self):
+        """PIDs de los workers de gunicorn (hijos del proceso maestro)."""
+        try:
+            with open(f"/proc/{self.app.pid}/task/{self.app.pid}/children") as f:
+                return [int(pid) for pid in f.read().split()]
+        except OSError:
+            return []
+
+    def stop(self):
+        for proceso in (self.app, self.mock):
+            proceso.terminate()
+        for proceso in (self.app, self.mock):
+            try:
+                proceso.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                pass
+            try:
+                os.killpg(proceso.pid, signal.SIGKILL)
+            except OSError:
+                pass
+        for log in self._logs:
+            log.close()
+
+
+def _rss_kib(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for linea in f:
+                if linea.startswith("VmRSS:"):
+                    return int(linea.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+class RssSampler(threading.Thread):
+    """Muestrea el RSS de los workers cada `interval` segundos: [{"t": s, "workers": {pid: KiB}}]."""
+
+    def __init__(self, stack, interval, inicio):
+        super().__init__(daemon=True)
+        self.stack = stack
+        self.interval = interval
+        self.inicio = inicio
+        self.samples = []
+        self._detener = threading.Event()
+
+    def run(self):
+        while not self._detener.is_set():
+            muestra = {str(pid): _rss_kib(pid) for pid in self.stack.worker_pids()}
+            self.samples.append({"t": round(time.monotonic() - self.inicio, 1),
+                                 "workers": {pid: kib for pid, kib in muestra.items() if kib is not None}})
+            self._detener.wait(self.interval)
+
+    def stop(self):
+        self._detener.set()
+        self.join()
+
+
+class User(threading.Thread):
+    """Usuario simulado: elige endpoints según la mezcla hasta que se acaba el tiempo."""
+
+    def __init__(self, numero, base_url, corpus, mezcla, fin, inicio, timeout, seed, results, lock):
+        super().__init__(daemon=True)
+        self.numero = numero
+        self.base_url = base_url
+        self.corpus = corpus
+        self.nombres, self.pesos = zip(*mezcla.items())
+        self.fin = fin
+        self.inicio = inicio
+        self.timeout = timeout
+        self.rnd = random.Random(seed + numero)
+        self.results = results
+        self.lock = lock
+        self.session = requests.Session()
+        self.chat_session = None
+        self.pregunta = 0
+
+    def _upload(self, url, data):
+        ruta = self.rnd.choice(self.corpus)
+        with open(ruta, "rb") as f:
+            return self.session.post(url, data=data, files={"file": (os.path.basename(ruta), f)}, timeout=self.timeout)
+
+    def matrix(self):
+        return self._upload(f"{self.base_url}/api/matrix", {
+            "contexto": "Sistema de gestión interno", "flujo": "Flujo principal",
+            "historia": "", "types": self.rnd.choice(_TIPOS)
+        })
+
+    def story(self):
+        return self._upload(f"{self.base_url}/api/story", {
+            "role": "Usuario", "story_type": "historia de usuario", "business_context": ""
+        })
+
+    def preview(self):
+        return self._upload(f"{self.base_url}/api/preview", {
+            "role": "Usuario", "story_type": "historia de usuario", "business_context": ""
+        })
+
+    def chat(self):
+        respuesta = self.session.post(f"{self.base_url}/api/chat", json={
+            "pregunta": _PREGUNTAS[self.pregunta % len(_PREGUNTAS)], "session_id": self.chat_session
+        }, timeout=self.timeout)
+        self.pregunta += 1
+        if respuesta.ok:
+            self.chat_session = respuesta.json().get("session_id")
+        return respuesta
+
+    def run(self):
+        while time.monotonic() < self.fin:
+            endpoint = self.rnd.choices(self.nombres, self.pesos)[0]
+            comienzo = time.monotonic()
+            try:
+                respuesta = getattr(self, endpoint)()
+                # La respuesta completa (las descargas llegan en streaming) cuenta en la latencia
+                _ = respuesta.content
+                estado, error = respuesta.status_code, None if respuesta.ok else respuesta.text[:200]
+            except requests.RequestException as e:
+                estado, error = None, f"{type(e).__name__}: {e}"[:200]
+            resultado = {"endpoint": endpoint, "start": round(comienzo - self.inicio, 3),
+                         "latency": time.monotonic() - comienzo, "status": estado, "error": error}
+            with self.lock:
+                self.results.append(resultado)
+
+
+def summarize(results, duracion):
+    """Métricas por endpoint y totales a partir de los resultados individuales."""
+    resumen = {}
+    for endpoint in ENDPOINTS + ("total",):
+        filas = [r for r in results if endpoint == "total" or r["endpoint"] == endpoint]
+        if not filas:
+            continue
+        latencias = sorted(r["latency"] for r in filas)
+        errores = sum(1 for r in filas if r["error"] is not None)
+        codigos = {}
+        for r in filas:
+            clave = str(r["status"]) if r["status"] is not None else "connection_error"
+            codigos[clave] = codigos.get(clave, 0) + 1
+        resumen[endpoint] = {
+            "requests": len(filas),
+            "errors": errores,
+            "error_rate": round(errores / len(filas), 4),
+            "throughput_rps": round(len(filas) / duracion, 3),
+            "latency_s": {
+                "p50": round(percentile(latencias, 50), 3),
+                "p95": round(percentile(latencias, 95), 3),
+                "p99": round(percentile(latencias, 99), 3),
+                "max": round(latencias[-1], 3)
+            },
+            "status_codes": codigos
+        }
+    return resumen
+
+
+def summarize_rss(samples):
+    """RSS inicial, pico y final (KiB) de cada worker."""
+    workers = {}
+    for muestra in samples:
+        for pid, kib in muestra["workers"].items():
+            datos = workers.setdefault(pid, {"start_kib": kib, "peak_kib": kib, "end_kib": kib})
+            datos["peak_kib"] = max(datos["peak_kib"], kib)
+            datos["end_kib"] = kib
+    return workers
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Prueba de carga de extremo a extremo de la API.")
+    parser.add_argument("--users", type=int, default=10, help="Usuarios concurrentes")
+    parser.add_argument("--duration", type=float, default=60, help="Duración de la prueba (s)")
+    parser.add_argument("--ramp-up", type=float, default=5, help="Segundos para arrancar a todos los usuarios")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"Pesos por endpoint (por defecto: {DEFAULT_MIX})")
+    parser.add_argument("--corpus", help="Directorio con especificaciones .docx/.pdf (por defecto se generan)")
+    parser.add_argument("--pages", type=int, nargs="+", default=DEFAULT_PAGES,
+                        help="Tamaños en páginas del corpus generado (por defecto: 2 10 30)")
+    parser.add_argument("--docs-per-size", type=int, default=3, help="Documentos generados por tamaño")
+    parser.add_argument("--base-url", help="Probar una app ya levantada en lugar de lanzar mock + gunicorn")
+    parser.add_argument("--workers", type=int, default=2, help="Workers de gunicorn (WEB_CONCURRENCY)")
+    parser.add_argument("--timeout", type=float, default=600, help="Timeout por petición (s)")
+    parser.add_argument("--rss-interval", type=float, default=2, help="Intervalo de muestreo del RSS (s)")
+    parser.add_argument("--latency", type=float, default=1.0, help="Mock: latencia media por llamada (s)")
+    parser.add_argument("--jitter", type=float, default=0.3, help="Mock: desviación estándar de la latencia (s)")
+    parser.add_argument("--ms-per-token", type=float, default=0.0, help="Mock: latencia por token de salida (ms)")
+    parser.add_argument("--output-tokens", type=int, default=400, help="Mock: tokens de cada respuesta")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Mock: fracción de llamadas con 429")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Mock: fracción de llamadas con 500")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="loadtest_report.json", help="Ruta del reporte JSON")
+    parser.add_argument("--max-error-rate", type=float,
+                        help="Termina con código 1 si la tasa de error total la supera")
+    args = parser.parse_args(argv)
+    mezcla = parse_mix(args.mix)
+
+    with tempfile.TemporaryDirectory(prefix="nexus_loadtest_") as workdir:
+        if args.corpus:
+            corpus = load_corpus(args.corpus)
+        else:
+            os.makedirs(os.path.join(workdir, "corpus"))
+            corpus = build_corpus(os.path.join(workdir, "corpus"), args.pages, args.docs_per_size, args.seed)
+        print(f"Corpus: {len(corpus)} documentos")
+
+        stack = None
+        if args.base_url:
+            base_url = args.base_url.rstrip("/")
+        else:
+            print("Lanzando mock de Gemini y gunicorn...")
+            stack = Stack(args, workdir)
+            base_url = stack.base_url
+
+        try:
+            inicio = time.monotonic()
+            fin = inicio + args.ramp_up + args.duration
+            muestreo = RssSampler(stack, args.rss_interval, inicio) if stack else None
+            if muestreo:
+                muestreo.start()
+
+            results, lock = [], threading.Lock()
+            usuarios = [User(i, base_url, corpus, mezcla, fin, inicio, args.timeout, args.seed, results, lock)
+                        for i in range(args.users)]
+            print(f"{args.users} usuarios durante {args.duration:g} s (+{args.ramp_up:g} s de rampa) contra {base_url}")
+            for i, usuario in enumerate(usuarios):
+                usuario.start()
+                if args.users > 1:
+                    time.sleep(args.ramp_up / (args.users - 1) if i < args.users - 1 else 0)
+            for usuario in usuarios:
+                usuario.join()
+            duracion = time.monotonic() - inicio
+            if muestreo:
+                muestreo.stop()
+        finally:
+            if stack:
+                stack.stop()
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "base_url": args.base_url or "local (mock + gunicorn)",
+            "users": args.users,
+            "duration_s": round(duracion, 1),
+            "mix": mezcla,
+            "corpus_documents": len(corpus),
+            "workers": None if args.base_url else args.workers,
+            "mock": None if args.base_url else {
+                "latency": args.latency, "jitter": args.jitter, "ms_per_token": args.ms_per_token,
+                "output_tokens": args.output_tokens, "throttle_rate": args.throttle_rate,
+                "error_rate": args.error_rate
+            }
+        },
+        "summary": summarize(results, duracion),
+        "worker_rss": summarize_rss(muestreo.samples) if muestreo else {},
+        "worker_rss_samples": muestreo.samples if muestreo else [],
+        "errors": [r for r in results if r["error"] is not None][:50]
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"Reporte guardado en {args.output}\n")
+
+    print(f"{'endpoint':<9} {'peticiones':>10} {'req/s':>8} {'p50 s':>8} {'p95 s':>8} {'p99 s':>8} {'error':>7}")
+    for endpoint, datos in report["summary"].items():
+        lat = datos["latency_s"]
+        print(f"{endpoint:<9} {datos['requests']:>10} {datos['throughput_rps']:>8.2f} {lat['p50']:>8.2f} "
+              f"{lat['p95']:>8.2f} {lat['p99']:>8.2f} {datos['error_rate']:>7.1%}")
+    for pid, datos in report["worker_rss"].items():
+        print(f"worker {pid}: RSS {datos['start_kib'] / 1024:.0f} -> pico {datos['peak_kib'] / 1024:.0f} "
+              f"-> final {datos['end_kib'] / 1024:.0f} MiB")
+
+    total = report["summary"].get("total")
+    if args.max_error_rate is not None and total and total["error_rate"] > args.max_error_rate:
+        print(f"\nTasa de error {total['error_rate']:.1%} por encima de {args.max_error_rate:.1%}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,248 @@
+"""
+Servidor local que imita la API de Gemini para pruebas de carga.
+
+Implementa GenerateContent por gRPC con TLS, el mismo transporte que usa el
+SDK en producción (generate_content_async va por el canal gRPC asíncrono), así
+que el camino de llamada de la app no cambia: solo el destino. Las
+respuestas tienen la forma que esperan los backends según el prompt:
+
+    - matriz (prompt de Testing o response_mime_type JSON): arreglo JSON de casos
+    - análisis de historias: lista numerada de funcionalidades
+    - lotes de historias, chat y resúmenes: texto
+
+La latencia es fija más un componente aleatorio y otro por token de salida,
+y una fracción configurable de las llamadas falla con RESOURCE_EXHAUSTED
+(429, cuota) o INTERNAL (500), que la app clasifica como throttle y
+reintentable.
+
+El certificado TLS autofirmado se genera en --cert-dir. Para apuntar la app
+al mock:
+
+    GEMINI_API_KEY=mock
+    GEMINI_API_ENDPOINT=localhost:<puerto>
+    GRPC_DEFAULT_SSL_ROOTS_FILE_PATH=<cert-dir>/mock_gemini.crt
+
+tools/loadtest.py lanza el mock y la app con esas variables.
+
+Uso (desde Nexus-Web/):
+    python tools/mock_gemini.py --port 50051 --latency 2 --jitter 0.5 --throttle-rate 0.05 --error-rate 0.01
+"""
+import argparse
+import datetime
+import ipaddress
+import json
+import os
+import random
+import signal
+import sys
+import tempfile
+import threading
+import time
+from concurrent import futures
+
+import grpc
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+from google.ai import generativelanguage_v1beta as glm
+
+_SERVICE = "google.ai.generativelanguage.v1beta.GenerativeService"
+
+_VERBOS = ["Registrar", "Consultar", "Actualizar", "Validar", "Exportar", "Aprobar"]
+_OBJETOS = ["usuario", "pedido", "reporte mensual", "factura", "permiso de rol", "documento adjunto"]
+
+
+def ensure_certificate(directory):
+    """Certificado autofirmado para localhost/127.0.0.1 (se reutiliza si ya existe). Devuelve (crt, key)."""
+    os.makedirs(directory, exist_ok=True)
+    crt = os.path.join(directory, "mock_gemini.crt")
+    key = os.path.join(directory, "mock_gemini.key")
+    if os.path.exists(crt) and os.path.exists(key):
+        return crt, key
+
+    clave = ec.generate_private_key(ec.SECP256R1())
+    nombre = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "localhost")])
+    ahora = datetime.datetime.now(datetime.timezone.utc)
+    certificado = (
+        x509.CertificateBuilder()
+        .subject_name(nombre)
+        .issuer_name(nombre)
+        .public_key(clave.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(ahora - datetime.timedelta(days=1))
+        .not_valid_after(ahora + datetime.timedelta(days=365))
+        .add_extension(x509.SubjectAlternativeName([x509.DNSName("localhost"),
+                                                    x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]),
+                       critical=False)
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .sign(clave, hashes.SHA256())
+    )
+    with open(key, "wb") as f:
+        f.write(clave.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                    serialization.NoEncryption()))
+    with open(crt, "wb") as f:
+        f.write(certificado.public_bytes(serialization.Encoding.PEM))
+    return crt, key
+
+
+def _prompt_text(request):
+    return "\n".join(part.text for content in request.contents for part in content.parts)
+
+
+def _test_cases(rnd, n):
+    casos = []
+    for _ in range(n):
+        objeto = rnd.choice(_OBJETOS)
+        casos.append({
+            "id_caso_prueba": "",
+            "titulo_caso_prueba": f"{rnd.choice(_VERBOS)} {objeto} con datos válidos #{rnd.randint(1, 99999)}",
+            "Descripcion": f"Verificar que el sistema permite operar sobre {objeto}.",
+            "Precondiciones": "Usuario autenticado con permisos.",
+            "Tipo_de_prueba": rnd.choice(["Funcional", "No Funcional"]),
+            "Nivel_de_prueba": "Sistema",
+            "Tipo_de_ejecucion": "Manual",
+            "Pasos": [f"Ingresar al módulo de {objeto}", "Capturar los datos", "Guardar"],
+            "Resultado_esperado": ["El sistema guarda la información y muestra confirmación"],
+            "Categoria": "Flujo Principal",
+            "Ambiente": "QA",
+            "Ciclo": "Ciclo 1",
+            "issuetype": "Test",
+            "Prioridad": rnd.choice(["Alta", "Media", "Baja"]),
+            "historia_de_usuario": ""
+        })
+    return casos
+
+
+def build_response_text(prompt, json_mode, rnd, output_tokens):
+    """Texto de respuesta con la forma que espera el backend que hizo la llamada."""
+    if json_mode or "Eres un experto en Testing" in prompt:
+        return json.dumps(_test_cases(rnd, max(1, output_tokens // 150)), ensure_ascii=False)
+    if "IDENTIFICAR Y LISTAR" in prompt:
+        lineas = [f"{i}. {rnd.choice(_VERBOS)} {rnd.choice(_OBJETOS)} - Permite gestionar la operación"
+                  for i in range(1, 13)]
+        return "Lista de Funcionalidades Identificadas:\n" + "\n".join(lineas) + \
+            "\n\nTOTAL FUNCIONALIDADES IDENTIFICADAS: 12"
+    if "Resume la siguiente conversación" in prompt:
+        return "El usuario consultó sobre el registro de bugs en Jira y los criterios de prioridad."
+    palabras = []
+    while len(palabras) < output_tokens:
+        palabras.extend(f"{rnd.choice(_VERBOS)} {rnd.choice(_OBJETOS)} según el criterio de aceptación.".split())
+    return " ".join(palabras[:output_tokens])
+
+
+class MockGemini:
+    """Lógica del mock: latencia, errores inyectados y contadores."""
+
+    def __init__(self, latency=1.0, jitter=0.3, ms_per_token=0.0, throttle_rate=0.0, error_rate=0.0,
+                 output_tokens=400, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.ms_per_token = ms_per_token
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.output_tokens = output_tokens
+        self._rnd = random.Random(seed)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.stats = {"ok": 0, "throttled": 0, "error": 0}
+
+    def _count(self, outcome):
+        with self._lock:
+            self.stats[outcome] += 1
+
+    def generate_content(self, request, context):
+        with self._lock:
+            self.in_flight += 1
+            sorteo = self._rnd.random()
+            rnd = random.Random(self._rnd.random())
+        try:
+            prompt = _prompt_text(request)
+            if sorteo < self.throttle_rate:
+                time.sleep(min(self.latency, 0.05))
+                self._count("throttled")
+                context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, "Resource has been exhausted (e.g. check quota).")
+            if sorteo < self.throttle_rate + self.error_rate:
+                time.sleep(self.latency * rnd.random())
+                self._count("error")
+                context.abort(grpc.StatusCode.INTERNAL, "An internal error has occurred.")
+
+            json_mode = request.generation_config.response_mime_type == "application/json"
+            salida = request.generation_config.max_output_tokens or self.output_tokens
+            salida = min(salida, self.output_tokens)
+            texto = build_response_text(prompt, json_mode, rnd, salida)
+            tokens_salida = len(texto) // 4
+            time.sleep(max(0.0, rnd.gauss(self.latency, self.jitter)) + tokens_salida * self.ms_per_token / 1000)
+            self._count("ok")
+            return glm.GenerateContentResponse(
+                candidates=[glm.Candidate(content=glm.Content(parts=[glm.Part(text=texto)], role="model"),
+                                          finish_reason=glm.Candidate.FinishReason.STOP, index=0)],
+                usage_metadata=glm.GenerateContentResponse.UsageMetadata(
+                    prompt_token_count=len(prompt) // 4,
+                    candidates_token_count=tokens_salida,
+                    total_token_count=len(prompt) // 4 + tokens_salida
+                )
+            )
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+
+def serve(mock, port, cert_dir, max_concurrency=512):
+    """Arranca el servidor gRPC con TLS en localhost:port y lo devuelve (ya iniciado)."""
+    crt, key = ensure_certificate(cert_dir)
+    with open(crt, "rb") as f:
+        certificado = f.read()
+    with open(key, "rb") as f:
+        clave = f.read()
+    servidor = grpc.server(futures.ThreadPoolExecutor(max_workers=max_concurrency),
+                           maximum_concurrent_rpcs=max_concurrency)
+    servidor.add_generic_rpc_handlers((grpc.method_handlers_generic_handler(_SERVICE, {
+        "GenerateContent": grpc.unary_unary_rpc_method_handler(
+            mock.generate_content,
+            request_deserializer=glm.GenerateContentRequest.deserialize,
+            response_serializer=glm.GenerateContentResponse.serialize
+        )
+    }),))
+    servidor.add_secure_port(f"localhost:{port}", grpc.ssl_server_credentials([(clave, certificado)]))
+    servidor.start()
+    return servidor
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Mock local de la API de Gemini (gRPC) para pruebas de carga.")
+    parser.add_argument("--port", type=int, default=50051)
+    parser.add_argument("--cert-dir", default=os.path.join(tempfile.gettempdir(), "nexus_mock_gemini"),
+                        help="Directorio del certificado TLS autofirmado")
+    parser.add_argument("--latency", type=float, default=1.0, help="Latencia media por llamada (s)")
+    parser.add_argument("--jitter", type=float, default=0.3, help="Desviación estándar de la latencia (s)")
+    parser.add_argument("--ms-per-token", type=float, default=0.0, help="Latencia adicional por token de salida (ms)")
+    parser.add_argument("--output-tokens", type=int, default=400, help="Tokens aproximados de cada respuesta")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fracción de llamadas con 429 (cuota)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fracción de llamadas con 500 (interno)")
+    parser.add_argument("--max-concurrency", type=int, default=512, help="Llamadas simultáneas máximas")
+    parser.add_argument("--seed", type=int, help="Semilla para respuestas y errores reproducibles")
+    args = parser.parse_args(argv)
+
+    mock = MockGemini(args.latency, args.jitter, args.ms_per_token, args.throttle_rate, args.error_rate,
+                      args.output_tokens, args.seed)
+    servidor = serve(mock, args.port, args.cert_dir, args.max_concurrency)
+    crt, _ = ensure_certificate(args.cert_dir)
+    print(f"Mock de Gemini escuchando en localhost:{args.port}")
+    print(f"  GEMINI_API_ENDPOINT=localhost:{args.port}")
+    print(f"  GRPC_DEFAULT_SSL_ROOTS_FILE_PATH={crt}", flush=True)
+
+    detener = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: detener.set())
+    try:
+        while not detener.wait(10):
+            print(f"  llamadas: {mock.stats} en vuelo: {mock.in_flight}", flush=True)
+    except KeyboardInterrupt:
+        pass
+    servidor.stop(grace=1)
+    print(f"Llamadas atendidas: {mock.stats}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,75 @@
+"""
+Escritura de archivos ZIP (y gzip) en streaming.
+
+zipfile puede escribir sobre un flujo no "seekable" (usa data descriptors en
+lugar de volver atrás a completar las cabeceras). Aquí el flujo es un buffer
+que se vacía después de cada escritura, de modo que los bytes del ZIP se
+entregan al cliente a medida que se producen los miembros y la memoria usada
+queda acotada al fragmento en curso.
+"""
+import io
+import time
+import zipfile
+import zlib
+
+
+class _DrainBuffer(io.RawIOBase):
+    """Destino de escritura no seekable que acumula bytes hasta que se vacía."""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def stream_zip(members):
+    """
+    Genera los bytes de un ZIP a partir de miembros (nombre, iterable_de_bytes, comprimir).
+    Cada iterable se consume solo cuando se llega a su miembro. Los miembros que ya
+    están comprimidos (por ejemplo XLSX) deben pasarse con comprimir=False.
+    """
+    buffer = _DrainBuffer()
+    with zipfile.ZipFile(buffer, mode="w") as zip_file:
+        for name, chunks, compress in members:
+            info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+            with zip_file.open(info, mode="w") as destino:
+                for chunk in chunks:
+                    destino.write(chunk)
+                    data = buffer.drain()
+                    if data:
+                        yield data
+            data = buffer.drain()
+            if data:
+                yield data
+    # Directorio central
+    data = buffer.drain()
+    if data:
+        yield data
+
+
+def gzip_stream(chunks, level=6):
+    """Comprime en gzip un iterable de bytes, entregando la salida a medida que se produce."""
+    # wbits=31: formato gzip (cabecera y CRC) en lugar de zlib
+    compresor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        # Z_SYNC_FLUSH entrega cada bloque completo para que el cliente lo procese sin esperar al final
+        data = compresor.compress(chunk) + compresor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compresor.flush()